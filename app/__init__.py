@@ -2,14 +2,17 @@
 Package: app
 
 Package for the application models and services
-This module also sets up the logging to be used with gunicorn
+create_app() sets up the logging to be used with gunicorn and connects
+the app to its database, importing the app does neither
 """
 
+import time
+IMPORT_STARTED = time.time()
+
+import os
 import logging
 from flask import Flask
-# Since we're using IBM DB2, we need to import the dependencies
-import ibm_db_sa
-from .vcap_services import get_database_uri
+from .vcap_services import get_database_uri, get_replica_uris, get_shard_uris, get_pool_options
 
 # Create Flask application
 app = Flask(__name__)
@@ -20,20 +23,135 @@ app = Flask(__name__)
 # app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
 app.config['SQLALCHEMY_DATABASE_URI'] = get_database_uri()
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+# Connection pool: recycle connections before DB2 drops them when idle and
+# test each one on checkout so a stale connection never fails a request
+POOL_OPTIONS = get_pool_options()
+app.config['SQLALCHEMY_POOL_SIZE'] = POOL_OPTIONS.get('pool_size')
+app.config['SQLALCHEMY_MAX_OVERFLOW'] = POOL_OPTIONS.get('max_overflow')
+app.config['SQLALCHEMY_POOL_TIMEOUT'] = POOL_OPTIONS.get('pool_timeout')
+app.config['SQLALCHEMY_POOL_RECYCLE'] = POOL_OPTIONS.get('pool_recycle', 1800)
+app.config['SQLALCHEMY_POOL_PRE_PING'] = POOL_OPTIONS.get('pool_pre_ping', True)
+# Read replicas for the read-only queries of GET requests, how long one that
+# failed is skipped, how long reads stay on the primary after a write, and
+# how far behind the primary a replica may fall before it is skipped (0 not to check)
+app.config['REPLICA_URIS'] = get_replica_uris()
+app.config['REPLICA_RETRY_SECONDS'] = float(os.getenv('REPLICA_RETRY_SECONDS', '30'))
+app.config['REPLICA_STICKY_SECONDS'] = float(os.getenv('REPLICA_STICKY_SECONDS', '5'))
+app.config['REPLICA_MAX_LAG_SECONDS'] = float(os.getenv('REPLICA_MAX_LAG_SECONDS', '30'))
+# Shards of the products table, none to keep them in SQLALCHEMY_DATABASE_URI,
+# what places new products on a shard (id or category), and how many ids a
+# worker reserves at a time
+app.config['SHARD_URIS'] = get_shard_uris()
+app.config['SHARD_KEY'] = os.getenv('SHARD_KEY', 'id').lower()
+app.config['SHARD_ID_BLOCK'] = int(os.getenv('SHARD_ID_BLOCK', '100'))
 app.config['SECRET_KEY'] = 'please, tell nobody... Shhhh'
 app.config['LOGGING_LEVEL'] = logging.INFO
+# Product cache: local (per worker) or redis (shared by every worker at CACHE_URL)
+app.config['CACHE_BACKEND'] = os.getenv('CACHE_BACKEND', 'local')
+app.config['CACHE_URL'] = os.getenv('CACHE_URL', 'redis://localhost:6379/0')
+# Size and time to live in seconds of the in-process cache, a size of 0 disables it
+app.config['CACHE_SIZE'] = int(os.getenv('CACHE_SIZE', '1024'))
+app.config['CACHE_TTL'] = float(os.getenv('CACHE_TTL', '60'))
+# Lists are only cached by the redis backend, and never with more products than this
+app.config['CACHE_LIST_MAX'] = int(os.getenv('CACHE_LIST_MAX', '1000'))
+# Rows written per statement by the bulk endpoints
+app.config['BULK_BATCH_SIZE'] = int(os.getenv('BULK_BATCH_SIZE', '1000'))
+# Seconds before the in-process search index is rebuilt to pick up other workers' writes
+app.config['SEARCH_INDEX_TTL'] = float(os.getenv('SEARCH_INDEX_TTL', '300'))
+# Indent JSON responses, which are otherwise written without any whitespace
+app.config['JSONIFY_PRETTYPRINT_REGULAR'] = os.getenv('JSON_PRETTYPRINT', 'false').lower() == 'true'
+# Responses smaller than this many bytes are sent uncompressed
+app.config['COMPRESS_MIN_SIZE'] = int(os.getenv('COMPRESS_MIN_SIZE', '1024'))
+# gzip level (1-9) and brotli quality (0-11), favoring speed for dynamic responses
+app.config['COMPRESS_LEVEL'] = int(os.getenv('COMPRESS_LEVEL', '6'))
+app.config['COMPRESS_BROTLI_QUALITY'] = int(os.getenv('COMPRESS_BROTLI_QUALITY', '4'))
+# Keep running totals for GET /products/stats instead of aggregating every product
+app.config['STATS_SUMMARY'] = os.getenv('STATS_SUMMARY', 'false').lower() == 'true'
+# Change feed: longest long-poll and server-sent events stream, in seconds (0 on
+# sync workers, see gunicorn.conf.py), how often they look for other workers'
+# changes, and how long a gap in the sequence numbers is waited on before it is
+# taken to be a rolled back write
+app.config['CHANGES_MAX_WAIT'] = float(os.getenv('CHANGES_MAX_WAIT', '30'))
+app.config['CHANGES_STREAM_SECONDS'] = float(os.getenv('CHANGES_STREAM_SECONDS', '300'))
+app.config['CHANGES_POLL_INTERVAL'] = float(os.getenv('CHANGES_POLL_INTERVAL', '1'))
+app.config['CHANGES_SETTLE'] = float(os.getenv('CHANGES_SETTLE', '5'))
+# Write-behind for PUT /products/{id}/unavailable: off, group (answer once the
+# batch is committed) or async (answer once queued), the most seconds a change
+# is held, the number of products that triggers a write, and how long a group
+# request waits for its batch
+app.config['WRITE_BEHIND'] = os.getenv('WRITE_BEHIND', 'off').lower()
+app.config['WRITE_BEHIND_INTERVAL'] = float(os.getenv('WRITE_BEHIND_INTERVAL', '0.05'))
+app.config['WRITE_BEHIND_BATCH'] = int(os.getenv('WRITE_BEHIND_BATCH', '500'))
+app.config['WRITE_BEHIND_TIMEOUT'] = float(os.getenv('WRITE_BEHIND_TIMEOUT', '5'))
+# Record the SQL statements of every request, flagging any run this many times
+app.config['SQL_PROFILING'] = os.getenv('SQL_PROFILING', 'false').lower() == 'true'
+app.config['SQL_PROFILING_REPEAT'] = int(os.getenv('SQL_PROFILING_REPEAT', '5'))
 
 import service
 
-# Set up logging for production
-print 'Setting up logging for {}...'.format(__name__)
-if __name__ != '__main__':
+IMPORT_SECONDS = time.time() - IMPORT_STARTED
+initialized = False
+
+
+def load_driver(database_uri):
+    """ Imports the database driver that SQLAlchemy does not load by itself """
+    if database_uri.split(':', 1)[0].split('+', 1)[0] in ('db2', 'ibm_db_sa'):
+        # Since we're using IBM DB2, we need to import the dependencies
+        import ibm_db_sa
+
+
+def create_app(check_schema=None):
+    """
+    Initializes the app the first time it is called and returns it
+
+    Run it under gunicorn with app:create_app(). The schema is created and
+    migrated when check_schema is True, which defaults to the SCHEMA_CHECK
+    environment variable. gunicorn.conf.py checks the schema once in the
+    master with check_schema() and turns the check off for the workers,
+    so a worker only connects to the database when it serves a request.
+    """
+    global initialized
+    if initialized:
+        return app
+    started = time.time()
+    if check_schema is None:
+        check_schema = os.getenv('SCHEMA_CHECK', 'true').lower() == 'true'
+    load_driver(app.config['SQLALCHEMY_DATABASE_URI'])
+
+    # Set up logging for production
+    print('Setting up logging for {}...'.format(__name__))
     gunicorn_logger = logging.getLogger('gunicorn.error')
     if gunicorn_logger:
         app.logger.handlers = gunicorn_logger.handlers
         app.logger.setLevel(gunicorn_logger.level)
     else:
         service.initialize_logging()
-    service.init_db()  # make our sqlalchemy tables
+    service.init_db(check_schema)
+    initialized = True
+    app.logger.info('Logging established')
+    app.logger.info('Imported in %.3fs, booted in %.3fs (schema check %s)', IMPORT_SECONDS,
+                    time.time() - started, 'on' if check_schema else 'off')
+    return app
+
+
+def check_schema():
+    """ Creates and migrates the database schema, then closes its connections
 
-app.logger.info('Logging established')
+    Nothing else is initialized, so it is safe to call in a process that
+    forks workers afterwards
+    """
+    from .models import db, Products, ProductStats
+    from . import migrations
+    load_driver(app.config['SQLALCHEMY_DATABASE_URI'])
+    db.init_app(app)
+    with app.app_context():
+        db.create_all()
+        version = migrations.upgrade()
+        shards = Products.connect_shards(app)
+        shards.create_all()
+        shards.dispose()
+        if app.config['STATS_SUMMARY'] and not shards:
+            ProductStats.rebuild()
+        db.session.remove()
+        db.get_engine(app).dispose()
+    return version
@@ -0,0 +1,396 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Product Cache
+
+Caches of serialized products and product lists behind a common
+CacheBackend interface:
+
+LRUCache - a bounded in-process cache that only the current worker sees
+RedisCache - a cache shared by every worker and instance through Redis
+
+Writes call invalidate() with the keys they touched. This also retires
+every cached list, since any write can change the result of a list query.
+Readers that fill the cache from the database pass the generation() they
+saw before reading to set(), which then keeps nothing if an invalidation
+came in between, so a value read before a write never outlives it.
+RedisCache publishes invalidations so that the local cache in front of it
+in every other worker drops its stale entries too.
+"""
+import json
+import time
+import logging
+import threading
+from collections import OrderedDict
+import redis
+
+logger = logging.getLogger(__name__)
+
+
+class CacheBackend(object):
+    """ Interface that every product cache implements """
+    # True when every worker sees the same entries and invalidations
+    shared = False
+
+    def get(self, key):
+        """ Returns the value stored for key, or None if it is not cached """
+        raise NotImplementedError
+
+    def set(self, key, value, generation=None):
+        """ Stores a JSON serializable value for key
+
+        When generation is given the value is only kept if nothing was
+        invalidated since generation() returned it
+        """
+        raise NotImplementedError
+
+    def get_many(self, keys):
+        """ Returns a dictionary of the values stored for the keys that are cached """
+        values = {}
+        for key in keys:
+            value = self.get(key)
+            if value is not None:
+                values[key] = value
+        return values
+
+    def set_many(self, values, generation=None):
+        """ Stores a dictionary of JSON serializable values by key, like set() """
+        for key, value in values.items():
+            self.set(key, value, generation)
+
+    def invalidate(self, *keys):
+        """ Removes keys from the cache and retires every cached list """
+        raise NotImplementedError
+
+    def generation(self):
+        """ Returns a number that changes whenever cached lists are retired """
+        raise NotImplementedError
+
+    def clear(self):
+        """ Removes every entry from the cache """
+        raise NotImplementedError
+
+    def stats(self):
+        """ Returns the cache counters as a dictionary """
+        raise NotImplementedError
+
+    def close(self):
+        """ Releases any connections or threads held by the cache """
+        pass
+
+
+class LRUCache(CacheBackend):
+    """
+    Least recently used cache with a time to live
+
+    Args:
+        maxsize (int): the most entries to hold, 0 disables the cache
+        ttl (float): seconds an entry stays fresh, 0 for no expiry
+    """
+
+    def __init__(self, maxsize=1024, ttl=60):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self._generation = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    def get(self, key):
+        """ Returns the value stored for key, or None if it is missing or expired """
+        with self._lock:
+            entry = self._entries.pop(key, None)
+            if entry is None:
+                self.misses += 1
+                return None
+            value, expires = entry
+            if expires and expires < time.time():
+                self.misses += 1
+                self.evictions += 1
+                return None
+            # re-insert to mark it as the most recently used
+            self._entries[key] = entry
+            self.hits += 1
+            return value
+
+    def set(self, key, value, generation=None):
+        """ Stores value for key, evicting the least recently used entry if full
+
+        Nothing is stored if generation is given and no longer current
+        """
+        if self.maxsize <= 0:
+            return
+        expires = time.time() + self.ttl if self.ttl else None
+        with self._lock:
+            if generation is not None and generation != self._generation:
+                return
+            self._entries.pop(key, None)
+            self._entries[key] = (value, expires)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def delete(self, key):
+        """ Removes key from the cache """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def invalidate(self, *keys):
+        """ Removes keys from the cache and retires every cached list """
+        with self._lock:
+            for key in keys:
+                self._entries.pop(key, None)
+            self._generation += 1
+
+    def generation(self):
+        """ Returns a number that changes whenever cached lists are retired """
+        return self._generation
+
+    def clear(self):
+        """ Removes every entry from the cache """
+        with self._lock:
+            self._entries.clear()
+            self._generation += 1
+
+    def stats(self):
+        """ Returns the cache counters as a dictionary """
+        with self._lock:
+            return {"backend": "local",
+                    "size": len(self._entries),
+                    "maxsize": self.maxsize,
+                    "ttl": self.ttl,
+                    "hits": self.hits,
+                    "misses": self.misses,
+                    "evictions": self.evictions}
+
+
+class RedisCache(CacheBackend):
+    """
+    Cache shared by every worker through a Redis server
+
+    Values are stored as JSON under prefix. Redis errors are logged and
+    treated as cache misses so the service keeps working from the database.
+
+    Args:
+        url (string): the Redis URL, e.g. redis://localhost:6379/0
+        ttl (float): seconds an entry stays fresh, 0 for no expiry
+        local (LRUCache): an optional in-process cache consulted first,
+            kept coherent through the invalidations published by writers
+        prefix (string): prepended to every key and to the channel name
+    """
+
+    shared = True
+
+    def __init__(self, url, ttl=60, local=None, prefix='products:'):
+        self.url = url
+        self.ttl = ttl
+        self.local = local
+        self.prefix = prefix
+        self.channel = prefix + 'invalidate'
+        self.client = redis.StrictRedis.from_url(url)
+        self.hits = 0
+        self.misses = 0
+        self.errors = 0
+        self._listener = None
+        if local is not None:
+            try:
+                pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+                pubsub.subscribe(**{self.channel: self._on_invalidate})
+                self._listener = pubsub.run_in_thread(sleep_time=1, daemon=True)
+            except redis.RedisError as error:
+                # without invalidations the local cache could serve stale data
+                self._error(error)
+                self.local = None
+
+    def get(self, key):
+        """ Returns the value stored for key, or None if it is not cached """
+        local_generation = None
+        if self.local is not None:
+            value = self.local.get(key)
+            if value is not None:
+                return value
+            # an invalidation published while Redis is read must win
+            local_generation = self.local.generation()
+        try:
+            data = self.client.get(self.prefix + key)
+        except redis.RedisError as error:
+            self._error(error)
+            return None
+        if data is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        value = json.loads(data)
+        if self.local is not None:
+            self.local.set(key, value, local_generation)
+        return value
+
+    def set(self, key, value, generation=None):
+        """ Stores a JSON serializable value for key
+
+        With a generation the value is stored and then removed again if
+        the generation moved on, see _store()
+        """
+        self.set_many({key: value}, generation)
+
+    def get_many(self, keys):
+        """ Returns the values stored for the keys that are cached, with a single MGET """
+        values, local_generation = {}, None
+        if self.local is not None:
+            values = self.local.get_many(keys)
+            local_generation = self.local.generation()
+        missing = [key for key in keys if key not in values]
+        if not missing:
+            return values
+        try:
+            data = self.client.mget([self.prefix + key for key in missing])
+        except redis.RedisError as error:
+            self._error(error)
+            return values
+        fetched = {}
+        for key, item in zip(missing, data):
+            if item is None:
+                self.misses += 1
+            else:
+                self.hits += 1
+                fetched[key] = json.loads(item)
+        if self.local is not None:
+            self.local.set_many(fetched, local_generation)
+        values.update(fetched)
+        return values
+
+    def set_many(self, values, generation=None):
+        """ Stores a dictionary of JSON serializable values by key in a single round trip """
+        if not values:
+            return
+        local_generation = self.local.generation() if self.local is not None else None
+        try:
+            if not self._store(values, generation):
+                return
+        except redis.RedisError as error:
+            self._error(error)
+            return
+        if self.local is not None:
+            self.local.set_many(values, local_generation)
+
+    def _store(self, values, generation):
+        """ Sets values in Redis, returns False if they were dropped as stale
+
+        The generation is read back in the same round trip as the SET. If
+        it moved on the values are deleted again: an invalidation that
+        incremented it earlier may have deleted the keys before the SET,
+        and one that increments it later deletes them after, since
+        invalidate() increments before it deletes
+        """
+        pipe = self.client.pipeline(transaction=False)
+        for key, value in values.items():
+            pipe.set(self.prefix + key, json.dumps(value), ex=int(self.ttl) or None)
+        if generation is None:
+            pipe.execute()
+            return True
+        pipe.get(self.prefix + 'generation')
+        current = int(pipe.execute()[-1] or 0)
+        if current == generation:
+            return True
+        self.client.delete(*[self.prefix + key for key in values])
+        return False
+
+    def invalidate(self, *keys):
+        """ Removes keys from the cache, retires every cached list and tells the other workers """
+        if self.local is not None:
+            self.local.invalidate(*keys)
+        try:
+            # increment before deleting, which _store() relies on
+            pipe = self.client.pipeline(transaction=False)
+            pipe.incr(self.prefix + 'generation')
+            if keys:
+                pipe.delete(*[self.prefix + key for key in keys])
+            pipe.publish(self.channel, json.dumps(keys))
+            pipe.execute()
+        except redis.RedisError as error:
+            self._error(error)
+
+    def generation(self):
+        """ Returns a number that changes whenever cached lists are retired """
+        try:
+            return int(self.client.get(self.prefix + 'generation') or 0)
+        except redis.RedisError as error:
+            self._error(error)
+            return None
+
+    def clear(self):
+        """ Removes every entry under prefix from the cache and tells the other workers """
+        if self.local is not None:
+            self.local.clear()
+        try:
+            keys = list(self.client.scan_iter(match=self.prefix + '*'))
+            pipe = self.client.pipeline(transaction=False)
+            if keys:
+                pipe.delete(*keys)
+            pipe.incr(self.prefix + 'generation')
+            pipe.publish(self.channel, json.dumps(None))
+            pipe.execute()
+        except redis.RedisError as error:
+            self._error(error)
+
+    def stats(self):
+        """ Returns the cache counters as a dictionary """
+        stats = {"backend": "redis",
+                 "ttl": self.ttl,
+                 "hits": self.hits,
+                 "misses": self.misses,
+                 "errors": self.errors}
+        if self.local is not None:
+            stats["local"] = self.local.stats()
+        return stats
+
+    def close(self):
+        """ Stops listening for invalidations """
+        if self._listener is not None:
+            self._listener.stop()
+            self._listener = None
+
+    def _on_invalidate(self, message):
+        """ Drops the entries another worker invalidated from the local cache """
+        keys = json.loads(message['data'])
+        if keys is None:
+            self.local.clear()
+        else:
+            self.local.invalidate(*keys)
+
+    def _error(self, error):
+        """ Counts and logs a Redis failure """
+        self.errors += 1
+        logger.warning('Redis cache error: %s', error)
+
+
+def make_cache(backend='local', url=None, maxsize=1024, ttl=60):
+    """
+    Creates the product cache from the configuration
+
+    Args:
+        backend (string): local for an in-process cache or redis for a shared one
+        url (string): the Redis URL when backend is redis
+        maxsize (int): the size of the in-process cache, 0 disables it
+        ttl (float): seconds an entry stays fresh
+    """
+    if backend == 'local':
+        return LRUCache(maxsize, ttl)
+    if backend == 'redis':
+        local = LRUCache(maxsize, ttl) if maxsize > 0 else None
+        return RedisCache(url, ttl, local)
+    raise ValueError('Unknown cache backend: {}'.format(backend))
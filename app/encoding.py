@@ -0,0 +1,150 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Response Encodings
+
+Negotiates how responses go over the wire:
+- JSON is written without indentation or spaces unless
+  JSONIFY_PRETTYPRINT_REGULAR is set, even in debug mode
+- JSON responses are sent as MessagePack to clients that prefer
+  application/msgpack in Accept
+- bodies of at least COMPRESS_MIN_SIZE bytes are compressed with brotli
+  or gzip, whichever the client accepts (brotli first), and streamed
+  bodies are compressed as they are streamed
+- the ETag of a MessagePack or compressed body gets a suffix for each
+  transformation, e.g. "7-2-msgpack-gzip", since a strong ETag must
+  differ between representations. base_etag() removes them again
+
+Brotli and MessagePack are only offered when their packages are installed.
+"""
+import zlib
+from flask import request, current_app, has_app_context, json
+from flask.json import JSONEncoder
+
+try:
+    import brotli
+except ImportError:   # pragma: no cover
+    brotli = None
+try:
+    import msgpack
+except ImportError:   # pragma: no cover
+    msgpack = None
+
+JSON_MIMETYPE = 'application/json'
+MSGPACK_MIMETYPE = 'application/msgpack'
+# ETag suffixes of the transformed representations
+SUFFIXES = ('-msgpack', '-br', '-gzip')
+# media types worth compressing, anything else (images, archives) already is
+COMPRESSIBLE = ('application/json', 'application/x-ndjson', 'application/msgpack',
+                'text/csv', 'text/plain', 'text/html')
+
+
+class CompactJSONEncoder(JSONEncoder):
+    """ A JSON encoder that ignores the indentation Flask asks for in debug mode """
+
+    def __init__(self, **kwargs):
+        if has_app_context() and not current_app.config['JSONIFY_PRETTYPRINT_REGULAR']:
+            kwargs.update(indent=None, separators=(',', ':'))
+        super(CompactJSONEncoder, self).__init__(**kwargs)
+
+
+def encodings():
+    """ Returns the content codings the server can send, in order of preference """
+    return (['br'] if brotli else []) + ['gzip']
+
+
+def compressor(coding):
+    """ Returns a (compress, flush) pair of functions for a content coding """
+    config = current_app.config
+    if coding == 'br':
+        engine = brotli.Compressor(quality=config['COMPRESS_BROTLI_QUALITY'])
+        return engine.process, engine.finish
+    # wbits 16 + 15 writes the gzip header and trailer around the deflate stream
+    engine = zlib.compressobj(config['COMPRESS_LEVEL'], zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    return engine.compress, engine.flush
+
+
+def compress_stream(chunks, compress, flush):
+    """ Yields the compressed chunks of a streamed body, buffering only what zlib or brotli does """
+    for chunk in chunks:
+        if not isinstance(chunk, bytes):
+            chunk = chunk.encode('utf-8')
+        data = compress(chunk)
+        if data:
+            yield data
+    yield flush()
+
+
+def base_etag(etag):
+    """ Returns an ETag without the suffixes of its representation """
+    while etag.endswith(SUFFIXES):
+        etag = etag[:etag.rindex('-')]
+    return etag
+
+
+def tag_representation(response, suffix):
+    """ Adds the suffix of a transformation to the ETag of a response, if it has one """
+    etag, weak = response.get_etag()
+    if etag:
+        response.set_etag(etag + suffix, weak)
+
+
+def to_msgpack(response):
+    """ Replaces a JSON body with the same data as MessagePack """
+    data = json.loads(response.get_data(as_text=True))
+    response.set_data(msgpack.packb(data, use_bin_type=True))
+    response.mimetype = MSGPACK_MIMETYPE
+    tag_representation(response, '-msgpack')
+
+
+def compress(response, coding):
+    """ Compresses the body of a response with a content coding """
+    # made here because the stream is sent after the app context is gone
+    compress_body, flush = compressor(coding)
+    if response.is_streamed:
+        response.response = compress_stream(response.response, compress_body, flush)
+        response.headers.pop('Content-Length', None)
+    else:
+        response.set_data(compress_body(response.get_data()) + flush())
+    response.headers['Content-Encoding'] = coding
+    tag_representation(response, '-' + coding)
+
+
+def encode_response(response):
+    """ Sends a response in the best encoding the client accepts """
+    if response.direct_passthrough or 'Content-Encoding' in response.headers or \
+            response.status_code in (204, 206, 304) or request.method == 'HEAD':
+        return response
+    if response.mimetype == JSON_MIMETYPE and not response.is_streamed:
+        response.vary.add('Accept')
+        if msgpack and request.accept_mimetypes.best_match(
+                [JSON_MIMETYPE, MSGPACK_MIMETYPE]) == MSGPACK_MIMETYPE:
+            to_msgpack(response)
+    if response.mimetype not in COMPRESSIBLE:
+        return response
+    response.vary.add('Accept-Encoding')
+    if not response.is_streamed and \
+            (response.content_length or 0) < current_app.config['COMPRESS_MIN_SIZE']:
+        return response
+    coding = request.accept_encodings.best_match(encodings())
+    if coding:
+        compress(response, coding)
+    return response
+
+
+def init_app(app):
+    """ Encodes the responses of app """
+    app.json_encoder = CompactJSONEncoder
+    app.after_request(encode_response)
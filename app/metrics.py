@@ -0,0 +1,123 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Request Metrics
+
+Prometheus histograms of the latency, response size and database work
+of every request, labelled with the Flask route rule (not the URL, so
+/products/1 and /products/2 share one series) and the status code.
+
+Each gunicorn worker is a separate process. When the
+prometheus_multiproc_dir environment variable names a writable directory
+every worker writes its samples there and /metrics adds them all up, so
+it reports the same totals whichever worker serves it. The directory must
+be emptied before the server starts; gunicorn.conf.py removes the files
+of workers that exit.
+"""
+import os
+import time
+from flask import g, request
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+from prometheus_client import CollectorRegistry, Histogram, REGISTRY, \
+                              CONTENT_TYPE_LATEST, generate_latest, multiprocess
+
+LATENCY_BUCKETS = (.001, .0025, .005, .01, .025, .05, .1, .25, .5, 1, 2.5, 5, 10)
+SIZE_BUCKETS = (100, 1000, 10000, 100000, 1000000, 10000000)
+QUERY_BUCKETS = (0, 1, 2, 3, 5, 10, 25, 50, 100)
+
+REQUEST_LATENCY = Histogram('http_request_duration_seconds',
+                            'Time spent serving a request',
+                            ['method', 'route', 'status'], buckets=LATENCY_BUCKETS)
+RESPONSE_SIZE = Histogram('http_response_size_bytes',
+                          'Size of the response body',
+                          ['method', 'route', 'status'], buckets=SIZE_BUCKETS)
+DB_QUERIES = Histogram('db_queries_per_request',
+                       'Number of SQL statements executed by a request',
+                       ['method', 'route'], buckets=QUERY_BUCKETS)
+DB_TIME = Histogram('db_query_duration_seconds',
+                    'Time a request spent executing SQL statements',
+                    ['method', 'route'], buckets=LATENCY_BUCKETS)
+
+
+def route_label():
+    """ Returns the route rule that matched the request """
+    if request.url_rule is None:
+        return 'unmatched'  # 404s must not create a series per URL
+    return request.url_rule.rule
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """ Notes when a statement starts so its time can be measured """
+    conn.info.setdefault('query_start', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """ Adds a finished statement to the counters of the current request """
+    elapsed = time.time() - conn.info['query_start'].pop()
+    try:
+        g.db_queries += 1
+        g.db_time += elapsed
+    except (AttributeError, RuntimeError):
+        pass    # outside a request, or before the request was started
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    """ Forgets the start of a statement that failed, which never reaches after_cursor_execute """
+    connection = context.connection
+    if context.statement is not None and connection is not None and \
+            connection.info.get('query_start'):
+        connection.info['query_start'].pop()
+
+
+def start_request():
+    """ Resets the timers and counters of a new request """
+    g.request_start = time.time()
+    g.db_queries = 0
+    g.db_time = 0.0
+
+
+def record_request(response):
+    """ Observes the latency, size and database work of a finished request """
+    start = getattr(g, 'request_start', None)
+    if start is None or request.endpoint == 'metrics_endpoint':
+        return response
+    method, route, code = request.method, route_label(), str(response.status_code)
+    REQUEST_LATENCY.labels(method, route, code).observe(time.time() - start)
+    if response.content_length is not None:
+        # streamed responses have no length until they have been sent
+        RESPONSE_SIZE.labels(method, route, code).observe(response.content_length)
+    DB_QUERIES.labels(method, route).observe(g.db_queries)
+    DB_TIME.labels(method, route).observe(g.db_time)
+    return response
+
+
+def init_app(app):
+    """ Records the metrics of every request served by app """
+    app.before_request(start_request)
+    app.after_request(record_request)
+
+
+def collect():
+    """ Returns the exposition text of every metric and its content type """
+    if os.getenv('prometheus_multiproc_dir'):
+        registry = CollectorRegistry()
+        multiprocess.MultiProcessCollector(registry)
+    else:
+        registry = REGISTRY
+    return generate_latest(registry), CONTENT_TYPE_LATEST
@@ -0,0 +1,234 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Schema Migrations
+
+db.create_all() only creates missing tables, it never alters one that
+already exists. This module brings existing Postgres/DB2 tables up to
+date by running numbered migrations in order and recording the last one
+applied in the schema_version table.
+
+To change the schema, add a function below and append it to MIGRATIONS
+with the next version number. Migrations must be safe to run against a
+table that db.create_all() has just created with the current schema.
+"""
+import logging
+from datetime import datetime
+from sqlalchemy import inspect
+from sqlalchemy.types import Integer
+from .models import db, Products, ProductStats, ProductChange, ProductIds
+
+logger = logging.getLogger(__name__)
+
+# the names of the DB2 dialect
+DB2_DIALECTS = ('ibm_db_sa', 'db2')
+# the price columns, stored as whole numbers of cents since version 6
+PRICE_COLUMNS = [(Products.__table__, ('price',)),
+                 (ProductStats.__table__, ('price_sum', 'price_min', 'price_max'))]
+
+
+class SchemaVersion(db.Model):
+    """ The single row that records the last migration applied """
+    __tablename__ = 'schema_version'
+    id = db.Column(db.Integer, primary_key=True)
+    version = db.Column(db.Integer, nullable=False)
+
+
+def create_missing_indexes(table):
+    """ Creates every index declared on a table that the database is missing """
+    existing = set(index['name'] for index in inspect(db.engine).get_indexes(table.name))
+    for index in table.indexes:
+        if index.name not in existing:
+            logger.info('Creating index %s', index.name)
+            index.create(db.engine)
+
+
+def is_integer(table, name):
+    """ Returns True if the database declares a column as an integer type """
+    columns = dict((column['name'], column['type'])
+                   for column in inspect(db.engine).get_columns(table.name))
+    return isinstance(columns[name], Integer)
+
+
+def set_data_type(table, name, data_type):
+    """ Changes the type of a column in place, converting its values
+
+    DB2 puts the table in reorg pending state after the change, so it is
+    reorganized before it is used again
+    """
+    logger.info('Changing %s.%s to %s', table.name, name, data_type)
+    if db.engine.dialect.name == 'postgresql':
+        db.engine.execute('ALTER TABLE {} ALTER COLUMN {} TYPE {}'
+                          .format(table.name, name, data_type))
+    elif db.engine.dialect.name in DB2_DIALECTS:
+        db.engine.execute('ALTER TABLE {} ALTER COLUMN {} SET DATA TYPE {}'
+                          .format(table.name, name, data_type))
+        db.engine.execute("CALL SYSPROC.ADMIN_CMD('REORG TABLE {}')".format(table.name))
+    else:
+        raise RuntimeError('Cannot change {}.{} to {} on {}, change it by hand'
+                           .format(table.name, name, data_type, db.engine.dialect.name))
+
+
+def require_exact_prices():
+    """ Makes every price column BIGINT, or fails if the database cannot hold cents exactly
+
+    SQLite keeps the type it has: its REAL is a double, which is exact
+    for every whole number of cents up to MAX_PRICE
+    """
+    if db.engine.dialect.name == 'sqlite':
+        return
+    for table, columns in PRICE_COLUMNS:
+        for name in columns:
+            if not is_integer(table, name):
+                set_data_type(table, name, 'BIGINT')
+
+
+def add_missing_columns(table):
+    """ Adds every column declared on a table that the database is missing
+
+    Columns are added with their server default, which fills in the
+    existing rows, and are otherwise nullable
+    """
+    existing = set(column['name'] for column in inspect(db.engine).get_columns(table.name))
+    dialect = db.engine.dialect
+    for column in table.columns:
+        if column.name in existing:
+            continue
+        ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+            table.name, column.name, column.type.compile(dialect=dialect))
+        if column.server_default is not None:
+            default = column.server_default.arg
+            if not default.isdigit():
+                default = "'{}'".format(default)
+            ddl += ' DEFAULT {} NOT NULL'.format(default)
+        logger.info('Adding column %s.%s', table.name, column.name)
+        db.engine.execute(ddl)
+
+
+def add_lookup_indexes():
+    """ Version 1: indexes for the Products lookup columns """
+    create_missing_indexes(Products.__table__)
+
+
+def add_version_columns():
+    """ Version 2: version and updated_at columns for conditional requests """
+    add_missing_columns(Products.__table__)
+    table = Products.__table__
+    db.engine.execute(table.update().where(table.c.updated_at.is_(None))
+                      .values(updated_at=datetime.utcnow()))
+
+
+def add_search_indexes():
+    """ Version 3: full-text and trigram indexes for searches on Postgres
+
+    Other databases search an in-process index and need nothing here
+    """
+    if db.engine.dialect.name != 'postgresql':
+        return
+    db.engine.execute('CREATE EXTENSION IF NOT EXISTS pg_trgm')
+    # the expression must match the document of Products._search_postgres
+    db.engine.execute("CREATE INDEX IF NOT EXISTS ix_products_search ON products "
+                      "USING gin (to_tsvector('simple', coalesce(name, '') || ' ' || "
+                      "coalesce(category, '')))")
+    db.engine.execute('CREATE INDEX IF NOT EXISTS ix_products_name_trgm ON products '
+                      'USING gin (name gin_trgm_ops)')
+
+
+def add_stats_table():
+    """ Version 4: running totals for GET /products/stats """
+    ProductStats.__table__.create(db.engine, checkfirst=True)
+
+
+def add_change_feed():
+    """ Version 5: the change feed behind GET /products/changes """
+    ProductChange.__table__.create(db.engine, checkfirst=True)
+
+
+def exact_prices():
+    """ Version 6: prices stored as whole numbers of cents, and the category and price index
+
+    The columns become BIGINT, except on SQLite which holds the cents
+    exactly in the REAL it has. Columns that db.create_all() has just
+    created as integers already hold cents
+    """
+    dialect = db.engine.dialect.name
+    if dialect not in ('postgresql', 'sqlite') + DB2_DIALECTS:
+        require_exact_prices()    # fails before any price is changed
+    for table, columns in PRICE_COLUMNS:
+        columns = [name for name in columns if not is_integer(table, name)]
+        if dialect == 'postgresql':
+            for name in columns:
+                db.engine.execute('ALTER TABLE {0} ALTER COLUMN {1} TYPE BIGINT '
+                                  'USING round({1}::numeric * 100)'.format(table.name, name))
+            continue
+        if dialect in DB2_DIALECTS:
+            # DB2 maps the old FLOAT to a single precision REAL, which
+            # cannot hold the cents of large prices
+            for name in columns:
+                set_data_type(table, name, 'DOUBLE')
+        if columns:
+            db.engine.execute('UPDATE {} SET {}'.format(table.name, ', '.join(
+                '{0} = round({0} * 100)'.format(name) for name in columns)))
+    require_exact_prices()
+    create_missing_indexes(Products.__table__)
+
+
+def add_id_allocator():
+    """ Version 7: the allocator of product ids for SHARD_URIS """
+    ProductIds.__table__.create(db.engine, checkfirst=True)
+
+
+def bigint_prices():
+    """ Version 8: BIGINT price columns where version 6 kept a floating point type
+
+    Version 6 used to leave the cents in the old column type outside
+    Postgres, a single precision REAL on DB2
+    """
+    require_exact_prices()
+
+
+# (version, migration) pairs in the order they must be applied
+MIGRATIONS = [
+    (1, add_lookup_indexes),
+    (2, add_version_columns),
+    (3, add_search_indexes),
+    (4, add_stats_table),
+    (5, add_change_feed),
+    (6, exact_prices),
+    (7, add_id_allocator),
+    (8, bigint_prices),
+]
+
+
+def current_version():
+    """ Returns the version of the schema in the database """
+    row = SchemaVersion.query.get(1)
+    return row.version if row else 0
+
+
+def upgrade():
+    """ Applies every migration newer than the database schema """
+    SchemaVersion.__table__.create(db.engine, checkfirst=True)
+    version = current_version()
+    for number, migration in MIGRATIONS:
+        if number <= version:
+            continue
+        logger.info('Applying migration %s: %s', number, migration.__name__)
+        migration()
+        row = SchemaVersion.query.get(1) or SchemaVersion(id=1)
+        row.version = number
+        db.session.add(row)
+        db.session.commit()
+    return current_version()
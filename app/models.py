@@ -23,13 +23,204 @@ Attributes:
 name (string) - the name of the product
 category (string) - the category the product belongs to (i.e., apparel, shoe)
 available (boolean) - True for products that are available for purchase
-price (float) - the price of the product
+price (decimal) - the price of the product, stored exactly as a number of cents
+version (int) - incremented every time the product is saved
+updated_at (datetime) - when the product was last saved, in UTC
+
+product_stats - running totals of the products in each category and
+availability, kept when STATS_SUMMARY is on
+
+product_changes - the change feed, a numbered row for every product that
+was created, updated or deleted
 """
+import io
+import json
+import time
+import random
+import hashlib
+import numbers
 import logging
+import calendar
+import threading
+from collections import OrderedDict
+from decimal import Decimal, InvalidOperation, ROUND_HALF_UP
+from datetime import datetime, timedelta
+from json.encoder import c_encode_basestring_ascii, py_encode_basestring_ascii
+import sqlalchemy
 from flask_sqlalchemy import SQLAlchemy
+from sqlalchemy import func, bindparam, case, or_, select, inspect, literal, BigInteger
+from sqlalchemy.orm import sessionmaker
+from sqlalchemy.types import TypeDecorator
+from sqlalchemy.exc import SQLAlchemyError, DBAPIError, IntegrityError
+from sqlalchemy.orm.exc import StaleDataError
+from sqlalchemy.engine.url import make_url
+from .cache import LRUCache, make_cache
+from .search import SearchIndex, tokenize
+from .transfer import copy_line
+from .pool import InstrumentedQueuePool
+from .replicas import ReplicaSet
+from .routing import RoutedQuery, RoutingSession
+from .sharding import ShardSet
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """ SQLAlchemy that checks out connections from an InstrumentedQueuePool
+
+    Its sessions route statements to the shards, see app/routing.py, and
+    create_all() and drop_all() include the products table of the shards
+    """
+    # the shards of the products table, none until Products.init_db()
+    shards = ShardSet()
+
+    def create_session(self, options):
+        return sessionmaker(class_=RoutingSession, db=self, **options)
+
+    def apply_pool_defaults(self, app, options):
+        SQLAlchemy.apply_pool_defaults(self, app, options)
+        # SQLite replaces the pool class unless a pool size is configured
+        options['poolclass'] = InstrumentedQueuePool
+        options['pool_pre_ping'] = app.config.get('SQLALCHEMY_POOL_PRE_PING', False)
+
+    def create_all(self, bind='__all__', app=None):
+        SQLAlchemy.create_all(self, bind, app)
+        self.shards.create_all()
+
+    def drop_all(self, bind='__all__', app=None):
+        self.shards.drop_all()
+        SQLAlchemy.drop_all(self, bind, app)
+
+    def create_engine_for(self, app, uri):
+        """ Creates an engine for another database, a read replica, set up like the app's own """
+        info = make_url(uri)
+        options = {'convert_unicode': True}
+        self.apply_pool_defaults(app, options)
+        self.apply_driver_hacks(app, info, options)
+        return sqlalchemy.create_engine(info, **options)
+
 
 # Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+db = PooledSQLAlchemy(query_class=RoutedQuery)
+
+# Number of rows fetched per round trip when streaming results
+STREAM_BATCH_SIZE = 500
+# Number of rows written per statement by the bulk operations
+BULK_BATCH_SIZE = 1000
+# Number of ids looked up per IN query, below the 999 parameters of older SQLite
+LOOKUP_BATCH_SIZE = 500
+# Number of import errors reported by line, the rest are only counted
+IMPORT_MAX_ERRORS = 100
+
+# Prices are stored exactly, in cents, up to MAX_PRICE
+CENT = Decimal('0.01')
+MAX_PRICE = Decimal('99999999.99')
+
+# The serialize() keys in the order jsonify() sorts them, for encode_row()
+JSON_COLUMNS = ('available', 'category', 'id', 'name', 'price')
+JSON_ROW = '{"available":%s,"category":%s,"id":%s,"name":%s,"price":%s}'
+JSON_BOOLEANS = {True: 'true', False: 'false', None: 'null'}
+# use the C string encoder from the json module when it was built with one
+encode_string = c_encode_basestring_ascii or py_encode_basestring_ascii
+
+
+def to_price(value):
+    """ Converts a number or a string to a Decimal price rounded to the cent
+
+    Raises:
+        TypeError: if the value is None or not a number
+        ValueError: if the value is not a finite price up to MAX_PRICE
+    """
+    if value is None or isinstance(value, bool):
+        raise TypeError('price must be a number')
+    try:
+        # floats go through their shortest repr, so 2.675 rounds up as written
+        # rather than down from the 2.67499999... that the float holds
+        price = Decimal(repr(value) if isinstance(value, float) else value).quantize(
+            CENT, rounding=ROUND_HALF_UP)
+    except InvalidOperation:
+        raise ValueError('price must be a number')
+    if not price.is_finite():
+        raise ValueError('price must be a number')
+    if abs(price) > MAX_PRICE:
+        raise ValueError('price must be at most {}'.format(MAX_PRICE))
+    return price
+
+
+class Price(TypeDecorator):
+    """ A decimal price stored exactly as a whole number of cents
+
+    Prices are bound and read as Decimals, comparisons with the column
+    convert their values to cents so that they can use its indexes, and
+    sums, minimums and maximums of the column are prices too
+    """
+    impl = BigInteger
+
+    def process_bind_param(self, value, dialect):
+        if value is None:
+            return None
+        return int(to_price(value) / CENT)
+
+    def process_result_value(self, value, dialect):
+        if value is None:
+            return None
+        # SQLite returns floats for columns that were declared FLOAT before migration 6
+        return (Decimal(int(round(value))) * CENT).quantize(CENT)
+
+
+def to_timestamp(value):
+    """ Converts a naive UTC datetime to seconds since the epoch, or None """
+    if value is None:
+        return None
+    if not isinstance(value, datetime):
+        # SQLite returns aggregates of DateTime columns as strings
+        value = datetime.strptime(value[:19], '%Y-%m-%d %H:%M:%S')
+    return calendar.timegm(value.utctimetuple())
+
+
+def add_up(values):
+    """ Returns the sum of the values that are not None, None if there are none """
+    values = [value for value in values if value is not None]
+    return sum(values) if values else None
+
+
+def stats_keys(model, group_by):
+    """ Returns the group columns of a stats query, grouped like product_stats """
+    columns = {'category': func.coalesce(model.category, ''),
+               'available': func.coalesce(model.available, False)}
+    return [columns[key] for key in group_by]
+
+
+def stats_result(group_by, row):
+    """ Returns a stats row of group columns and totals as a dictionary
+
+    The totals are count, available_count, price_sum, priced, min and max
+    """
+    keys = len(group_by)
+    count, available, price_sum, priced, price_min, price_max = row[keys:]
+    result = dict(zip(group_by, row[:keys]))
+    if 'category' in result:
+        result['category'] = result['category'] or None
+    if 'available' in result:
+        result['available'] = bool(result['available'])
+    result.update(count=int(count),
+                  available_count=int(available or 0),
+                  avg_price=float(to_price(Decimal(price_sum) / priced)) if priced else None,
+                  min_price=None if price_min is None else float(price_min),
+                  max_price=None if price_max is None else float(price_max))
+    return result
+
+
+def merge_stats(rows, keys):
+    """ Adds up the stats rows of the shards by their first keys columns, in the order of the keys """
+    groups = {}
+    for row in rows:
+        groups.setdefault(tuple(row[:keys]), []).append(row[keys:])
+    merged = []
+    for key, totals in sorted(groups.items()):
+        count, available, price_sum, priced, price_min, price_max = zip(*totals)
+        merged.append(key + (add_up(count), add_up(available), add_up(price_sum), add_up(priced),
+                             min([value for value in price_min if value is not None] or [None]),
+                             max([value for value in price_max if value is not None] or [None])))
+    return merged
 
 
 class DataValidationError(Exception):
@@ -37,6 +228,11 @@ class DataValidationError(Exception):
     pass
 
 
+class VersionConflictError(Exception):
+    # Used when a product was changed since the version a client read
+    pass
+
+
 class Products(db.Model):
     """
     Class that represents a product
@@ -46,13 +242,36 @@ class Products(db.Model):
     """
     logger = logging.getLogger(__name__)
     app = None
+    # read-through cache of serialized products keyed by id
+    cache = LRUCache()
+    # in-process search index for databases without full-text search
+    search_index = SearchIndex()
+    # read replicas for the queries of read_query(), none until init_db()
+    replicas = ReplicaSet()
+    SORTABLE_COLUMNS = ('id', 'name', 'category', 'available', 'price')
 
     # Table Schema
+    # Existing tables pick up changes here through app/migrations.py
     id = db.Column(db.Integer, primary_key=True)
-    name = db.Column(db.String(63))
+    name = db.Column(db.String(63), index=True)
     category = db.Column(db.String(63))
     available = db.Column(db.Boolean())
-    price = db.Column(db.Float(precision=2))
+    price = db.Column(Price, index=True)
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    updated_at = db.Column(db.DateTime)
+
+    # category lookups use the leading column of the composite index
+    __table_args__ = (
+        db.Index('ix_products_category_available_price', 'category', 'available', 'price'),
+        # the cheapest products of a category, whatever their availability
+        db.Index('ix_products_category_price', 'category', 'price'),
+    )
+    # every UPDATE is a compare-and-swap on the version that was loaded,
+    # save() sets the new version itself
+    __mapper_args__ = {
+        'version_id_col': version,
+        'version_id_generator': False,
+    }
 
 
     def __repr__(self):
@@ -62,20 +281,184 @@ class Products(db.Model):
         """
         Saves a product to the data store
         """
+        changes = self._stats_changes() if ProductStats.enabled else None
+        self.updated_at = datetime.utcnow()
+        operation = 'updated' if self.id else 'created'
         if not self.id:
+            self.version = 1
             db.session.add(self)
+        else:
+            self.version = (self.version or 0) + 1
+        try:
+            db.session.flush()
+            if changes:
+                ProductStats.apply(*changes)
+            ProductChange.record(operation, self.id)
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            raise VersionConflictError('Product {} was changed by another request'.format(self.id))
+        except IntegrityError:
+            db.session.rollback()
+            if operation == 'created':
+                # the id may be from a block reserved before the tables were recreated
+                db.shards.discard_ids()
+            raise
+        self.invalidate(self.id)
+
+    @classmethod
+    def update_by_id(cls, product_id, values, version=None):
+        """ Updates a product with a single atomic UPDATE statement
+
+        The version is bumped in the same statement, and when a version is
+        given the UPDATE is a compare-and-swap that only matches that version
+
+        Args:
+            product_id (int): the id of the product to update
+            values (dict): the columns to change and their new values
+            version (int): the version the product must still be at
+
+        Returns:
+            the updated product, or None if there is no product with that id
+
+        Raises:
+            VersionConflictError: if the product is no longer at version
+        """
+        cls.logger.info('Processing update for id %s at version %s ...', product_id, version)
+        table = cls.__table__
+        with db.shards.pinned(db.session, db.shards.for_id(product_id)):
+            if ProductStats.enabled:
+                # lock the row so that its old values stay right for the totals
+                old = db.session.query(cls.category, cls.available, cls.price) \
+                                .filter(cls.id == product_id).with_for_update().first()
+            statement = table.update().where(table.c.id == product_id)
+            if version is not None:
+                statement = statement.where(table.c.version == version)
+            statement = statement.values(version=table.c.version + 1,
+                                         updated_at=datetime.utcnow(), **values)
+            result = db.session.execute(statement)
+        if ProductStats.enabled and result.rowcount:
+            new = tuple(values.get(key, value)
+                        for key, value in zip(('category', 'available', 'price'), old))
+            ProductStats.apply([tuple(old)], [new])
+        if result.rowcount:
+            ProductChange.record('updated', product_id)
         db.session.commit()
+        cls.invalidate(product_id)
+        product = cls.find(product_id)
+        if result.rowcount == 0 and product is not None:
+            raise VersionConflictError('Product {} is no longer at version {}'
+                                       .format(product_id, version))
+        return product
+
+    @classmethod
+    def set_availability(cls, changes, versions=None, found=None):
+        """ Sets the availability of many products with one executemany UPDATE per batch
+
+        Every product that changes gets a new version, like update_by_id()
+
+        Args:
+            changes (dict): the new availability of products by id
+            versions (dict): the version each product must still be at, by
+                id, like the version of update_by_id(). Products at another
+                version are left alone
+            found (set): where the ids of each batch are added once it is
+                committed, so that the caller knows what was written when a
+                later batch fails
+
+        Returns:
+            the set of ids that were found and updated
+        """
+        cls.logger.info('Processing availability of %s products ...', len(changes))
+        table = cls.__table__
+        statement = table.update().where(table.c.id == bindparam('_id')) \
+                         .values(version=table.c.version + 1)
+        if versions is not None:
+            statement = statement.where(table.c.version == bindparam('_version'))
+        found = set() if found is None else found
+        for shard, ids in db.shards.group(changes):
+            for start in range(0, len(ids), LOOKUP_BATCH_SIZE):
+                with db.shards.pinned(db.session, shard):
+                    batch = ids[start:start + LOOKUP_BATCH_SIZE]
+                    if versions is not None:
+                        batch = cls._at_versions(batch, versions)
+                    existing = cls._existing(batch)
+                    if not existing:
+                        continue
+                    now = datetime.utcnow()
+                    params = [{"_id": product_id, "available": changes[product_id],
+                               "updated_at": now} for product_id in existing]
+                    if versions is not None:
+                        for row in params:
+                            row['_version'] = versions[row['_id']]
+                    result = db.session.execute(statement, params)
+                    if versions is not None and result.supports_sane_multi_rowcount() and \
+                            result.rowcount != len(existing):
+                        # a row changed after it was read, without row locks
+                        db.session.rollback()
+                        raise VersionConflictError('Products changed while their availability '
+                                                   'was being set')
+                if ProductStats.enabled:
+                    flipped = [product_id for product_id, (_, available, _) in existing.items()
+                               if bool(available) != bool(changes[product_id])]
+                    ProductStats.apply([existing[product_id] for product_id in flipped],
+                                       [(existing[product_id][0], changes[product_id],
+                                         existing[product_id][2]) for product_id in flipped])
+                ProductChange.record('updated', *existing)
+                db.session.commit()
+                cls.invalidate(*existing)
+                found.update(existing)
+        return found
 
     def delete(self):
-        """ Removes a product from the data store """
-        db.session.delete(self)
+        """ Removes a product from the data store
+
+        A product changed since it was loaded is deleted at its current
+        version, and one that is already gone is left alone
+        """
+        product_id = self.id
+        values = (self.category, self.available, self.price)
+        try:
+            db.session.delete(self)
+            db.session.flush()
+        except StaleDataError:
+            db.session.rollback()
+            current = Products.query.get(product_id)
+            if current is not None:
+                current.delete()
+            return
+        if ProductStats.enabled:
+            ProductStats.apply(removed=[values])
+        ProductChange.record('deleted', product_id)
         db.session.commit()
+        self.invalidate(product_id)
 
     ''' DELETE ALL FOR TESTING ONLY '''
     @classmethod
     def delete_all(cls):
-        cls.query.delete()
+        for shard in db.shards.each():
+            with db.shards.pinned(db.session, shard):
+                cls.query.delete()
+        ProductStats.query.delete()
+        # a single change tells the consumers to drop every product
+        ProductChange.record('reset', None)
         db.session.commit()
+        cls.cache.clear()
+        cls.search_index.clear()
+        cls.replicas.wrote()
+        ProductChange.notify()
+
+    @classmethod
+    def invalidate(cls, *ids):
+        """ Drops changed products from the cache and the search index
+
+        Call it after committing, it also wakes the requests waiting for changes
+        and keeps reads off the replicas until they have caught up
+        """
+        cls.cache.invalidate(*[cls.cache_key(product_id) for product_id in ids])
+        cls.search_index.invalidate(*ids)
+        cls.replicas.wrote()
+        ProductChange.notify()
 
     def serialize(self):
         """ Serializes a products into a dictionary """
@@ -97,69 +480,1164 @@ class Products(db.Model):
             self.name = data['name']
             self.category = data['category']
             self.available = data['available']
-            self.price = float(data['price'])
+            self.price = to_price(data['price'])
         except KeyError as error:
             raise DataValidationError('Invalid product: missing ' + error.args[0])
         except TypeError as error:
             raise DataValidationError('Invalid product: body of request contained' \
                                       'bad or no data')
+        except ValueError as error:
+            raise DataValidationError('Invalid product: ' + str(error))
         return self
 
+    def to_mapping(self):
+        """ Returns the column values of a product for the bulk operations """
+        return {"name": self.name,
+                "category": self.category,
+                "available": self.available,
+                "price": self.price,
+                "updated_at": datetime.utcnow()}
+
+    def validators(self):
+        """ Returns the version and the last modified time in seconds of a product """
+        return {"version": self.version, "updated": to_timestamp(self.updated_at)}
+
+    def _stats_changes(self):
+        """ Returns the (removed, added) values that saving changes in the totals
+
+        The values are (category, available, price) tuples, None is returned
+        when an existing product keeps all three
+        """
+        new = (self.category, self.available, self.price)
+        if not self.id:
+            return [], [new]
+        state = inspect(self)
+        old = []
+        for key, value in zip(('category', 'available', 'price'), new):
+            history = state.attrs[key].history
+            old.append(history.deleted[0] if history.deleted else value)
+        if tuple(old) == new:
+            return None
+        return [tuple(old)], [new]
+
     @classmethod
     def init_db(cls, app):
         """ Initializes the database session """
         cls.logger.info('Initializing database')
         cls.app = app
+        cls.cache.close()
+        cls.cache = make_cache(app.config.get('CACHE_BACKEND', 'local'),
+                               app.config.get('CACHE_URL'),
+                               app.config.get('CACHE_SIZE', 1024),
+                               app.config.get('CACHE_TTL', 60))
+        cls.search_index = SearchIndex(app.config.get('SEARCH_INDEX_TTL', 300))
+        ProductStats.enabled = app.config.get('STATS_SUMMARY', False)
         # This is where we initialize SQLAlchemy from the Flask app
         db.init_app(app)
+        cls.replicas.dispose()
+        cls.replicas = ReplicaSet([db.create_engine_for(app, uri)
+                                   for uri in app.config.get('REPLICA_URIS') or []],
+                                  app.config.get('REPLICA_RETRY_SECONDS', 30),
+                                  app.config.get('REPLICA_STICKY_SECONDS', 5),
+                                  app.config.get('REPLICA_MAX_LAG_SECONDS', 0),
+                                  ProductChange.position)
+        db.shards.dispose()
+        db.shards = cls.connect_shards(app)
+        if db.shards and ProductStats.enabled:
+            # the totals are updated with subqueries on the products table
+            cls.logger.warning('STATS_SUMMARY is not kept for sharded products')
+            ProductStats.enabled = False
         app.app_context().push()
-        db.create_all()  # make our sqlalchemy tables
+
+    @classmethod
+    def connect_shards(cls, app):
+        """ Returns the shards of the products in SHARD_URIS, an empty ShardSet if there are none """
+        return ShardSet([db.create_engine_for(app, uri) for uri in app.config.get('SHARD_URIS') or []],
+                        cls.__table__, app.config.get('SHARD_KEY', 'id'), ProductIds.allocate,
+                        app.config.get('SHARD_ID_BLOCK', 100))
+
+    @classmethod
+    def read_query(cls):
+        """ Returns a query for products that a read replica may answer
+
+        It is only sent to a replica in a session that the replicas allow,
+        see app/replicas.py, so read the products that are about to be
+        changed with cls.query instead
+        """
+        return cls.query.replica()
 
     @classmethod
     def all(cls):
         """ Returns all of the products in the database """
         cls.logger.info('Processing all products')
-        return cls.query.all()
+        return cls.read_query().all()
 
     @classmethod
     def find(cls, product_id):
         """ Finds a product by it's ID """
         cls.logger.info('Processing lookup for id %s ...', product_id)
-        return cls.query.get(product_id)
+        return cls.read_query().get(product_id)
+
+    @classmethod
+    def find_version(cls, product_id):
+        """ Returns the version of a product by it's ID, None if there is no such product """
+        return db.session.query(cls.version).filter(cls.id == product_id).scalar()
+
+    @staticmethod
+    def cache_key(product_id):
+        """ Returns the cache key of a serialized product """
+        return 'product:{}'.format(product_id)
+
+    @classmethod
+    def find_cached(cls, product_id):
+        """ Returns a serialized product by it's ID, reading through the cache
+
+        The serialized product is returned under "product" along with its
+        "version" and "updated" time so that conditional requests can be
+        answered from the cache. Returns None if there is no product with that id
+        """
+        key = cls.cache_key(product_id)
+        entry = cls.cache.get(key)
+        if entry is None:
+            # taken before the read, so that set() drops what a write invalidates meanwhile
+            generation = cls.cache.generation()
+            product = cls.find(product_id)
+            if not product:
+                return None
+            entry = dict(product.validators(), product=product.serialize())
+            if generation is not None:
+                cls.cache.set(key, entry, generation)
+        return dict(entry)
+
+    @classmethod
+    def find_many_cached(cls, ids):
+        """ Returns serialized products by their IDs, reading through the cache
+
+        The ids that are not cached are read with IN queries of up to
+        LOOKUP_BATCH_SIZE ids, so any number of products takes a single
+        round trip to the cache and one to the database per batch
+
+        Returns:
+            the serialized products in the order of the ids, each once,
+            and the ids for which there is no product
+        """
+        cls.logger.info('Processing lookup for %s ids ...', len(ids))
+        ids = list(OrderedDict.fromkeys(ids))
+        keys = dict((product_id, cls.cache_key(product_id)) for product_id in ids)
+        cached = cls.cache.get_many(list(keys.values()))
+        products = dict((product_id, cached[key]['product'])
+                        for product_id, key in keys.items() if key in cached)
+        missing = [product_id for product_id in ids if product_id not in products]
+        generation = cls.cache.generation() if missing else None
+        entries = {}
+        for start in range(0, len(missing), LOOKUP_BATCH_SIZE):
+            batch = missing[start:start + LOOKUP_BATCH_SIZE]
+            for product in cls.read_query().filter(cls.id.in_(batch)):
+                products[product.id] = product.serialize()
+                entries[keys[product.id]] = dict(product.validators(),
+                                                 product=products[product.id])
+        if generation is not None:
+            cls.cache.set_many(entries, generation)
+        return ([products[product_id] for product_id in ids if product_id in products],
+                [product_id for product_id in ids if product_id not in products])
+
+    @classmethod
+    def list_generation(cls):
+        """ Returns the cache generation that list keys include, None if lists are not cached
+
+        Lists are only cached in a shared cache. A local one would only be
+        retired by the writes of its own worker, and serve stale lists for
+        the writes of the others until they expire
+        """
+        return cls.cache.generation() if cls.cache.shared else None
+
+    @classmethod
+    def list_validators(cls, **filters):
+        """ Returns an ETag and the last modified time of the products matching find_by_filters
+
+        Both are computed with a single aggregate query, without loading
+        any rows, and cached like list_json(). The ETag changes whenever a
+        matching product is created, deleted or saved
+
+        Args:
+            filters: the keyword arguments to pass to find_by_filters
+        """
+        generation = cls.list_generation()
+        criteria = json.dumps(filters, sort_keys=True)
+        key = 'validators:{}:{}'.format(generation, criteria)
+        entry = cls.cache.get(key) if generation is not None else None
+        if entry is None:
+            query = cls.find_by_filters(**filters).order_by(None)
+            # one row per shard when the products are sharded
+            rows = query.with_entities(func.count(cls.id), func.sum(cls.id),
+                                       func.sum(cls.version), func.max(cls.updated_at)).all()
+            aggregates = [add_up(row[index] for row in rows) for index in range(3)]
+            aggregates.append(max([row[3] for row in rows if row[3] is not None] or [None]))
+            fingerprint = '{}:{}:{}:{}'.format(criteria, *aggregates)
+            entry = {"etag": hashlib.md5(fingerprint.encode('utf-8')).hexdigest(),
+                     "updated": to_timestamp(aggregates[3])}
+            if generation is not None:
+                cls.cache.set(key, entry)
+        return entry
+
+    @classmethod
+    def list_json(cls, **filters):
+        """ Returns the products matching find_by_filters as a JSON array, reading through the cache
+
+        Lists longer than CACHE_LIST_MAX are not cached. The key includes the
+        cache generation so that any write retires every cached list
+
+        Args:
+            filters: the keyword arguments to pass to find_by_filters
+        """
+        generation = cls.list_generation()
+        key = 'list:{}:{}'.format(generation, json.dumps(filters, sort_keys=True))
+        data = cls.cache.get(key) if generation is not None else None
+        if data is None:
+            rows = [cls.encode_row(row) for row in cls.rows(cls.find_by_filters(**filters))]
+            data = '[' + ','.join(rows) + ']'
+            if generation is not None and len(rows) <= cls.app.config.get('CACHE_LIST_MAX', 1000):
+                cls.cache.set(key, data)
+        return data
+
+    ######################################################################
+    #  F A S T   S E R I A L I Z A T I O N
+    ######################################################################
+
+    @classmethod
+    def rows(cls, query, columns=JSON_COLUMNS):
+        """ Returns a query for plain tuples of the JSON_COLUMNS, or of other columns
+
+        The tuples skip building ORM instances and the identity map, which
+        dominates the cost of serializing large lists
+
+        Args:
+            query (Query): the products query, e.g. from find_by_filters
+            columns (tuple): the names of the columns, in order
+        """
+        return query.with_entities(*[getattr(cls, column) for column in columns])
+
+    @staticmethod
+    def encode_row(row):
+        """ Encodes a tuple from rows() to the same JSON as jsonify(serialize()) """
+        available, category, product_id, name, price = row
+        return JSON_ROW % (JSON_BOOLEANS[available],
+                           'null' if category is None else encode_string(category),
+                           'null' if product_id is None else product_id,
+                           'null' if name is None else encode_string(name),
+                           encode_string(str(price)))
 
     @classmethod
     def find_or_404(cls, product_id):
         """ Find a product by it's id """
         cls.logger.info('Processing lookup or 404 for id %s ...', product_id)
-        return cls.query.get_or_404(product_id)
+        return cls.read_query().get_or_404(product_id)
 
     @classmethod
-    def find_by_name(cls, name):
+    def find_by_name(cls, name, query=None):
         """ Returns all products with the given name
 
         Args:
-            name (string): the name of the products you want to match
+            name (string or list): the name of the products you want to match
+            query (Query): an optional query to narrow down
         """
         cls.logger.info('Processing name query for %s ...', name)
-        return cls.query.filter(cls.name == name)
+        return cls._match(cls.name, name, query)
 
     @classmethod
-    def find_by_category(cls, category):
+    def find_by_category(cls, category, query=None):
         """ Returns all of the products in a category
 
         Args:
-            category (string): the category of the products you want to match
+            category (string or list): the category of the products you want to match
+            query (Query): an optional query to narrow down
         """
         cls.logger.info('Processing category query for %s ...', category)
-        return cls.query.filter(cls.category == category)
+        return cls._match(cls.category, category, query)
 
     @classmethod
-    def find_by_availability(cls, available=True):
-        """ Query that finds products by their availability """
+    def find_by_availability(cls, available=True, query=None):
         """ Returns all products by their availability
 
         Args:
             available (boolean): True for products that are available
+            query (Query): an optional query to narrow down
         """
         cls.logger.info('Processing available query for %s ...', available)
-        return cls.query.filter(cls.available == available)
+        return cls._match(cls.available, available, query)
+
+    @classmethod
+    def find_by_price(cls, price, query=None):
+        """ Returns all products with the given price
+
+        Prices are compared as decimals, so that the price index is used
+        and 0.1 matches a price of 0.10
+
+        Args:
+            price (number or list): the price of the products you want to match
+            query (Query): an optional query to narrow down
+        """
+        cls.logger.info('Processing price query for %s ...', price)
+        if isinstance(price, (list, tuple)):
+            return cls._match(cls.price, [cls._price_arg(value) for value in price], query)
+        return cls._match(cls.price, cls._price_arg(price), query)
+
+    @classmethod
+    def find_by_price_range(cls, price_min=None, price_max=None, query=None):
+        """ Returns all products priced between price_min and price_max inclusive
+
+        The range is a scan of the price index, or of the category and
+        price index when the query is narrowed to a category
+
+        Args:
+            price_min (number): the lowest price to match, or None for no lower bound
+            price_max (number): the highest price to match, or None for no upper bound
+            query (Query): an optional query to narrow down
+        """
+        cls.logger.info('Processing price range query for %s - %s ...', price_min, price_max)
+        if query is None:
+            query = cls.read_query()
+        if price_min is not None:
+            query = query.filter(cls.price >= cls._price_arg(price_min))
+        if price_max is not None:
+            query = query.filter(cls.price <= cls._price_arg(price_max))
+        return query
+
+    @classmethod
+    def cheapest(cls, limit, category=None, available=None, price_max=None):
+        """ Returns the limit cheapest products, cheapest first and then by id
+
+        The products are read in order from the price index, or from the
+        category and price index for a category, so only limit rows are
+        read whatever the size of the catalog. Products without a price are
+        left out.
+
+        Args:
+            limit (int): the number of products to return
+            category (string): the category of the products, or None for all
+            available (boolean): True or False to match their availability
+            price_max (number): the highest price to match
+        """
+        cls.logger.info('Processing cheapest %s query in %s ...', limit, category)
+        query = cls.read_query().filter(cls.price.isnot(None))
+        if category is not None:
+            query = query.filter(cls.category == category)
+        if available is not None:
+            query = query.filter(cls.available == available)
+        if price_max is not None:
+            query = query.filter(cls.price <= cls._price_arg(price_max))
+        return query.order_by(cls.price, cls.id).limit(limit).all()
+
+    @staticmethod
+    def _price_arg(value):
+        """ Returns a price to filter on as a Decimal, raising a DataValidationError if it is not one """
+        try:
+            return to_price(value)
+        except (TypeError, ValueError) as error:
+            raise DataValidationError(str(error))
+
+    @classmethod
+    def find_by_filters(cls, name=None, category=None, available=None, price=None,
+                        price_min=None, price_max=None, sort=None):
+        """ Returns a single query that combines any mix of filters
+
+        Each filter that is not None narrows the query further, and filters
+        given as a list match any of their values (SQL IN)
+
+        Args:
+            name (string or list): the names of the products you want to match
+            category (string or list): the categories of the products you want to match
+            available (boolean): True for products that are available
+            price (number or list): the prices of the products you want to match
+            price_min (number): the lowest price to match
+            price_max (number): the highest price to match
+            sort (list): column names to order by, prefixed with '-' for descending
+        """
+        query = cls.read_query()
+        if name is not None:
+            query = cls.find_by_name(name, query)
+        if category is not None:
+            query = cls.find_by_category(category, query)
+        if available is not None:
+            query = cls.find_by_availability(available, query)
+        if price is not None:
+            query = cls.find_by_price(price, query)
+        if price_min is not None or price_max is not None:
+            query = cls.find_by_price_range(price_min, price_max, query)
+        for key in sort or []:
+            column = key.lstrip('-')
+            if column not in cls.SORTABLE_COLUMNS:
+                raise DataValidationError('Invalid sort: cannot sort by ' + column)
+            column = getattr(cls, column)
+            query = query.order_by(column.desc() if key.startswith('-') else column)
+        return query
+
+    @classmethod
+    def _match(cls, column, value, query=None):
+        """ Filters a query on a column equal to a value or in a list of values """
+        if query is None:
+            query = cls.read_query()
+        if isinstance(value, (list, tuple)):
+            return query.filter(column.in_(value))
+        return query.filter(column == value)
+
+    @classmethod
+    def stats(cls, group_by=('category',)):
+        """ Returns the number of products and their prices in each group
+
+        The totals are read from the product_stats summary when
+        STATS_SUMMARY is on, and computed from the products otherwise
+
+        Args:
+            group_by (list): the columns to group by, category and/or available
+
+        Returns:
+            a dictionary for each group, in order, with the group columns,
+            count, available_count, avg_price, min_price and max_price
+        """
+        cls.logger.info('Processing stats by %s ...', ', '.join(group_by))
+        if ProductStats.enabled:
+            return ProductStats.totals(group_by)
+        keys = stats_keys(cls, group_by)
+        rows = db.session.query(*(keys + [
+            func.count(cls.id),
+            func.sum(case([(cls.available == True, 1)], else_=0)),
+            func.sum(cls.price),
+            func.count(cls.price),
+            func.min(cls.price),
+            func.max(cls.price)])).replica().group_by(*keys)
+        if db.shards:
+            rows = merge_stats(sum(db.shards.map(lambda session: rows.with_session(session).all()), []),
+                               len(keys))
+        else:
+            rows = rows.order_by(*keys)
+        return [stats_result(group_by, row) for row in rows]
+
+    @classmethod
+    def search(cls, text, limit=20, offset=0):
+        """ Searches product names and categories for every word of a text
+
+        Postgres uses the full-text and trigram indexes of migration 3,
+        other databases the in-process SearchIndex
+
+        Args:
+            text (string): the words to search for, the last may be a prefix
+            limit (int): the maximum number of products to return
+            offset (int): the number of best matches to skip
+
+        Returns:
+            the number of matching products and a page of (product, score)
+            pairs with the best match first
+        """
+        cls.logger.info('Processing search for %r ...', text)
+        if db.engine.dialect.name == 'postgresql':
+            return cls._search_postgres(text, limit, offset)
+        cls.refresh_search_index()
+        total, hits = cls.search_index.search(text, limit, offset)
+        products = dict((product.id, product) for product in
+                        cls.read_query().filter(cls.id.in_([product_id for product_id, _ in hits]))) \
+                   if hits else {}
+        return total, [(products[product_id], score) for product_id, score in hits
+                       if product_id in products]
+
+    @classmethod
+    def _search_postgres(cls, text, limit, offset):
+        """ Searches with to_tsquery prefixes, or name trigrams for misspellings """
+        terms = tokenize(text)
+        if not terms:
+            return 0, []
+        # must match the expression of ix_products_search
+        document = func.to_tsvector('simple', func.coalesce(cls.name, '').op('||')(' ')
+                                    .op('||')(func.coalesce(cls.category, '')))
+        words = func.to_tsquery('simple', ' & '.join(term + ':*' for term in terms))
+        phrase = ' '.join(terms)
+        query = cls.read_query().filter(document.op('@@')(words) | cls.name.op('%')(phrase))
+        # ordered by the label so that the shards can be merged by score
+        score = (func.ts_rank(document, words) + func.similarity(cls.name, phrase)).label('score')
+        total = query.count()
+        hits = query.add_columns(score) \
+                    .order_by(score.desc(), cls.id).offset(offset).limit(limit).all()
+        return total, [(product, round(score, 3)) for product, score in hits]
+
+    @classmethod
+    def refresh_search_index(cls):
+        """ Brings the in-process search index up to date
+
+        The index is built on the first search and rebuilt in the
+        background once it is older than SEARCH_INDEX_TTL, which picks up
+        writes made by other workers. Writes made by this worker are
+        applied to the index before the next search.
+        """
+        index = cls.search_index
+        if index.built_at is None:
+            index.pop_stale()
+            index.build(cls._search_rows(cls.query))
+            return
+        if index.expired() and not index.rebuilding:
+            index.rebuilding = True
+            thread = threading.Thread(target=cls._rebuild_search_index, args=(index,))
+            thread.daemon = True
+            thread.start()
+        stale = index.pop_stale()
+        if stale:
+            found = set()
+            for product_id, name, category in \
+                    cls._search_rows(cls.query.filter(cls.id.in_(stale))):
+                index.add(product_id, name, category)
+                found.add(product_id)
+            for product_id in stale - found:
+                index.remove(product_id)
+
+    @classmethod
+    def _rebuild_search_index(cls, index):
+        """ Rebuilds the search index from a background thread """
+        try:
+            with cls.app.app_context():
+                index.build(cls._search_rows(cls.query))
+                db.session.remove()
+        except SQLAlchemyError as error:
+            cls.logger.warning('Search index rebuild failed: %s', error)
+        finally:
+            index.rebuilding = False
+
+    @classmethod
+    def _search_rows(cls, query):
+        """ Returns the (id, name, category) rows that the search index holds """
+        return query.with_entities(cls.id, cls.name, cls.category).yield_per(STREAM_BATCH_SIZE)
+
+    @classmethod
+    def page(cls, after=None, limit=100, query=None):
+        """ Returns a page of products using keyset pagination on id
+
+        Args:
+            after (int): only products with an id greater than this are returned
+            limit (int): the maximum number of products to return
+            query (Query): an optional query to paginate (defaults to all products)
+
+        Returns:
+            a tuple of the products on the page and the id to continue
+            after, or None when this is the last page
+        """
+        cls.logger.info('Processing page query after %s limit %s ...', after, limit)
+        if query is None:
+            query = cls.read_query()
+        if after is not None:
+            query = query.filter(cls.id > after)
+        # fetch one extra row so we know if there is another page
+        products = query.order_by(cls.id).limit(limit + 1).all()
+        if len(products) > limit:
+            products = products[:limit]
+            return products, products[-1].id
+        return products, None
+
+    @classmethod
+    def stream(cls, query=None, batch_size=STREAM_BATCH_SIZE):
+        """ Returns an iterator over products backed by a server-side cursor
+
+        Rows are fetched in batches of batch_size so memory stays flat
+        no matter how many products the query matches
+
+        Args:
+            query (Query): an optional query to stream (defaults to all products)
+            batch_size (int): the number of rows to fetch per round trip
+        """
+        cls.logger.info('Processing streamed query ...')
+        if query is None:
+            query = cls.read_query()
+        return query.order_by(cls.id).yield_per(batch_size)
+
+    ######################################################################
+    #  B U L K   O P E R A T I O N S
+    ######################################################################
+
+    @classmethod
+    def bulk_create(cls, items, batch_size=BULK_BATCH_SIZE):
+        """ Creates products from a list of dictionaries with batched INSERTs
+
+        Args:
+            items (list): the product dictionaries to create
+            batch_size (int): the number of rows written per statement
+
+        Returns:
+            a result for each item, in order, with its index, status
+            (created, invalid or failed) and either the new id or an error
+        """
+        cls.logger.info('Processing bulk create of %s products ...', len(items))
+        results, pending = [], []
+        for index, item in enumerate(items):
+            result = {"index": index}
+            results.append(result)
+            try:
+                pending.append((result, cls().deserialize(item).to_mapping()))
+            except DataValidationError as error:
+                result.update(status='invalid', error=str(error))
+
+        def write(batch):
+            """ Inserts a batch and records the new ids """
+            ids = cls._insert([dict(mapping) for _, mapping in batch])
+            for (result, _), product_id in zip(batch, ids):
+                result.update(status='created', id=product_id)
+            ProductChange.record('created', *ids)
+            if ProductStats.enabled:
+                ProductStats.apply(added=[cls._stats_values(mapping) for _, mapping in batch])
+
+        cls._write_batches(pending, batch_size, write)
+        return results
+
+    @classmethod
+    def bulk_update(cls, items, batch_size=BULK_BATCH_SIZE):
+        """ Updates products from a list of dictionaries with batched UPDATEs
+
+        Every dictionary must have the id of the product to update
+
+        Returns:
+            a result for each item, in order, with its index, id and status
+            (updated, not found, invalid or failed)
+        """
+        cls.logger.info('Processing bulk update of %s products ...', len(items))
+        results, pending = [], []
+        for index, item in enumerate(items):
+            result = {"index": index}
+            results.append(result)
+            try:
+                product_id = cls._item_id(item)
+                result['id'] = product_id
+                mapping = cls().deserialize(item).to_mapping()
+                mapping['id'] = product_id
+                pending.append((result, mapping))
+            except DataValidationError as error:
+                result.update(status='invalid', error=str(error))
+
+        def write(batch):
+            """ Updates the rows of a batch that exist """
+            existing = cls._existing([mapping['id'] for _, mapping in batch])
+            found = []
+            for result, mapping in batch:
+                result['status'] = 'updated' if mapping['id'] in existing else 'not found'
+                if mapping['id'] in existing:
+                    found.append(mapping)
+            if found:
+                # executemany UPDATE that also bumps each version
+                table = cls.__table__
+                statement = table.update().where(table.c.id == bindparam('_id')) \
+                                 .values(version=table.c.version + 1)
+                params = []
+                for mapping in found:
+                    mapping = dict(mapping, _id=mapping['id'])
+                    del mapping['id']
+                    params.append(mapping)
+                db.session.execute(statement, params)
+                if ProductStats.enabled:
+                    ProductStats.apply([existing[mapping['id']] for mapping in found],
+                                       [cls._stats_values(mapping) for mapping in found])
+                ProductChange.record('updated', *[mapping['id'] for mapping in found])
+
+        cls._write_batches(pending, batch_size, cls._by_shard(write))
+        return results
+
+    @classmethod
+    def bulk_delete(cls, items, batch_size=BULK_BATCH_SIZE):
+        """ Deletes products by id with batched DELETEs
+
+        Args:
+            items (list): product ids, or dictionaries with an id
+
+        Returns:
+            a result for each item, in order, with its index, id and status
+            (deleted, not found, invalid or failed)
+        """
+        cls.logger.info('Processing bulk delete of %s products ...', len(items))
+        results, pending = [], []
+        for index, item in enumerate(items):
+            result = {"index": index}
+            results.append(result)
+            try:
+                product_id = cls._item_id(item)
+                result['id'] = product_id
+                pending.append((result, {"id": product_id}))
+            except DataValidationError as error:
+                result.update(status='invalid', error=str(error))
+
+        def write(batch):
+            """ Deletes the rows of a batch that exist """
+            existing = cls._existing([mapping['id'] for _, mapping in batch])
+            for result, mapping in batch:
+                result['status'] = 'deleted' if mapping['id'] in existing else 'not found'
+            if existing:
+                cls.query.filter(cls.id.in_(list(existing))).delete(synchronize_session=False)
+                if ProductStats.enabled:
+                    ProductStats.apply(removed=list(existing.values()))
+                ProductChange.record('deleted', *existing)
+
+        cls._write_batches(pending, batch_size, cls._by_shard(write))
+        return results
+
+    ######################################################################
+    #  E X P O R T   A N D   I M P O R T
+    ######################################################################
+
+    @classmethod
+    def import_products(cls, items, batch_size=BULK_BATCH_SIZE):
+        """ Creates products from an iterable of dictionaries, one batch in memory at a time
+
+        Each batch is written with a single COPY on Postgres and a single
+        executemany INSERT elsewhere, or one per shard, then committed. The new products get
+        new ids. A batch that fails is retried one product at a time.
+
+        Args:
+            items (iterable): the product dictionaries, None for an unreadable line
+            batch_size (int): the number of products written per statement
+
+        Returns:
+            the number of imported, invalid and failed products, the errors
+            of the first IMPORT_MAX_ERRORS of them by line and the rows
+            imported per second
+        """
+        cls.logger.info('Processing import of products ...')
+        started = time.time()
+        report = {"imported": 0, "invalid": 0, "failed": 0, "errors": []}
+
+        def error(line, kind, message):
+            """ Counts a product that was not imported and keeps its first errors """
+            report[kind] += 1
+            if len(report['errors']) < IMPORT_MAX_ERRORS:
+                report['errors'].append({"line": line, "status": kind, "error": message})
+
+        def write(batch):
+            """ Writes and commits a batch of (line, mapping) pairs """
+            mappings = [mapping for _, mapping in batch]
+            try:
+                if db.shards:
+                    # the ids are allocated here, COPY cannot tell which rows belong where
+                    ProductChange.record('created', *cls._insert(mappings))
+                else:
+                    last_id = db.session.query(func.max(cls.id)).scalar() or 0
+                    if db.engine.dialect.name == 'postgresql':
+                        cls._copy(mappings)
+                    else:
+                        db.session.execute(cls.__table__.insert(), mappings)
+                    ProductChange.record_created_after(last_id)
+                if ProductStats.enabled:
+                    ProductStats.apply(added=[cls._stats_values(mapping) for mapping in mappings])
+                db.session.commit()
+                report['imported'] += len(batch)
+            except SQLAlchemyError as failure:
+                db.session.rollback()
+                if len(batch) == 1:
+                    error(batch[0][0], 'failed', str(getattr(failure, 'orig', failure)))
+                    return
+                cls.logger.warning('Import batch failed, retrying one at a time: %s', failure)
+                for item in batch:
+                    write([item])
+
+        batch = []
+        for line, item in enumerate(items, 1):
+            try:
+                batch.append((line, cls().deserialize(item).to_mapping()))
+            except DataValidationError as invalid:
+                error(line, 'invalid', str(invalid))
+            if len(batch) >= batch_size:
+                write(batch)
+                batch = []
+        if batch:
+            write(batch)
+        if report['imported']:
+            # the new ids were never read, so only the lists and the index are stale
+            cls.cache.invalidate()
+            cls.search_index.clear()
+            ProductChange.notify()
+        seconds = time.time() - started
+        report.update(seconds=round(seconds, 3),
+                      rows_per_second=int(report['imported'] / seconds) if seconds else None)
+        cls.logger.info('Imported %s products in %.3f seconds', report['imported'], seconds)
+        return report
+
+    @classmethod
+    def _copy(cls, mappings):
+        """ Writes product mappings with a single Postgres COPY FROM STDIN """
+        price = Price()
+        data = u''.join(copy_line((mapping['name'], mapping['category'], mapping['available'],
+                                   price.process_bind_param(mapping['price'], None),
+                                   mapping['updated_at'], 1))
+                        for mapping in mappings)
+        statement = 'COPY {} (name, category, available, price, updated_at, version) ' \
+                    'FROM STDIN WITH (FORMAT csv)'.format(cls.__tablename__)
+        cursor = db.session.connection().connection.cursor()
+        try:
+            cursor.copy_expert(statement, io.BytesIO(data.encode('utf-8')))
+        except db.engine.dialect.dbapi.Error as error:
+            # surface it like the errors of the other write paths
+            raise DBAPIError(statement, None, error)
+        finally:
+            cursor.close()
+
+    @classmethod
+    def _write_batches(cls, pending, batch_size, write):
+        """ Calls write with batches of (result, mapping) pairs and commits each one
+
+        A batch that fails is rolled back and retried one item at a time
+        so that only the items that cannot be written are marked as failed
+        """
+        for start in range(0, len(pending), batch_size):
+            batch = pending[start:start + batch_size]
+            try:
+                write(batch)
+                db.session.commit()
+            except SQLAlchemyError as error:
+                db.session.rollback()
+                cls.logger.warning('Bulk batch failed, retrying one at a time: %s', error)
+                for item in batch:
+                    try:
+                        write([item])
+                        db.session.commit()
+                    except SQLAlchemyError as error:
+                        db.session.rollback()
+                        item[0].update(status='failed', error=str(getattr(error, 'orig', error)))
+            cls.invalidate(*[result['id'] for result, _ in batch if 'id' in result])
+
+    @staticmethod
+    def _by_shard(write):
+        """ Wraps the write of a batch of (result, mapping) pairs to run once per shard
+
+        Each call gets the pairs whose mapping id is on one shard, with
+        the session pinned to it. Without shards it is write itself
+        """
+        def write_shards(batch):
+            """ Writes the pairs of each shard """
+            for shard, pairs in db.shards.group(batch, lambda pair: pair[1]['id']):
+                with db.shards.pinned(db.session, shard):
+                    write(pairs)
+        return write_shards if db.shards else write
+
+    @classmethod
+    def _insert(cls, mappings):
+        """ Inserts rows in as few statements as possible and returns their ids """
+        if db.shards:
+            # new ids first, so that each row knows its shard
+            for mapping in mappings:
+                mapping['id'] = db.shards.new_id(mapping['category'])
+            try:
+                for shard, rows in db.shards.group(mappings, lambda mapping: mapping['id']):
+                    with db.shards.pinned(db.session, shard):
+                        db.session.execute(cls.__table__.insert(), rows)
+            except IntegrityError:
+                # the ids may be from a block reserved before the tables were recreated
+                db.shards.discard_ids()
+                raise
+            return [mapping['id'] for mapping in mappings]
+        table = cls.__table__
+        if db.engine.dialect.name == 'postgresql':
+            # a single multi-row INSERT ... RETURNING id
+            statement = table.insert().values(mappings).returning(cls.id)
+            return [row[0] for row in db.session.execute(statement)]
+        # a single executemany INSERT of rows marked with a negative version
+        # that only this batch uses, then the ids are read back by the mark
+        last_id = db.session.query(func.max(cls.id)).scalar() or 0
+        mark = -random.randint(1, 2 ** 31 - 1)
+        db.session.execute(table.insert(), [dict(mapping, version=mark) for mapping in mappings])
+        marked = (table.c.id > last_id) & (table.c.version == mark)
+        ids = [row[0] for row in db.session.execute(
+            select([table.c.id]).where(marked).order_by(table.c.id))]
+        db.session.execute(table.update().where(marked).values(version=1))
+        return ids
+
+    @classmethod
+    def _at_versions(cls, ids, versions):
+        """ Returns the ids that are still at their version, locking their rows """
+        query = db.session.query(cls.id, cls.version).filter(cls.id.in_(ids)).with_for_update()
+        current = dict((product_id, version) for product_id, version in query)
+        return [product_id for product_id in ids
+                if product_id in current and current[product_id] == versions.get(product_id)]
+
+    @classmethod
+    def _existing(cls, ids):
+        """ Returns the (category, available, price) of the ids that exist in a single IN query
+
+        The rows are locked while the totals are kept so that their old
+        values stay right until the batch is committed
+        """
+        query = db.session.query(cls.id, cls.category, cls.available, cls.price) \
+                          .filter(cls.id.in_(ids))
+        if ProductStats.enabled:
+            query = query.with_for_update()
+        return dict((row[0], tuple(row[1:])) for row in query)
+
+    @staticmethod
+    def _stats_values(mapping):
+        """ Returns the (category, available, price) of a bulk mapping """
+        return (mapping['category'], mapping['available'], mapping['price'])
+
+    @staticmethod
+    def _item_id(item):
+        """ Returns the id of a bulk item given as an id or a dictionary with an id """
+        product_id = item.get('id') if isinstance(item, dict) else item
+        if isinstance(product_id, bool) or not isinstance(product_id, numbers.Integral):
+            raise DataValidationError('Invalid product: id must be an integer')
+        return product_id
+
+
+class ProductStats(db.Model):
+    """
+    Running totals of the products in each category and availability
+
+    When STATS_SUMMARY is on every write to the products also updates the
+    totals of the groups it touches, in the same transaction, so that
+    Products.stats() reads one row per group instead of every product.
+    Concurrent bulk writes to the same products can skew the totals, which
+    rebuild() recomputes from scratch.
+    """
+    enabled = False
+
+    __tablename__ = 'product_stats'
+    category = db.Column(db.String(63), primary_key=True)    # '' for no category
+    available = db.Column(db.Boolean(), primary_key=True, autoincrement=False)
+    count = db.Column(db.Integer, nullable=False, default=0)
+    priced = db.Column(db.Integer, nullable=False, default=0)  # products with a price
+    price_sum = db.Column(Price, nullable=False, default=0)
+    price_min = db.Column(Price)
+    price_max = db.Column(Price)
+
+    @classmethod
+    def apply(cls, removed=(), added=()):
+        """ Updates the totals of the products that left and joined their groups
+
+        Call it after writing the products and before committing them
+
+        Args:
+            removed (list): the old (category, available, price) of products
+            added (list): the new (category, available, price) of products
+        """
+        deltas = {}
+        for values, sign in [(values, -1) for values in removed] + \
+                            [(values, 1) for values in added]:
+            category, available, price = values
+            delta = deltas.setdefault((category or '', bool(available)),
+                                      dict(count=0, priced=0, price_sum=Decimal(0),
+                                           price_min=None, price_max=None, shrunk=False))
+            delta['count'] += sign
+            if price is None:
+                continue
+            price = to_price(price)
+            delta['priced'] += sign
+            delta['price_sum'] += sign * price
+            if sign < 0:
+                delta['shrunk'] = True
+            else:
+                if delta['price_min'] is None or price < delta['price_min']:
+                    delta['price_min'] = price
+                if delta['price_max'] is None or price > delta['price_max']:
+                    delta['price_max'] = price
+        table = cls.__table__
+        for (category, available), delta in deltas.items():
+            group = (table.c.category == category) & (table.c.available == available)
+            values = dict(count=table.c.count + delta['count'],
+                          priced=table.c.priced + delta['priced'],
+                          price_sum=table.c.price_sum + delta['price_sum'])
+            if delta['price_min'] is not None:
+                # typed so that the prices are bound in cents like the columns
+                price_min = literal(delta['price_min'], Price)
+                price_max = literal(delta['price_max'], Price)
+                values['price_min'] = case([(or_(table.c.price_min.is_(None),
+                                                 table.c.price_min > price_min),
+                                             price_min)], else_=table.c.price_min)
+                values['price_max'] = case([(or_(table.c.price_max.is_(None),
+                                                 table.c.price_max < price_max),
+                                             price_max)], else_=table.c.price_max)
+            result = db.session.execute(table.update().where(group).values(**values))
+            if result.rowcount == 0:
+                db.session.execute(table.insert().values(
+                    category=category, available=available, count=delta['count'],
+                    priced=delta['priced'], price_sum=delta['price_sum'],
+                    price_min=delta['price_min'], price_max=delta['price_max']))
+            if delta['shrunk']:
+                # a removed price may have been the lowest or highest, both
+                # are single lookups on ix_products_category_available_price
+                products = Products.__table__
+                match = cls._products_in(products, category, available)
+                db.session.execute(table.update().where(group).values(
+                    price_min=select([func.min(products.c.price)]).where(match).as_scalar(),
+                    price_max=select([func.max(products.c.price)]).where(match).as_scalar()))
+        db.session.execute(table.delete().where(table.c.count <= 0))
+
+    @staticmethod
+    def _products_in(products, category, available):
+        """ Returns the condition for the products of a group """
+        if category:
+            match = products.c.category == category
+        else:
+            match = or_(products.c.category.is_(None), products.c.category == '')
+        if available:
+            return match & (products.c.available == True)
+        return match & or_(products.c.available == False, products.c.available.is_(None))
+
+    @classmethod
+    def totals(cls, group_by=('category',)):
+        """ Returns the totals of the groups like Products.stats() """
+        keys = [getattr(cls, key) for key in group_by]
+        rows = db.session.query(*(keys + [
+            func.sum(cls.count),
+            func.sum(case([(cls.available == True, cls.count)], else_=0)),
+            func.sum(cls.price_sum),
+            func.sum(cls.priced),
+            func.min(cls.price_min),
+            func.max(cls.price_max)])).replica().group_by(*keys).order_by(*keys)
+        return [stats_result(group_by, row) for row in rows]
+
+    @classmethod
+    def rebuild(cls):
+        """ Recomputes every total from the products with one INSERT ... SELECT """
+        cls.query.delete()
+        keys = stats_keys(Products, ('category', 'available'))
+        query = select(keys + [func.count(Products.id),
+                               func.count(Products.price),
+                               func.coalesce(func.sum(Products.price), 0),
+                               func.min(Products.price),
+                               func.max(Products.price)]).group_by(*keys)
+        db.session.execute(cls.__table__.insert().from_select(
+            ['category', 'available', 'count', 'priced', 'price_sum', 'price_min', 'price_max'],
+            query))
+        db.session.commit()
+
+
+class ProductChange(db.Model):
+    """
+    The change feed of the products
+
+    Every write to the products adds a change in the same transaction, so
+    the changes are committed exactly when the products are. A change has
+    a sequence number that only grows, the id of the product and what
+    happened to it: created, updated, deleted, or reset when every product
+    was deleted. Consumers keep the last sequence number they saw and ask
+    for the changes since it.
+    """
+    # woken up whenever this worker commits a change
+    condition = threading.Condition()
+
+    __tablename__ = 'product_changes'
+    # sqlite_autoincrement keeps SQLite from reusing the numbers of pruned changes
+    __table_args__ = {'sqlite_autoincrement': True}
+    seq = db.Column(db.Integer, primary_key=True)
+    product_id = db.Column(db.Integer)    # None for a reset
+    operation = db.Column(db.String(8), nullable=False)
+    changed_at = db.Column(db.DateTime, nullable=False)
+
+    @classmethod
+    def record(cls, operation, *product_ids):
+        """ Adds a change for each product id, call it before committing the products """
+        if not product_ids:
+            return
+        now = datetime.utcnow()
+        db.session.execute(cls.__table__.insert(), [
+            {"product_id": product_id, "operation": operation, "changed_at": now}
+            for product_id in product_ids])
+
+    @classmethod
+    def record_created_after(cls, last_id):
+        """ Adds a created change for every product with an id above last_id
+
+        Used when the new ids are not returned. Products committed by other
+        writers in the meantime get a second created change, which
+        consumers see as an update
+        """
+        products = Products.__table__
+        db.session.execute(cls.__table__.insert().from_select(
+            ['product_id', 'operation', 'changed_at'],
+            select([products.c.id, literal('created'), literal(datetime.utcnow())])
+            .where(products.c.id > last_id).order_by(products.c.id)))
+
+    @classmethod
+    def notify(cls):
+        """ Wakes up the requests of this worker that wait for changes """
+        with cls.condition:
+            cls.condition.notify_all()
+
+    @classmethod
+    def wait(cls, timeout):
+        """ Waits up to timeout seconds for this worker to commit a change
+
+        Changes committed by other workers are only seen by polling, so
+        callers wait in short steps and query again after each
+        """
+        with cls.condition:
+            cls.condition.wait(timeout)
+
+    @classmethod
+    def last_seq(cls):
+        """ Returns the sequence number of the latest change, 0 if there is none """
+        return db.session.query(func.max(cls.seq)).scalar() or 0
+
+    @classmethod
+    def position(cls, engine):
+        """ Returns the latest sequence number in the database of an engine, how far a replica got """
+        return engine.execute(select([func.max(cls.seq)])).scalar() or 0
+
+    @classmethod
+    def since(cls, seq, limit=100, settle=5):
+        """ Returns up to limit changes after a sequence number, oldest first
+
+        Sequence numbers are handed out when a change is written but
+        become visible when it is committed, so a later change can show up
+        before an earlier one. The changes stop at a gap in the numbers
+        unless the change after the gap is older than settle seconds, by
+        which time the missing number is taken to belong to a rolled back
+        transaction.
+
+        Returns:
+            a dictionary for each change with seq, id, operation,
+            changed_at in seconds and the current product, or None when it
+            no longer exists
+        """
+        rows = db.session.query(cls.seq, cls.product_id, cls.operation, cls.changed_at) \
+                         .filter(cls.seq > seq).order_by(cls.seq).limit(limit).all()
+        settled = datetime.utcnow() - timedelta(seconds=settle)
+        changes = []
+        expected = seq + 1
+        for row in rows:
+            if row.seq != expected and row.changed_at > settled:
+                break
+            changes.append(row)
+            expected = row.seq + 1
+        ids = set(row.product_id for row in changes if row.product_id is not None)
+        products = {}
+        if ids:
+            products = dict((product.id, product.serialize())
+                            for product in Products.query.filter(Products.id.in_(ids)))
+        return [{"seq": row.seq,
+                 "id": row.product_id,
+                 "operation": row.operation,
+                 "changed_at": to_timestamp(row.changed_at),
+                 "product": products.get(row.product_id)} for row in changes]
+
+
+class ProductIds(db.Model):
+    """
+    The allocator of product ids when the products are sharded
+
+    A single row on the home database holds the next free value. Each
+    worker reserves a block of values at a time in a short transaction of
+    its own, so that ids stay unique across the shards and workers
+    """
+    __tablename__ = 'product_ids'
+    id = db.Column(db.Integer, primary_key=True)
+    next_value = db.Column(BigInteger, nullable=False)
+
+    @classmethod
+    def allocate(cls, count):
+        """ Reserves count consecutive values and returns the first """
+        table = cls.__table__
+        while True:
+            with db.engine.begin() as connection:
+                updated = connection.execute(table.update().where(table.c.id == 1)
+                                             .values(next_value=table.c.next_value + count))
+                if updated.rowcount:
+                    return connection.execute(select([table.c.next_value])
+                                              .where(table.c.id == 1)).scalar() - count
+            # a new or recreated allocator starts past the ids on the shards
+            first = db.shards.first_value()
+            try:
+                with db.engine.begin() as connection:
+                    connection.execute(table.insert(), id=1, next_value=first + count)
+                return first
+            except IntegrityError:
+                # another worker created the row first
+                continue
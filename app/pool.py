@@ -0,0 +1,92 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Connection Pool
+
+A QueuePool that measures how long requests wait for a database
+connection so that the pool size and overflow can be tuned under load.
+"""
+import time
+import threading
+from sqlalchemy import exc
+from sqlalchemy.pool import QueuePool
+
+
+class InstrumentedQueuePool(QueuePool):
+    """ QueuePool that counts checkouts, waits and timeouts """
+
+    def __init__(self, *args, **kwargs):
+        QueuePool.__init__(self, *args, **kwargs)
+        self._stats_lock = threading.Lock()
+        self.reset_stats()
+
+    def reset_stats(self):
+        """ Sets every counter back to zero """
+        with self._stats_lock:
+            self.checkouts = 0
+            self.waits = 0
+            self.timeouts = 0
+            self.connects = 0
+            self.wait_time = 0.0
+            self.max_wait_time = 0.0
+
+    def _do_get(self):
+        # with no idle connection and no overflow left the checkout
+        # has to wait for a connection to be returned to the pool
+        waited = (self.checkedin() == 0 and self._max_overflow > -1 and
+                  self._overflow >= self._max_overflow)
+        start = time.time()
+        try:
+            return QueuePool._do_get(self)
+        except exc.TimeoutError:
+            with self._stats_lock:
+                self.timeouts += 1
+            raise
+        finally:
+            elapsed = time.time() - start
+            with self._stats_lock:
+                self.checkouts += 1
+                self.waits += 1 if waited else 0
+                self.wait_time += elapsed
+                self.max_wait_time = max(self.max_wait_time, elapsed)
+
+    def _create_connection(self):
+        with self._stats_lock:
+            self.connects += 1
+        return QueuePool._create_connection(self)
+
+    def stats(self):
+        """ Returns the pool gauges and counters as a dictionary """
+        with self._stats_lock:
+            return {"pool": self.__class__.__name__,
+                    "size": self.size(),
+                    "in_use": self.checkedout(),
+                    "idle": self.checkedin(),
+                    "overflow": max(self.overflow(), 0),
+                    "checkouts": self.checkouts,
+                    "waits": self.waits,
+                    "timeouts": self.timeouts,
+                    "connects": self.connects,
+                    "avg_wait_ms": round(1000 * self.wait_time / self.checkouts, 3)
+                                   if self.checkouts else 0.0,
+                    "max_wait_ms": round(1000 * self.max_wait_time, 3)}
+
+
+def pool_stats(engine):
+    """ Returns the statistics of an engine's connection pool """
+    pool = engine.pool
+    if isinstance(pool, InstrumentedQueuePool):
+        return pool.stats()
+    return {"pool": pool.__class__.__name__, "status": pool.status()}
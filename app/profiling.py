@@ -0,0 +1,149 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+SQL Profiling
+
+When SQL_PROFILING is on, every SQL statement a request runs is recorded
+with its duration and row count, or its error. The totals are sent back in a
+Server-Timing header and the most recent profiles are kept for
+GET /debug/sql.
+
+A request that runs the same statement (ignoring its parameters) at
+least SQL_PROFILING_REPEAT times is flagged and logged as a possible
+N+1 query, e.g. a lazy load run once per product of a list.
+
+Statements run while a streamed response is being sent are not recorded.
+"""
+import re
+import time
+from collections import deque, OrderedDict
+from flask import current_app, g, request, has_request_context
+from sqlalchemy import event
+from sqlalchemy.engine import Engine
+
+PLACEHOLDER = re.compile(r'%\(\w+\)s|%s|(?<!:):\w+|\?')
+VALUE_LIST = re.compile(r'\(\?(?:\s*,\s*\?)*\)')
+NUMBER = re.compile(r'\b\d+(?:\.\d+)?\b')
+WHITESPACE = re.compile(r'\s+')
+
+# the profiles of the most recent requests, newest last
+PROFILES = deque(maxlen=100)
+
+
+def normalize(statement):
+    """ Returns a statement with its literals and parameters replaced by ? """
+    statement = PLACEHOLDER.sub('?', statement)
+    statement = NUMBER.sub('?', statement)
+    statement = VALUE_LIST.sub('(?)', statement)
+    return WHITESPACE.sub(' ', statement).strip()
+
+
+def current_profile():
+    """ Returns the statements recorded for the current request, if it is profiled """
+    if not has_request_context():
+        return None
+    return getattr(g, 'sql_profile', None)
+
+
+@event.listens_for(Engine, 'before_cursor_execute')
+def before_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """ Notes when a profiled statement starts """
+    if current_profile() is not None:
+        conn.info.setdefault('profile_start', []).append(time.time())
+
+
+@event.listens_for(Engine, 'after_cursor_execute')
+def after_cursor_execute(conn, cursor, statement, parameters, context, executemany):
+    """ Records a finished statement in the profile of the current request """
+    rowcount = cursor.rowcount
+    # SELECTs report -1 on drivers that do not buffer their rows
+    record_statement(conn, statement, {"rows": rowcount if rowcount >= 0 else None})
+
+
+@event.listens_for(Engine, 'handle_error')
+def handle_error(context):
+    """ Records a statement that failed, which never reaches after_cursor_execute """
+    if context.statement is not None and context.connection is not None:
+        record_statement(context.connection, context.statement,
+                         {"rows": None, "error": str(context.original_exception)})
+
+
+def record_statement(conn, statement, outcome):
+    """ Adds a statement that ended, with its rows or error, to the profile of the current request """
+    profile = current_profile()
+    if profile is None or not conn.info.get('profile_start'):
+        return
+    elapsed = time.time() - conn.info['profile_start'].pop()
+    item = {"statement": statement, "duration_ms": round(elapsed * 1000, 3)}
+    item.update(outcome)
+    profile.append(item)
+
+
+def start_request():
+    """ Starts profiling a request when SQL_PROFILING is on """
+    if current_app.config.get('SQL_PROFILING'):
+        g.sql_profile = []
+        g.sql_profile_start = time.time()
+
+
+def repeated_statements(statements, threshold):
+    """ Returns the statements run at least threshold times, most frequent first """
+    counts = OrderedDict()
+    for item in statements:
+        key = normalize(item['statement'])
+        counts[key] = counts.get(key, 0) + 1
+    repeated = [{"statement": key, "count": count}
+                for key, count in counts.items() if count >= threshold]
+    return sorted(repeated, key=lambda item: -item['count'])
+
+
+def finish_request(response):
+    """ Adds the Server-Timing header and keeps the profile of a request """
+    statements = current_profile()
+    if statements is None or request.endpoint == 'sql_profiles':
+        return response
+    g.sql_profile = None    # statements run while streaming are not recorded
+    total_ms = (time.time() - g.sql_profile_start) * 1000
+    db_ms = sum(item['duration_ms'] for item in statements)
+    repeated = repeated_statements(statements, current_app.config['SQL_PROFILING_REPEAT'])
+    response.headers.add('Server-Timing', 'db;dur={:.3f};desc="{} queries"'.format(
+        db_ms, len(statements)))
+    response.headers.add('Server-Timing', 'total;dur={:.3f}'.format(total_ms))
+    for item in repeated:
+        current_app.logger.warning('Possible N+1 query in %s %s, ran %d times: %s',
+                                   request.method, request.path, item['count'],
+                                   item['statement'])
+    PROFILES.append({"method": request.method,
+                     "path": request.full_path.rstrip('?'),
+                     "endpoint": request.endpoint,
+                     "status": response.status_code,
+                     "duration_ms": round(total_ms, 3),
+                     "db_ms": round(db_ms, 3),
+                     "queries": len(statements),
+                     "statements": statements,
+                     "repeated": repeated})
+    return response
+
+
+def profiles(repeated_only=False):
+    """ Returns the kept profiles newest first, or only those with repeated statements """
+    return [profile for profile in reversed(PROFILES)
+            if profile['repeated'] or not repeated_only]
+
+
+def init_app(app):
+    """ Profiles the requests served by app while SQL_PROFILING is on """
+    app.before_request(start_request)
+    app.after_request(finish_request)
@@ -0,0 +1,169 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Read Replicas
+
+Sends read-only queries to the databases in REPLICA_URIS. A query is
+only answered by a replica when both:
+- it was made with RoutedQuery.replica() (app/routing.py), as the
+  read-only Products class methods do, and
+- its session allows it with ReplicaSet.allow(), which the service does
+  for GET and HEAD requests
+
+Replicas are taken in turn. One that cannot be connected to, that fails
+a query or that is more than REPLICA_MAX_LAG_SECONDS behind the primary
+is skipped for REPLICA_RETRY_SECONDS and the query goes to the next, or
+to the primary when none is left.
+
+For REPLICA_STICKY_SECONDS after a write, reads stay on the primary so
+that clients read their own writes while the replicas catch up. The
+time of the last write is kept by this process, and by the client in
+the last_write cookie the service sets, since its next request may be
+handled by another worker.
+"""
+import time
+import logging
+import itertools
+import threading
+from sqlalchemy.exc import DBAPIError
+from .pool import pool_stats
+
+logger = logging.getLogger(__name__)
+
+
+class ReplicaSet(object):
+    """
+    The read replica engines, with the ones that failed recently
+
+    Args:
+        engines (list): an engine for each replica
+        retry_seconds (float): how long a replica that failed is skipped
+        sticky_seconds (float): how long reads stay on the primary after a write
+        max_lag_seconds (float): how far behind the primary a replica may be, 0 not to check
+        position (function): returns the replication position of an engine, a number
+            that grows with every write such as the last change sequence number
+    """
+
+    def __init__(self, engines=(), retry_seconds=30, sticky_seconds=5,
+                 max_lag_seconds=0, position=None):
+        self.engines = list(engines)
+        self.retry_seconds = retry_seconds
+        self.sticky_seconds = sticky_seconds
+        self.max_lag_seconds = max_lag_seconds
+        self.position = position
+        self.down = {}   # engine -> the time it may be tried again
+        self.turn = itertools.count()
+        self.last_write = 0
+        self.positions = []   # (time, position) samples of the primary
+        self.next_check = 0
+        self.checking = threading.Lock()
+        self.reads = 0
+        self.failovers = 0
+
+    def __len__(self):
+        return len(self.engines)
+
+    def allow(self, session, enabled=True, last_write=0):
+        """ Lets the replica queries of a session go to a replica, or keeps them on the primary
+
+        last_write is the time the client last wrote, when it is known
+        """
+        enabled = enabled and self.readable(last_write)
+        if enabled:
+            self.check_lag(session.get_bind())
+        session.info['replicas'] = self if enabled else None
+
+    def readable(self, last_write=0):
+        """ Returns True if there are replicas and nothing was written too recently to read from them """
+        return bool(self.engines) and \
+            time.time() - max(self.last_write, last_write) >= self.sticky_seconds
+
+    def wrote(self):
+        """ Keeps reads on the primary for the next sticky_seconds """
+        self.last_write = time.time()
+
+    def choose(self):
+        """ Returns the replicas to try in order, starting with the next in turn """
+        start = next(self.turn) % len(self.engines)
+        now = time.time()
+        return [engine for engine in self.engines[start:] + self.engines[:start]
+                if self.down.get(engine, 0) <= now]
+
+    def check_lag(self, primary):
+        """ Skips the replicas that are more than max_lag_seconds behind the primary
+
+        Every max_lag_seconds / 2 the positions of the primary and of the
+        replicas are read. A replica that has not reached the position the
+        primary had max_lag_seconds ago is lagging.
+        """
+        now = time.time()
+        if not self.max_lag_seconds or self.position is None or now < self.next_check or \
+                not self.checking.acquire(False):
+            return
+        try:
+            self.next_check = now + self.max_lag_seconds / 2.0
+            self.positions.append((now, self.position(primary)))
+            old = [position for sampled, position in self.positions
+                   if sampled <= now - self.max_lag_seconds]
+            # only the latest of the samples older than max_lag_seconds is needed
+            self.positions = self.positions[max(len(old) - 1, 0):]
+            for engine in self.engines:
+                if self.down.get(engine, 0) > now:
+                    continue
+                try:
+                    position = self.position(engine)
+                except DBAPIError as error:
+                    self.mark_down(engine, error)
+                    continue
+                if old and position < old[-1]:
+                    self.mark_down(engine, 'lagging {}s behind the primary, at position {} of {}'
+                                   .format(self.max_lag_seconds, position, old[-1]))
+        finally:
+            self.checking.release()
+
+    def mark_down(self, engine, error):
+        """ Skips a replica that failed for the next retry_seconds """
+        logger.warning('Read replica %r failed, skipping it for %ss: %s',
+                       engine.url, self.retry_seconds, error)
+        self.down[engine] = time.time() + self.retry_seconds
+        self.failovers += 1
+
+    def connection(self, session, **kwargs):
+        """ Returns a connection of session to a healthy replica, or None if there is none """
+        for engine in self.choose():
+            try:
+                connection = session.connection(bind=engine, **kwargs)
+            except DBAPIError as error:
+                self.mark_down(engine, error)
+                continue
+            self.reads += 1
+            session.info['replica'] = engine
+            return connection
+        return None
+
+    def stats(self):
+        """ Returns the state and connection pool of every replica as a dictionary """
+        now = time.time()
+        return {"reads": self.reads,
+                "failovers": self.failovers,
+                "replicas": [dict(pool_stats(engine), url=repr(engine.url),
+                                  healthy=self.down.get(engine, 0) <= now)
+                             for engine in self.engines]}
+
+    def dispose(self):
+        """ Closes the connections of every replica """
+        for engine in self.engines:
+            engine.dispose()
+
@@ -0,0 +1,183 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Query Routing
+
+The session and query classes of db, which decide the database each
+statement runs on:
+- with shards (app/sharding.py), statements on the products table go to
+  the shard of their product, and queries that are not about a single
+  product go to every shard
+- otherwise queries made with replica() may go to a read replica
+  (app/replicas.py), and are run again on the primary if it fails them
+- everything else runs on the database of SQLALCHEMY_DATABASE_URI
+"""
+from flask_sqlalchemy import BaseQuery, SignallingSession
+from sqlalchemy.exc import DBAPIError
+
+
+def touches(table, mapper=None, clause=None):
+    """ Returns True if a statement is about a table """
+    if mapper is not None:
+        return mapper.mapped_table is table
+    return getattr(clause, 'table', None) is table or table in getattr(clause, 'froms', ())
+
+
+class RoutingSession(SignallingSession):
+    """ A session that sends the statements on the sharded table to their shard """
+
+    def __init__(self, db, **options):
+        self.db = db
+        SignallingSession.__init__(self, db, **options)
+
+    @property
+    def shards(self):
+        """ The ShardSet of db, or None when the products are not sharded """
+        return self.db.shards or None
+
+    @property
+    def connection_callable(self):
+        """ Gives the flush a connection for each instance when there are shards """
+        return self._instance_connection if self.shards else None
+
+    def _instance_connection(self, mapper, instance):
+        """ Returns the connection to the shard of an instance, giving a new one its id """
+        shards = self.shards
+        if mapper.mapped_table is not shards.table:
+            return self.connection(mapper)
+        if instance.id is None:
+            instance.id = shards.new_id(instance.category)
+        return self.connection(bind=shards.engine(shards.for_id(instance.id)))
+
+    def get_bind(self, mapper=None, clause=None):
+        shards = self.shards
+        if shards and touches(shards.table, mapper, clause):
+            shard = self.info.get('shard')
+            if shard is None:
+                raise RuntimeError('A statement on {} must be run in ShardSet.pinned()'
+                                   .format(shards.table.name))
+            return shards.engine(shard)
+        return SignallingSession.get_bind(self, mapper, clause)
+
+
+class RoutedQuery(BaseQuery):
+    """
+    A query that finds the shards or the read replica that should answer it
+
+    With shards, a query for the sharded table runs on the shard the
+    session is pinned to, on the shard of the id for get() and for
+    reloading an instance, and on every shard otherwise, bulk update()
+    and delete() included
+    """
+
+    _replica = False
+    _shard = None
+
+    def replica(self):
+        """ Returns a copy of the query that may be answered by a read replica """
+        query = self._clone()
+        query._replica = True
+        return query
+
+    def on_shard(self, shard):
+        """ Returns a copy of the query that runs on one shard """
+        query = self._clone()
+        query._shard = shard
+        return query
+
+    def get(self, ident):
+        shards = self._shards()
+        if shards and self.session.info.get('shard') is None:
+            return BaseQuery.get(self.on_shard(shards.for_id(ident)), ident)
+        return BaseQuery.get(self, ident)
+
+    def count(self):
+        shards = self._shards()
+        if shards and self.session.info.get('shard') is None:
+            self.session._autoflush()
+            return shards.count(self)
+        return BaseQuery.count(self)
+
+    def update(self, values, synchronize_session='evaluate', update_args=None):
+        shards = self._shards()
+        if shards and self.session.info.get('shard') is None:
+            return self._each_shard(shards, lambda: BaseQuery.update(
+                self, values, synchronize_session, update_args))
+        return BaseQuery.update(self, values, synchronize_session, update_args)
+
+    def delete(self, synchronize_session='evaluate'):
+        shards = self._shards()
+        if shards and self.session.info.get('shard') is None:
+            return self._each_shard(shards, lambda: BaseQuery.delete(self, synchronize_session))
+        return BaseQuery.delete(self, synchronize_session)
+
+    def __iter__(self):
+        shards = self._shards()
+        if not shards:
+            return self._read_replica() if self._replica else BaseQuery.__iter__(self)
+        shard = self.session.info.get('shard')
+        if shard is None and self._refresh_state is not None:
+            # reloading the expired attributes of an instance
+            shard = shards.for_id(self._refresh_state.key[1][0])
+        if shard is not None:
+            return BaseQuery.__iter__(self.on_shard(shard))
+        self.session._autoflush()
+        return shards.fan_out(self)
+
+    def _each_shard(self, shards, statement):
+        """ Runs a bulk UPDATE or DELETE on every shard and returns the rows it matched """
+        matched = 0
+        for shard in shards.each():
+            with shards.pinned(self.session, shard):
+                matched += statement()
+        return matched
+
+    def _read_replica(self):
+        """ Runs the query on a replica, or on the primary when the replica fails it """
+        info = self.session.info
+        info.pop('replica', None)
+        try:
+            return BaseQuery.__iter__(self)
+        except DBAPIError as error:
+            engine = info.pop('replica', None)
+            if engine is None:
+                raise
+            info['replicas'].mark_down(engine, error)
+            query = self._clone()
+            query._replica = False
+            return BaseQuery.__iter__(query)
+
+    def _shards(self):
+        """ Returns the ShardSet when the query is for the sharded table and no shard was chosen """
+        shards = getattr(self.session, 'shards', None)
+        if not shards or self._shard is not None:
+            return None
+        mapper = self._bind_mapper()
+        return shards if mapper is not None and mapper.mapped_table is shards.table else None
+
+    def _connection_from_session(self, **kwargs):
+        if self._shard is not None:
+            connection = self.session.connection(
+                bind=self.session.shards.engine(self._shard),
+                close_with_result=kwargs.get('close_with_result', False))
+        else:
+            replicas = self.session.info.get('replicas') if self._replica else None
+            connection = replicas.connection(self.session, close_with_result=kwargs.get(
+                'close_with_result', False)) if replicas else None
+        if connection is None:
+            return BaseQuery._connection_from_session(self, **kwargs)
+        if self._execution_options:
+            connection = connection.execution_options(**self._execution_options)
+        return connection
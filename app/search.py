@@ -0,0 +1,251 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Search Index
+
+An in-process inverted index of product names and categories, used for
+search on databases without full-text indexes (SQLite and DB2). Postgres
+searches its own tsvector and trigram indexes instead.
+
+Every word of a query must match a word of the product, exactly, as a
+prefix ("tele" finds "Television") or, failing both, by trigram
+similarity ("televsion" finds "Television"). Words in the name count
+twice as much as words in the category.
+"""
+import re
+import time
+import heapq
+import bisect
+import threading
+
+TOKEN = re.compile(r'\w+', re.UNICODE)
+
+# weight of a word by the field it was found in
+NAME_WEIGHT = 2.0
+CATEGORY_WEIGHT = 1.0
+# weight of a query word by how it matched
+EXACT = 1.0
+PREFIX = 0.8
+FUZZY = 0.5
+# trigram similarity a misspelled word needs to match
+FUZZY_SIMILARITY = 0.4
+
+
+def tokenize(text):
+    """ Returns the lower case words of a text """
+    return TOKEN.findall((text or '').lower())
+
+
+def trigrams(word):
+    """ Returns the trigrams of a word, padded like pg_trgm """
+    padded = '  ' + word + ' '
+    return set(padded[i:i + 3] for i in range(len(padded) - 2))
+
+
+class SearchIndex(object):
+    """ Inverted index from words to the ids of the products that contain them
+
+    Matches are kept as sets of ids grouped by score, so that a query is
+    answered with set unions and intersections rather than a loop over
+    every matching product
+    """
+
+    def __init__(self, max_age=300):
+        self.max_age = max_age
+        self.lock = threading.RLock()
+        self.rebuilding = False
+        self.stale = set()
+        self.built_at = None
+        self._replace({}, {}, {})
+
+    def _replace(self, documents, names, categories):
+        """ Swaps in new postings and the lookups derived from them """
+        grams = {}
+        for word in set(names) | set(categories):
+            for gram in trigrams(word):
+                grams.setdefault(gram, set()).add(word)
+        with self.lock:
+            self.documents = documents    # id -> (name words, category words)
+            self.names = names            # word -> ids with the word in their name
+            self.categories = categories  # word -> ids with the word in their category
+            self.trigrams = grams         # trigram -> words
+            self.vocabulary = None        # sorted words, for prefix lookups
+
+    def build(self, rows):
+        """ Replaces the index with (id, name, category) rows """
+        started = time.time()
+        documents = {}
+        names = {}
+        categories = {}
+        for product_id, name, category in rows:
+            name_words = tuple(set(tokenize(name)))
+            category_words = tuple(set(tokenize(category)))
+            documents[product_id] = (name_words, category_words)
+            for word in name_words:
+                names.setdefault(word, set()).add(product_id)
+            for word in category_words:
+                categories.setdefault(word, set()).add(product_id)
+        self._replace(documents, names, categories)
+        self.built_at = started
+
+    def clear(self):
+        """ Empties the index so that it is built again before the next search """
+        self._replace({}, {}, {})
+        with self.lock:
+            self.stale.clear()
+            self.built_at = None
+
+    def expired(self):
+        """ Returns True if the index was never built or is older than max_age """
+        return self.built_at is None or time.time() - self.built_at > self.max_age
+
+    def invalidate(self, *ids):
+        """ Marks products as changed so they are read again before the next search """
+        with self.lock:
+            self.stale.update(ids)
+
+    def pop_stale(self):
+        """ Returns and forgets the ids of the changed products """
+        with self.lock:
+            stale, self.stale = self.stale, set()
+        return stale
+
+    def _is_word(self, word):
+        """ Returns True if a word is in the name or category of any product """
+        return word in self.names or word in self.categories
+
+    def _post(self, postings, word, product_id):
+        """ Adds an id to the postings of a word """
+        if not self._is_word(word):
+            self.vocabulary = None
+            for gram in trigrams(word):
+                self.trigrams.setdefault(gram, set()).add(word)
+        postings.setdefault(word, set()).add(product_id)
+
+    def _unpost(self, postings, word, product_id):
+        """ Removes an id from the postings of a word """
+        ids = postings[word]
+        ids.discard(product_id)
+        if not ids:
+            del postings[word]
+            if not self._is_word(word):
+                self.vocabulary = None
+                for gram in trigrams(word):
+                    self.trigrams[gram].discard(word)
+
+    def add(self, product_id, name, category):
+        """ Adds a product to the index, replacing any earlier version of it """
+        with self.lock:
+            self.remove(product_id)
+            name_words = tuple(set(tokenize(name)))
+            category_words = tuple(set(tokenize(category)))
+            self.documents[product_id] = (name_words, category_words)
+            for word in name_words:
+                self._post(self.names, word, product_id)
+            for word in category_words:
+                self._post(self.categories, word, product_id)
+
+    def remove(self, product_id):
+        """ Removes a product from the index """
+        with self.lock:
+            name_words, category_words = self.documents.pop(product_id, ((), ()))
+            for word in name_words:
+                self._unpost(self.names, word, product_id)
+            for word in category_words:
+                self._unpost(self.categories, word, product_id)
+
+    def _expand(self, term):
+        """ Returns the (word, weight) pairs of the index that a query word matches """
+        if self.vocabulary is None:
+            self.vocabulary = sorted(set(self.names) | set(self.categories))
+        matches = []
+        if self._is_word(term):
+            matches.append((term, EXACT))
+        for position in range(bisect.bisect_right(self.vocabulary, term), len(self.vocabulary)):
+            word = self.vocabulary[position]
+            if not word.startswith(term):
+                break
+            # the closer a word is to the prefix the better it matches
+            matches.append((word, PREFIX * len(term) / len(word)))
+        if matches or len(term) < 3:
+            return matches
+        grams = trigrams(term)
+        candidates = set()
+        for gram in grams:
+            candidates.update(self.trigrams.get(gram, ()))
+        for word in candidates:
+            other = trigrams(word)
+            similarity = len(grams & other) / float(len(grams | other))
+            if similarity >= FUZZY_SIMILARITY:
+                matches.append((word, FUZZY * similarity))
+        return matches
+
+    def _matches(self, term):
+        """ Returns the (score, ids) of a query word, best first, each id once """
+        scored = {}
+        for word, weight in self._expand(term):
+            for field_weight, postings in ((NAME_WEIGHT, self.names),
+                                           (CATEGORY_WEIGHT, self.categories)):
+                if word in postings:
+                    score = round(weight * field_weight, 6)
+                    scored.setdefault(score, []).append(postings[word])
+        matches = []
+        seen = set()
+        for score in sorted(scored, reverse=True):
+            postings = scored[score]
+            ids = postings[0] if len(postings) == 1 else set().union(*postings)
+            if seen:
+                # an id scores its best match only
+                ids = ids - seen
+            if ids:
+                # the postings are shared with the index, never change them in place
+                matches.append((score, ids))
+                seen = seen | ids if seen else ids
+        return matches
+
+    def search(self, text, limit=20, offset=0):
+        """ Returns the number of products that match a text and a page of (id, score) pairs
+
+        Products are ranked by score, highest first, then by id
+        """
+        terms = tokenize(text)
+        if not terms:
+            return 0, []
+        matches = None
+        with self.lock:
+            for term in terms:
+                if matches is None:
+                    matches = self._matches(term)
+                else:
+                    # products must match every word, their scores add up
+                    combined = {}
+                    for term_score, term_ids in self._matches(term):
+                        for score, ids in matches:
+                            common = ids & term_ids
+                            if common:
+                                combined.setdefault(round(score + term_score, 6),
+                                                    set()).update(common)
+                    matches = sorted(combined.items(), reverse=True)
+                if not matches:
+                    return 0, []
+        total = sum(len(ids) for _, ids in matches)
+        wanted = offset + limit
+        hits = []
+        for score, ids in matches:
+            if len(hits) >= wanted:
+                break
+            hits.extend((product_id, round(score, 3))
+                        for product_id in heapq.nsmallest(wanted - len(hits), ids))
+        return total, hits[offset:]
@@ -17,27 +17,102 @@ Products Service
 Paths:
 ------
 GET /products - Returns a list all of the Products
-GET /product/{id} - Returns the Product with a given id number
+GET /products?category={c}&available={b}&price_min={p}&sort={col} - Returns the
+    Products matching every given filter, repeat a filter to match any of its values
+GET /products?limit={n}&after={id} - Returns a page of Products after the given id
+GET /products?ids={id,id} - Returns the Products with the given ids and the ids not found
+POST /products/lookup - the same for a JSON array of ids
+GET /products?stream=true - Streams all of the Products as a JSON array (or NDJSON)
+GET /products/cheapest?category={c}&limit={n} - Returns the n cheapest Products,
+    optionally of a category, available or under price_max
+GET /products/stats?group_by={category,available} - Returns the number of
+    Products and their average, lowest and highest price in each group
+GET /products/changes?since={seq}&wait={s} - Returns the changes to the Products
+    after a sequence number, waiting up to s seconds for one, or streams
+    them as server-sent events to clients that accept text/event-stream.
+    Each wait holds a thread or greenlet, see gunicorn.conf.py
+GET /products/search?q={text}&limit={n}&offset={n} - Returns the Products whose
+    name or category match every word of text, best match first
+GET /product/{id} - Returns the Product with a given id number, honoring
+    If-None-Match and If-Modified-Since with 304 Not Modified
 POST /products - creates a new Product record in the database
-PUT /products/{id} - updates a Product record in the database
+PUT /products/{id} - updates a Product record in the database, only if it
+    still matches the ETag in If-Match when one is sent
+PUT /products/{id}/unavailable - makes a Product unavailable, through the
+    write-behind queue when WRITE_BEHIND is group or async. In async mode
+    202 Accepted only means the change was queued, it is dropped if the
+    Product changes first or its batch fails
 DELETE /products/{id} - deletes a Product record in the database
+POST /products/bulk - creates Products from a JSON array or NDJSON body
+PUT /products/bulk - updates Products from a JSON array or NDJSON body
+DELETE /products/bulk - deletes the Products with the ids in a JSON array or NDJSON body
+GET /products/export?format={csv} - Streams every Product as NDJSON or CSV
+POST /products/import - creates Products from an NDJSON or CSV body in batches
+GET /cache/stats - Returns the product cache counters
+GET /writebehind/stats - Returns the write-behind queue counters
+GET /pool/stats - Returns the database connection pool gauges and counters, and
+    those of the read replicas and the shards
+GET /metrics - Returns the request latency, size and query histograms for Prometheus
+GET /debug/sql?repeated={b} - Returns the SQL statements of recent requests when
+    SQL_PROFILING is on, or only of those that repeated a statement
 """
 
 import os
 import sys
+import math
+import time
+import numbers
 import logging
-from flask import Flask, jsonify, request, url_for, make_response, abort
+from collections import OrderedDict
+from flask import Flask, Response, jsonify, json, request, url_for, make_response, \
+    abort, stream_with_context
 from flask_api import status    # HTTP Status Codes
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import NotFound, ServiceUnavailable
 
 # For this example we'll use SQLAlchemy, a popular ORM that supports a
 # variety of backends including SQLite, MySQL, and PostgreSQL
 from flask_sqlalchemy import SQLAlchemy
-from models import Products, DataValidationError
+from models import Products, ProductStats, ProductChange, DataValidationError, VersionConflictError, db, \
+    to_timestamp
+from pool import pool_stats
+from transfer import CSV_COLUMNS, csv_lines, read_csv, read_ndjson
+import migrations
+import metrics
+import profiling
+import encoding
+import writebehind
 
 # Import Flask application
 from app import app
 
+# Record the latency, size and database work of every request
+metrics.init_app(app)
+profiling.init_app(app)
+# Registered last so that it runs first, and the metrics see the encoded size
+encoding.init_app(app)
+# started by the first change queued, flushed at exit
+availability_queue = writebehind.AvailabilityQueue(app, Products.set_availability,
+                                                   app.config['WRITE_BEHIND_INTERVAL'],
+                                                   app.config['WRITE_BEHIND_BATCH'])
+
+# Pagination limits for GET /products
+DEFAULT_PAGE_SIZE = int(os.getenv('DEFAULT_PAGE_SIZE', '100'))
+MAX_PAGE_SIZE = int(os.getenv('MAX_PAGE_SIZE', '1000'))
+NDJSON_MIMETYPE = 'application/x-ndjson'
+CSV_MIMETYPE = 'text/csv'
+EVENT_STREAM_MIMETYPE = 'text/event-stream'
+
+# HTTP status of each item reported by the bulk endpoints
+BULK_STATUS = {'created': status.HTTP_201_CREATED,
+               'updated': status.HTTP_200_OK,
+               'deleted': status.HTTP_204_NO_CONTENT,
+               'invalid': status.HTTP_400_BAD_REQUEST,
+               'not found': status.HTTP_404_NOT_FOUND,
+               'failed': status.HTTP_409_CONFLICT}
+
+# What a query string argument must be, by the function that converts it
+ARG_TYPES = {int: 'an integer', float: 'a number'}
+
 ######################################################################
 # Error Handlers
 ######################################################################
@@ -46,6 +121,11 @@ def request_validation_error(error):
     """ Handles Value Errors from bad data """
     return bad_request(error)
 
+@app.errorhandler(VersionConflictError)
+def version_conflict_error(error):
+    """ Handles updates to a Product that changed since it was read """
+    return precondition_failed(error)
+
 @app.errorhandler(status.HTTP_400_BAD_REQUEST)
 def bad_request(error):
     """ Handles bad reuests with 400_BAD_REQUEST """
@@ -73,6 +153,15 @@ def method_not_supported(error):
                    error='Method not Allowed',
                    message=message), status.HTTP_405_METHOD_NOT_ALLOWED
 
+@app.errorhandler(status.HTTP_412_PRECONDITION_FAILED)
+def precondition_failed(error):
+    """ Handles failed If-Match preconditions with 412_PRECONDITION_FAILED """
+    message = error.message or str(error)
+    app.logger.warning(message)
+    return jsonify(status=status.HTTP_412_PRECONDITION_FAILED,
+                   error='Precondition Failed',
+                   message=message), status.HTTP_412_PRECONDITION_FAILED
+
 @app.errorhandler(status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
 def mediatype_not_supported(error):
     """ Handles unsuppoted media requests with 415_UNSUPPORTED_MEDIA_TYPE """
@@ -82,6 +171,15 @@ def mediatype_not_supported(error):
                    error='Unsupported media type',
                    message=message), status.HTTP_415_UNSUPPORTED_MEDIA_TYPE
 
+@app.errorhandler(status.HTTP_503_SERVICE_UNAVAILABLE)
+def service_unavailable(error):
+    """ Handles writes that could not be completed in time with 503_SERVICE_UNAVAILABLE """
+    message = error.message or str(error)
+    app.logger.warning(message)
+    return jsonify(status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                   error='Service Unavailable',
+                   message=message), status.HTTP_503_SERVICE_UNAVAILABLE
+
 @app.errorhandler(status.HTTP_500_INTERNAL_SERVER_ERROR)
 def internal_server_error(error):
     """ Handles unexpected server error with 500_SERVER_ERROR """
@@ -92,6 +190,40 @@ def internal_server_error(error):
                    message=message), status.HTTP_500_INTERNAL_SERVER_ERROR
 
 
+######################################################################
+# READ REPLICAS
+######################################################################
+# the cookie with the time a client last wrote, see app/replicas.py
+LAST_WRITE_COOKIE = 'last_write'
+
+@app.before_request
+def route_reads():
+    """
+    Lets the read-only queries of GET and HEAD requests go to a read replica
+
+    Requests that write, those sent with Cache-Control: no-cache to read
+    the latest data, and those of a client that wrote less than
+    REPLICA_STICKY_SECONDS ago stay on the primary
+    """
+    try:
+        last_write = float(request.cookies.get(LAST_WRITE_COOKIE, 0))
+    except ValueError:
+        last_write = 0
+    Products.replicas.allow(db.session, request.method in ('GET', 'HEAD') and
+                            not request.cache_control.no_cache, last_write)
+
+
+@app.after_request
+def remember_write(response):
+    """ Tells a client that wrote when it did, so that any worker keeps its reads on the primary """
+    sticky_seconds = Products.replicas.sticky_seconds
+    if Products.replicas and sticky_seconds and response.status_code < 400 and \
+            request.method not in ('GET', 'HEAD', 'OPTIONS'):
+        response.set_cookie(LAST_WRITE_COOKIE, '{:.3f}'.format(time.time()),
+                            max_age=int(math.ceil(sticky_seconds)), httponly=True)
+    return response
+
+
 ######################################################################
 # GET INDEX
 ######################################################################
@@ -112,28 +244,276 @@ def index():
 # LIST ALL Products
 ######################################################################
 @app.route('/products', methods=['GET'])
-
 def list_products():
-    """ Returns all of the Products """
+    """
+    Returns all of the Products
 
+    The list carries an ETag and answers If-None-Match with 304 Not Modified
+    without loading the products. Any mix of name, category, available,
+    price, price_min and price_max narrows the list in a single query, and
+    sort orders it by columns (prefix a column with - to sort descending).
+    Use limit and after for keyset pagination; the next page is advertised
+    in a Link header. Use stream=true (or Accept: application/x-ndjson) to
+    stream every matching Product without loading them all into memory
+    """
     app.logger.info('Request for product list')
-    products = []
-    category = request.args.get('category')
-    name = request.args.get('name')
-    price = request.args.get('price')
-    if category:
-        products = Products.find_by_category(category)
-    elif name:
-        products = Products.find_by_name(name)
-    elif price:
-        products = Products.find_by_price(price)
-    else:
-        products = Products.all()
+    if 'ids' in request.args:
+        ids = list_arg('ids', ',', int)
+        if ids is None:
+            ids = []
+        return lookup_response(ids if isinstance(ids, list) else [ids])
+    ndjson = request.accept_mimetypes.best == NDJSON_MIMETYPE
+    streamed = ndjson or request.args.get('stream', '').lower() == 'true'
+    paged = 'limit' in request.args or 'after' in request.args
+    sort = [key for key in request.args.get('sort', '').split(',') if key]
+    if paged and sort:
+        raise DataValidationError('sort cannot be combined with limit or after')
+    filters = dict(name=list_arg('name'),
+                   category=list_arg('category'),
+                   available=bool_arg('available'),
+                   price=list_arg('price', ',', float),
+                   price_min=float_arg('price_min'),
+                   price_max=float_arg('price_max'),
+                   sort=sort)
+
+    if streamed:
+        return stream_products(Products.find_by_filters(**filters), ndjson)
+    if paged:
+        return page_products(Products.find_by_filters(**filters))
+
+    validators = Products.list_validators(**filters)
+    response = not_modified(validators['etag'])
+    if response is None:
+        response = json_response(Products.list_json(**filters))
+    return with_validators(response, validators['etag'], validators['updated'])
+
+
+@app.route('/products/lookup', methods=['POST'])
+def lookup_products():
+    """
+    Returns the Products with the ids in a JSON array
+
+    Like GET /products?ids= for more ids than fit in a URL
+    """
+    app.logger.info('Request to look up products')
+    check_content_type('application/json')
+    ids = request.get_json()
+    if isinstance(ids, dict):
+        ids = ids.get('ids')
+    if not isinstance(ids, list) or not all(
+            isinstance(product_id, numbers.Integral) and not isinstance(product_id, bool)
+            for product_id in ids):
+        raise DataValidationError('Request body must be a JSON array of ids')
+    return lookup_response(ids)
+
+
+def lookup_response(ids):
+    """ Returns the Products with some ids and the ids that were not found """
+    if len(ids) > MAX_PAGE_SIZE:
+        raise DataValidationError('At most {} ids can be looked up at once'.format(MAX_PAGE_SIZE))
+    products, not_found = Products.find_many_cached(ids)
+    return make_response(jsonify(products=products, not_found=not_found), status.HTTP_200_OK)
+
+
+def page_products(query):
+    """ Returns one page of a query with a Link header to the next page """
+    limit = int_arg('limit', DEFAULT_PAGE_SIZE)
+    after = int_arg('after')
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise DataValidationError('limit must be between 1 and {}'.format(MAX_PAGE_SIZE))
+    products, next_after = Products.page(after, limit, query)
+    results = [product.serialize() for product in products]
+    headers = {}
+    if next_after is not None:
+        args = request.args.to_dict()
+        args.update(after=next_after, limit=limit)
+        next_url = url_for('list_products', _external=True, **args)
+        headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    return make_response(jsonify(results), status.HTTP_200_OK, headers)
+
+
+def stream_products(query, ndjson=False):
+    """ Streams a query as a JSON array or as newline delimited JSON """
+    def generate():
+        """ Yields the response body one product at a time """
+        rows = Products.stream(Products.rows(query))
+        if ndjson:
+            for row in rows:
+                yield Products.encode_row(row) + '\n'
+            return
+        separator = '['
+        for row in rows:
+            yield separator + Products.encode_row(row)
+            separator = ','
+        yield '[]' if separator == '[' else ']'
+
+    mimetype = NDJSON_MIMETYPE if ndjson else 'application/json'
+    return Response(stream_with_context(generate()), status.HTTP_200_OK, mimetype=mimetype)
+
+
+######################################################################
+# CHEAPEST Products
+######################################################################
+@app.route('/products/cheapest', methods=['GET'])
+def cheapest_products():
+    """
+    Returns the cheapest Products, cheapest first
 
+    Narrow them down with category, available and price_max. limit (10 by
+    default) Products are read in price order from an index
+    """
+    app.logger.info('Request for the cheapest products')
+    limit = int_arg('limit', 10)
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise DataValidationError('limit must be between 1 and {}'.format(MAX_PAGE_SIZE))
+    products = Products.cheapest(limit, category=request.args.get('category'),
+                                 available=bool_arg('available'),
+                                 price_max=float_arg('price_max'))
     results = [product.serialize() for product in products]
     return make_response(jsonify(results), status.HTTP_200_OK)
 
 
+######################################################################
+# Products STATISTICS
+######################################################################
+@app.route('/products/stats', methods=['GET'])
+def products_stats():
+    """
+    Returns the number of Products and their prices in each group
+
+    Products are grouped by category unless group_by lists category
+    and/or available. Each group has a count, the number available and the
+    average, lowest and highest price
+    """
+    group_by = list_arg('group_by', ',') or 'category'
+    if not isinstance(group_by, list):
+        group_by = [group_by]
+    app.logger.info('Request for product stats by %s', group_by)
+    for key in group_by:
+        if key not in ('category', 'available'):
+            raise DataValidationError('group_by must be category and/or available')
+    stats = Products.stats(list(OrderedDict.fromkeys(group_by)))
+    return make_response(jsonify(stats), status.HTTP_200_OK)
+
+
+######################################################################
+# CHANGE FEED
+######################################################################
+@app.route('/products/changes', methods=['GET'])
+def product_changes():
+    """
+    Returns the changes to the Products after a sequence number
+
+    Without since no changes are returned, only the latest sequence number
+    in next, so a consumer can take it before reading every Product and
+    then ask for the changes since. wait holds the request open for up to
+    that many seconds until there is a change (long polling). Clients that
+    accept text/event-stream get the changes as server-sent events, and
+    resume from the Last-Event-ID header when they reconnect
+    """
+    app.logger.info('Request for product changes')
+    limit = int_arg('limit', DEFAULT_PAGE_SIZE)
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise DataValidationError('limit must be between 1 and {}'.format(MAX_PAGE_SIZE))
+    since = int_arg('since')
+    if since is None and 'Last-Event-ID' in request.headers:
+        try:
+            since = int(request.headers['Last-Event-ID'])
+        except ValueError:
+            raise DataValidationError('Last-Event-ID must be a sequence number')
+    if since is None:
+        since = ProductChange.last_seq()
+    elif since < 0:
+        raise DataValidationError('since must be at least 0')
+    if request.accept_mimetypes.best == EVENT_STREAM_MIMETYPE:
+        return stream_changes(since, limit)
+    wait = float_arg('wait', 0)
+    if wait < 0:
+        raise DataValidationError('wait must be at least 0')
+    deadline = time.time() + min(wait, app.config['CHANGES_MAX_WAIT'])
+    changes = changes_since(since, limit)
+    while not changes and time.time() < deadline:
+        db.session.remove()  # do not hold a connection while waiting
+        ProductChange.wait(min(app.config['CHANGES_POLL_INTERVAL'], deadline - time.time()))
+        changes = changes_since(since, limit)
+    next_seq = changes[-1]['seq'] if changes else since
+    return make_response(jsonify(changes=changes, next=next_seq), status.HTTP_200_OK)
+
+
+def changes_since(since, limit):
+    """ Returns the settled changes after a sequence number """
+    return ProductChange.since(since, limit, app.config['CHANGES_SETTLE'])
+
+
+def stream_changes(since, limit):
+    """ Streams the changes after a sequence number as server-sent events
+
+    The stream ends after CHANGES_STREAM_SECONDS so that it does not hold a
+    worker forever, and the client reconnects with Last-Event-ID
+    """
+    config = app.config
+
+    def generate():
+        """ Yields an event for each change and a comment to keep the connection open """
+        last = since
+        deadline = time.time() + config['CHANGES_STREAM_SECONDS']
+        yield 'retry: 1000\n\n'
+        while True:
+            changes = changes_since(last, limit)
+            db.session.remove()
+            for change in changes:
+                yield 'id: {}\nevent: {}\ndata: {}\n\n'.format(
+                    change['seq'], change['operation'], json.dumps(change))
+            if changes:
+                last = changes[-1]['seq']
+                continue
+            if time.time() >= deadline:
+                return
+            yield ': waiting\n\n'
+            ProductChange.wait(min(config['CHANGES_POLL_INTERVAL'], deadline - time.time()))
+
+    return Response(stream_with_context(generate()), status.HTTP_200_OK,
+                    mimetype=EVENT_STREAM_MIMETYPE, headers={'Cache-Control': 'no-cache'})
+
+
+######################################################################
+# SEARCH Products
+######################################################################
+@app.route('/products/search', methods=['GET'])
+def search_products():
+    """
+    Searches the names and categories of the Products
+
+    Every word of q must match a word of the product exactly, as a prefix
+    or, when misspelled, by similarity. Each product has a score and the
+    best matches come first; use limit and offset to page through them,
+    the total is in X-Total-Count and the next page in a Link header
+    """
+    text = request.args.get('q', '').strip()
+    app.logger.info('Request to search products for %r', text)
+    if not text:
+        raise DataValidationError('q must contain a word to search for')
+    limit = int_arg('limit', DEFAULT_PAGE_SIZE)
+    offset = int_arg('offset', 0)
+    if limit < 1 or limit > MAX_PAGE_SIZE:
+        raise DataValidationError('limit must be between 1 and {}'.format(MAX_PAGE_SIZE))
+    if offset < 0:
+        raise DataValidationError('offset must not be negative')
+    total, hits = Products.search(text, limit, offset)
+    results = []
+    for product, score in hits:
+        result = product.serialize()
+        result['score'] = score
+        results.append(result)
+    headers = {'X-Total-Count': str(total)}
+    if offset + limit < total:
+        args = request.args.to_dict()
+        args.update(offset=offset + limit, limit=limit)
+        next_url = url_for('search_products', _external=True, **args)
+        headers['Link'] = '<{}>; rel="next"'.format(next_url)
+    return make_response(jsonify(results), status.HTTP_200_OK, headers)
+
+
 ######################################################################
 # RETRIEVE A Product
 ######################################################################
@@ -145,10 +525,14 @@ def get_products(product_id):
     This endpoint will return a Product based on it's id
     """
     app.logger.info('Request for product with id: %s', product_id)
-    product = Products.find(product_id)
-    if not product:
+    entry = Products.find_cached(product_id)
+    if not entry:
         raise NotFound("Product with id '{}' was not found.".format(product_id))
-    return make_response(jsonify(product.serialize()), status.HTTP_200_OK)
+    etag = product_etag(product_id, entry['version'])
+    response = not_modified(etag, entry['updated'])
+    if response is None:
+        response = make_response(jsonify(entry['product']), status.HTTP_200_OK)
+    return with_validators(response, etag, entry['updated'])
 
 
 ######################################################################
@@ -167,10 +551,11 @@ def create_products():
     product.save()
     message = product.serialize()
     location_url = url_for('get_products', product_id=product.id, _external=True)
-    return make_response(jsonify(message), status.HTTP_201_CREATED,
-                         {
-                             'Location': location_url
-                         })
+    response = make_response(jsonify(message), status.HTTP_201_CREATED,
+                             {
+                                 'Location': location_url
+                             })
+    return product_validators(response, product)
 
 
 ######################################################################
@@ -181,33 +566,76 @@ def update_products(product_id):
     """
     Update a Product
 
-    This endpoint will update a Product based the body that is posted
+    This endpoint will update a Product based the body that is posted.
+    Send the ETag of the Product in If-Match to only update it if nobody
+    else has changed it since, otherwise 412 Precondition Failed is returned
     """
     app.logger.info('Request to update product with id: %s', product_id)
     check_content_type('application/json')
-    product = Products.find(product_id)
+    values = Products().deserialize(request.get_json()).to_mapping()
+    del values['updated_at']
+    product = Products.update_by_id(product_id, values, if_match_version(product_id))
     if not product:
         raise NotFound("Product with id '{}' was not found.".format(product_id))
-    product.deserialize(request.get_json())
-    product.id = product_id
-    product.save()
-    return make_response(jsonify(product.serialize()), status.HTTP_200_OK)
+    response = make_response(jsonify(product.serialize()), status.HTTP_200_OK)
+    return product_validators(response, product)
 
 @app.route('/products/<int:product_id>/unavailable', methods=['PUT'])
 def unavailable_products(product_id):
     """
     Make a product unavailable
 
-    This endpoint will update a Product to be unavailable
+    This endpoint will update a Product to be unavailable with a single
+    UPDATE statement, honoring If-Match like a full update. When
+    WRITE_BEHIND is on and there is no If-Match, the change goes through
+    the write-behind queue instead
     """
     app.logger.info('Request to update product with id: %s', product_id)
+    mode = app.config['WRITE_BEHIND']
+    if mode != 'off' and 'If-Match' not in request.headers:
+        return queue_availability(product_id, False, mode)
+    product = Products.update_by_id(product_id, {'available': False},
+                                    if_match_version(product_id))
+    if not product:
+        raise NotFound("Product with id '{}' was not found.".format(product_id))
+    response = make_response(jsonify(product.serialize()), status.HTTP_200_OK)
+    return product_validators(response, product)
+
+
+def queue_availability(product_id, available, mode):
+    """
+    Queues a change of availability in the write-behind queue
+
+    The change is queued with the current version of the Product and is
+    only written if the Product is still at that version, so a write that
+    comes in while it waits wins over it.
+
+    In async mode 202 Accepted is returned as soon as the change is
+    queued. It only promises that the change was queued: the change is
+    dropped if the Product was changed by another request first, if its
+    batch fails to be written or if the worker stops. In group mode the
+    Product is returned once the batch holding the change is committed,
+    412 if the Product was changed first, or 503 if the batch failed or
+    took more than WRITE_BEHIND_TIMEOUT
+    """
+    version = Products.find_version(product_id)
+    if version is None:
+        raise NotFound("Product with id '{}' was not found.".format(product_id))
+    pending = availability_queue.put(product_id, available, version)
+    if mode == 'async':
+        return make_response(jsonify(id=product_id, available=available),
+                             status.HTTP_202_ACCEPTED)
+    if not pending.wait(app.config['WRITE_BEHIND_TIMEOUT']) or pending.failed:
+        raise ServiceUnavailable("Product with id '{}' could not be updated, "
+                                 "try again later.".format(product_id))
     product = Products.find(product_id)
     if not product:
         raise NotFound("Product with id '{}' was not found.".format(product_id))
-    product.id = product_id
-    product.available = False
-    product.save()
-    return make_response(jsonify(product.serialize()), status.HTTP_200_OK)
+    if not pending.found:
+        raise VersionConflictError('Product {} was changed by another request'
+                                   .format(product_id))
+    response = make_response(jsonify(product.serialize()), status.HTTP_200_OK)
+    return product_validators(response, product)
 
 ######################################################################
 # DELETE A PRODUCT
@@ -226,6 +654,128 @@ def delete_product(product_id):
         product.delete()
     return make_response('', status.HTTP_204_NO_CONTENT)
 
+######################################################################
+# BULK CREATE, UPDATE AND DELETE
+######################################################################
+@app.route('/products/bulk', methods=['POST'])
+def bulk_create_products():
+    """
+    Creates many Products
+
+    The body is a JSON array or NDJSON of products. Each product is
+    reported on its own so one bad item does not abort the others
+    """
+    app.logger.info('Request to bulk create products')
+    results = Products.bulk_create(read_bulk_items(), bulk_batch_size())
+    return bulk_response(results)
+
+
+@app.route('/products/bulk', methods=['PUT'])
+def bulk_update_products():
+    """
+    Updates many Products
+
+    The body is a JSON array or NDJSON of products that each have an id
+    """
+    app.logger.info('Request to bulk update products')
+    results = Products.bulk_update(read_bulk_items(), bulk_batch_size())
+    return bulk_response(results)
+
+
+@app.route('/products/bulk', methods=['DELETE'])
+def bulk_delete_products():
+    """
+    Deletes many Products
+
+    The body is a JSON array or NDJSON of product ids
+    """
+    app.logger.info('Request to bulk delete products')
+    results = Products.bulk_delete(read_bulk_items(), bulk_batch_size())
+    return bulk_response(results)
+
+
+def read_bulk_items():
+    """ Returns the items of a JSON array or NDJSON request body """
+    if request.mimetype == NDJSON_MIMETYPE:
+        items = []
+        for line in request.get_data(as_text=True).splitlines():
+            if not line.strip():
+                continue
+            try:
+                items.append(json.loads(line))
+            except ValueError:
+                items.append(None)  # reported as an invalid item
+        return items
+    check_content_type('application/json')
+    items = request.get_json()
+    if not isinstance(items, list):
+        raise DataValidationError('Request body must be a JSON array')
+    return items
+
+
+def bulk_batch_size():
+    """ Returns the batch size for a bulk request """
+    batch_size = int_arg('batch_size', app.config.get('BULK_BATCH_SIZE', 1000))
+    if batch_size < 1:
+        raise DataValidationError('batch_size must be at least 1')
+    return batch_size
+
+
+def bulk_response(results):
+    """ Returns the results of a bulk request with an HTTP status for each item """
+    counts = {}
+    for result in results:
+        counts[result['status']] = counts.get(result['status'], 0) + 1
+        result['status'] = BULK_STATUS[result['status']]
+    return make_response(jsonify(counts=counts, results=results), status.HTTP_200_OK)
+
+
+######################################################################
+# EXPORT AND IMPORT THE CATALOG
+######################################################################
+@app.route('/products/export', methods=['GET'])
+def export_products():
+    """
+    Exports every Product as NDJSON or CSV
+
+    Use format=csv (or Accept: text/csv) for CSV with a header row. The
+    rows are read with a server-side cursor and streamed as they arrive
+    """
+    app.logger.info('Request to export products')
+    as_csv = request.args.get('format', '').lower() == 'csv' or \
+        request.accept_mimetypes.best == CSV_MIMETYPE
+    if not as_csv:
+        response = stream_products(Products.read_query(), ndjson=True)
+    else:
+        rows = Products.stream(Products.rows(Products.read_query(), CSV_COLUMNS))
+        response = Response(stream_with_context(csv_lines(rows)), status.HTTP_200_OK,
+                            mimetype=CSV_MIMETYPE)
+    filename = 'products.csv' if as_csv else 'products.ndjson'
+    response.headers['Content-Disposition'] = 'attachment; filename=' + filename
+    return response
+
+
+@app.route('/products/import', methods=['POST'])
+def import_products():
+    """
+    Imports Products from an NDJSON or CSV body
+
+    The body is read and written in batches of batch_size, so it can hold
+    the whole catalog. The Products get new ids. The response counts the
+    imported, invalid and failed Products and reports the rows per second
+    """
+    app.logger.info('Request to import products')
+    if request.mimetype == NDJSON_MIMETYPE:
+        items = read_ndjson(request.stream)
+    elif request.mimetype == CSV_MIMETYPE:
+        items = read_csv(request.stream)
+    else:
+        app.logger.error('Invalid Content-Type: %s', request.mimetype)
+        abort(415, 'Content-Type must be {} or {}'.format(NDJSON_MIMETYPE, CSV_MIMETYPE))
+    report = Products.import_products(items, bulk_batch_size())
+    return make_response(jsonify(report), status.HTTP_200_OK)
+
+
 ######################################################################
 #  Delete ALL DATA!!! For Testing Only
 ######################################################################
@@ -240,10 +790,146 @@ def reset_all():
 ######################################################################
 
 
-def init_db():
-    """ Initialies the SQLAlchemy app """
+def init_db(check_schema=True):
+    """ Initialies the SQLAlchemy app, creating and migrating the schema if check_schema """
     global app
     Products.init_db(app)
+    if check_schema:
+        db.create_all()  # make our sqlalchemy tables
+        db.shards.create_all()
+        migrations.upgrade()
+        if ProductStats.enabled:
+            ProductStats.rebuild()  # the totals are not kept while it is off
+
+
+def int_arg(name, default=None):
+    """ Returns a query string argument as an int or raises a DataValidationError """
+    return typed_arg(name, int, default)
+
+
+def float_arg(name, default=None):
+    """ Returns a query string argument as a float or raises a DataValidationError """
+    return typed_arg(name, float, default)
+
+
+def bool_arg(name, default=None):
+    """ Returns a query string argument of true or false as a boolean """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    if value.lower() in ('true', '1'):
+        return True
+    if value.lower() in ('false', '0'):
+        return False
+    raise DataValidationError('{} must be true or false'.format(name))
+
+
+def typed_arg(name, convert, default=None):
+    """ Returns a query string argument converted with convert """
+    value = request.args.get(name)
+    if value is None:
+        return default
+    try:
+        return convert(value)
+    except ValueError:
+        raise DataValidationError('{} must be {}'.format(name, ARG_TYPES[convert]))
+
+
+def list_arg(name, separator=None, convert=None):
+    """
+    Returns a repeated query string argument
+
+    A single value is returned as is and several values as a list, so that
+    they can be matched with SQL IN. Values are also split on separator
+    and converted with convert when these are given
+    """
+    values = request.args.getlist(name)
+    if separator:
+        values = [value for item in values for value in item.split(separator) if value]
+    if convert:
+        try:
+            values = [convert(value) for value in values]
+        except ValueError:
+            raise DataValidationError('{} must be {}'.format(name, ARG_TYPES[convert]))
+    if not values:
+        return None
+    if len(values) == 1:
+        return values[0]
+    return values
+
+
+def product_etag(product_id, version):
+    """ Returns the strong ETag of a version of a Product """
+    return '{}-{}'.format(product_id, version)
+
+
+def if_match_version(product_id):
+    """
+    Returns the version of a Product that the If-Match header requires
+
+    Returns None when there is no If-Match header or it is *, so that the
+    update is unconditional, and aborts with 412 when no ETag in it can
+    belong to the Product
+    """
+    if not request.if_match or request.if_match.star_tag:
+        return None
+    prefix = '{}-'.format(product_id)
+    for etag in request.if_match:
+        etag = encoding.base_etag(etag)
+        version = etag[len(prefix):]
+        if etag.startswith(prefix) and version.isdigit():
+            return int(version)
+    abort(status.HTTP_412_PRECONDITION_FAILED,
+          'If-Match does not match any version of product {}'.format(product_id))
+
+
+def not_modified(etag, updated=None):
+    """
+    Returns a 304 Not Modified response if the client's copy is current
+
+    If-None-Match takes precedence over If-Modified-Since as in RFC 7232.
+    It matches the ETag of any representation, compressed or not. Lists
+    pass no updated time because deleting a product does not move their
+    last modified time
+    """
+    if request.if_none_match:
+        if not request.if_none_match.star_tag and etag not in \
+                set(encoding.base_etag(tag) for tag in request.if_none_match.as_set()):
+            return None
+    elif updated is None or request.if_modified_since is None or \
+            updated > to_timestamp(request.if_modified_since):
+        return None
+    return Response(status=status.HTTP_304_NOT_MODIFIED)
+
+
+def with_validators(response, etag, updated=None):
+    """ Sets the ETag and Last-Modified headers of a response """
+    response.set_etag(etag)
+    if updated is not None:
+        response.last_modified = updated
+    return response
+
+
+def product_validators(response, product):
+    """ Sets the ETag and Last-Modified headers of a response to a saved Product """
+    validators = product.validators()
+    return with_validators(response, product_etag(product.id, validators['version']),
+                           validators['updated'])
+
+
+def json_response(body, status_code=status.HTTP_200_OK):
+    """
+    Returns JSON that was already encoded by the fast path
+
+    The fast path writes the same compact, sorted and ASCII JSON as jsonify,
+    so when the app is set up to pretty print it is decoded and sent
+    through jsonify instead
+    """
+    config = app.config
+    if config['JSONIFY_PRETTYPRINT_REGULAR'] or \
+            not config['JSON_SORT_KEYS'] or not config['JSON_AS_ASCII']:
+        return make_response(jsonify(json.loads(body)), status_code)
+    return Response(body + '\n', status_code, mimetype=config['JSONIFY_MIMETYPE'])
 
 
 def check_content_type(content_type):
@@ -275,6 +961,60 @@ def initialize_logging(log_level=logging.INFO):
         app.logger.info('Logging handler established')
 
 
+######################################################################
+# GET CACHE STATISTICS
+######################################################################
+@app.route('/cache/stats', methods=['GET'])
+def cache_stats():
+    """ Returns the hit, miss and eviction counters of the product cache """
+    return make_response(jsonify(Products.cache.stats()), status.HTTP_200_OK)
+
+
+######################################################################
+# GET WRITE-BEHIND QUEUE STATISTICS
+######################################################################
+@app.route('/writebehind/stats', methods=['GET'])
+def writebehind_stats():
+    """ Returns the counters of the write-behind queue """
+    return make_response(jsonify(availability_queue.stats()), status.HTTP_200_OK)
+
+
+######################################################################
+# GET CONNECTION POOL STATISTICS
+######################################################################
+@app.route('/pool/stats', methods=['GET'])
+def connection_pool_stats():
+    """ Returns the checkout latency, wait counts and connections in use """
+    stats = pool_stats(db.engine)
+    if Products.replicas:
+        stats['replicas'] = Products.replicas.stats()
+    if db.shards:
+        stats['shards'] = db.shards.stats()
+    return make_response(jsonify(stats), status.HTTP_200_OK)
+
+
+######################################################################
+# GET PROMETHEUS METRICS
+######################################################################
+@app.route('/metrics', methods=['GET'])
+def metrics_endpoint():
+    """ Returns the request metrics of every worker in the Prometheus text format """
+    body, content_type = metrics.collect()
+    return Response(body, status=status.HTTP_200_OK, content_type=content_type)
+
+
+######################################################################
+# GET SQL PROFILES
+######################################################################
+@app.route('/debug/sql', methods=['GET'])
+def sql_profiles():
+    """ Returns the statements run by the most recent requests """
+    if not app.config['SQL_PROFILING']:
+        raise NotFound('SQL profiling is off, set SQL_PROFILING=true to turn it on')
+    repeated = bool_arg('repeated', False)
+    return make_response(jsonify(profiling.profiles(repeated)), status.HTTP_200_OK)
+
+
 ######################################################################
 # GET HEALTH CHECK
 ######################################################################
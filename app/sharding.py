@@ -0,0 +1,334 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Sharded Products
+
+Spreads the products table over the databases in SHARD_URIS. The
+database of SQLALCHEMY_DATABASE_URI stays the home of every other table:
+the change feed, the schema version and the id allocator.
+
+A product lives on shard id % N, so its id is all it takes to find it.
+Ids are handed out by the home database in blocks of SHARD_ID_BLOCK, so
+they are unique across the shards. SHARD_KEY chooses where new products go:
+
+- id: the next id, which spreads products evenly over the shards
+- category: the shard of the category, so that a category is kept
+  together. The id is picked to point at that shard, and a product
+  stays there if its category changes later
+
+The session (app/routing.py) sends the writes of a product to its shard
+and queries that are not about a single product to every shard in
+parallel, merging their rows in the order of the query. The instances
+they load are merged into the session of the query, so they can be
+changed and saved like any other.
+
+db.create_all() and db.drop_all() cover the shards too. When the home
+database has no allocator row, as after it was recreated, the ids start
+past the highest id on the shards.
+"""
+import heapq
+import zlib
+import threading
+from contextlib import contextmanager
+from collections import OrderedDict
+from multiprocessing.pool import ThreadPool
+from sqlalchemy import func, select
+from sqlalchemy.orm import Session
+from sqlalchemy.sql import operators
+from sqlalchemy.sql.elements import UnaryExpression, Label
+from .pool import pool_stats
+
+KEYS = ('id', 'category')
+
+
+class Descending(object):
+    """ A sort key that orders its value from the highest down """
+
+    __slots__ = ('value',)
+
+    def __init__(self, value):
+        self.value = value
+
+    def __eq__(self, other):
+        return self.value == other.value
+
+    def __lt__(self, other):
+        return other.value < self.value
+
+
+def order_names(query):
+    """ Returns (name, descending) for each ORDER BY of a query, by column key or label """
+    names = []
+    for clause in query._order_by or ():
+        element, descending = clause, False
+        if isinstance(element, UnaryExpression) and \
+                element.modifier in (operators.asc_op, operators.desc_op):
+            element, descending = element.element, element.modifier is operators.desc_op
+        name = element.name if isinstance(element, Label) else getattr(element, 'key', None)
+        if name is None:
+            raise NotImplementedError('Cannot merge the shards of ORDER BY {}'.format(clause))
+        names.append((name, descending))
+    return names
+
+
+def row_value(row, name):
+    """ Returns a column of a row, an entity or a tuple of entities and columns """
+    try:
+        return getattr(row, name)
+    except AttributeError:
+        for item in row:
+            if hasattr(item, name):
+                return getattr(item, name)
+        raise
+
+
+def attach(session, row):
+    """ Returns a row with the instances in it merged into session """
+    if hasattr(row, '_sa_instance_state'):
+        return session.merge(row, load=False)
+    if isinstance(row, tuple) and any(hasattr(item, '_sa_instance_state') for item in row):
+        return type(row)([attach(session, item) for item in row])
+    return row
+
+
+def merge(iterators, key):
+    """ Merges iterators that are each sorted by key into one sorted iterator """
+    heap = []
+    for index, iterator in enumerate(iter(iterator) for iterator in iterators):
+        for row in iterator:
+            heap.append((key(row), index, row, iterator))
+            break
+    heapq.heapify(heap)
+    while heap:
+        _, index, row, iterator = heap[0]
+        yield row
+        for row in iterator:
+            heapq.heapreplace(heap, (key(row), index, row, iterator))
+            break
+        else:
+            heapq.heappop(heap)
+
+
+class ShardSet(object):
+    """
+    The shard engines and the ids they own
+
+    Args:
+        engines (list): an engine for each shard, in a fixed order
+        table (Table): the table that is sharded
+        key (str): id or category, what decides the shard of a new row
+        allocate (function): reserves a number of consecutive values and
+            returns the first
+        block_size (int): the number of values reserved at a time
+    """
+
+    def __init__(self, engines=(), table=None, key='id', allocate=None, block_size=100):
+        if key not in KEYS:
+            raise ValueError('SHARD_KEY must be one of ' + ', '.join(KEYS))
+        self.engines = list(engines)
+        self.table = table
+        self.key = key
+        self.allocate = allocate
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.next_value = self.last_value = 0
+        self.pool = None
+        self.queries = 0
+
+    def __len__(self):
+        return len(self.engines)
+
+    ######################################################################
+    #  R O U T I N G
+    ######################################################################
+
+    def for_id(self, row_id):
+        """ Returns the shard of an id, None when there are no shards """
+        return int(row_id) % len(self.engines) if self.engines else None
+
+    def for_category(self, category):
+        """ Returns the shard that keeps a category """
+        return zlib.crc32((category or u'').encode('utf-8')) % len(self.engines)
+
+    def engine(self, shard):
+        """ Returns the engine of a shard """
+        return self.engines[shard]
+
+    def first_value(self):
+        """ Returns the first value to allocate, past the ids that are on the shards """
+        last_id = max([engine.execute(select([func.max(self.table.c.id)])).scalar() or 0
+                       for engine in self.engines] or [0])
+        if self.key == 'category' and self.engines:
+            return last_id // len(self.engines) + 1
+        return last_id + 1
+
+    def discard_ids(self):
+        """ Forgets the block of values of this process, the next id starts a new block """
+        with self.lock:
+            self.next_value = self.last_value = 0
+
+    def new_id(self, category=None):
+        """ Returns a new unique id on the shard that SHARD_KEY chooses """
+        with self.lock:
+            if self.next_value >= self.last_value:
+                self.next_value = self.allocate(self.block_size)
+                self.last_value = self.next_value + self.block_size
+            value = self.next_value
+            self.next_value += 1
+        if self.key == 'category':
+            return value * len(self.engines) + self.for_category(category)
+        return value
+
+    def group(self, items, key=lambda item: item):
+        """ Returns (shard, items) pairs for the items with an id, by shard
+
+        Without shards all of the items are returned with a shard of None
+        """
+        if not self.engines:
+            return [(None, list(items))]
+        groups = OrderedDict()
+        for item in items:
+            groups.setdefault(self.for_id(key(item)), []).append(item)
+        return list(groups.items())
+
+    def each(self):
+        """ Returns every shard, or just None without shards """
+        return list(range(len(self.engines))) or [None]
+
+    @contextmanager
+    def pinned(self, session, shard):
+        """ Sends the statements of session on the sharded table to a shard, None to do nothing """
+        if shard is None:
+            yield
+            return
+        previous = session.info.get('shard')
+        session.info['shard'] = shard
+        try:
+            yield
+        finally:
+            session.info['shard'] = previous
+
+    ######################################################################
+    #  F A N - O U T   Q U E R I E S
+    ######################################################################
+
+    def map(self, function):
+        """ Calls function with a session of each shard in parallel and returns the results in order """
+        def call(shard):
+            session = Session(bind=self.engines[shard])
+            try:
+                return function(session)
+            finally:
+                session.close()
+        if self.pool is None:
+            with self.lock:
+                if self.pool is None:
+                    self.pool = ThreadPool(len(self.engines))
+        self.queries += 1
+        return self.pool.map(call, range(len(self.engines)))
+
+    def fan_out(self, query):
+        """ Runs a query on every shard and returns its rows in the order of the query
+
+        Each shard is asked for the first offset + limit rows, which are
+        merged and cut to the page. Queries without an ORDER BY are merged
+        by id when their rows have one. Streamed queries (yield_per) are
+        read from the shards side by side, everything else in parallel.
+        """
+        session = query.session
+        limit, offset = query._limit, query._offset
+        query = query.limit(None).offset(None)
+        if limit is not None:
+            query = query.limit((offset or 0) + limit)
+        names = order_names(query) or [('id', False)]
+        if query._yield_per:
+            self.queries += 1
+            shards = [self._stream(query, shard) for shard in range(len(self.engines))]
+        else:
+            shards = self.map(lambda session: list(query.with_session(session)))
+        rows = merge(shards, self._sort_key(names, strict=bool(query._order_by)))
+        stop = None if limit is None else (offset or 0) + limit
+        for index, row in enumerate(rows):
+            if stop is not None and index >= stop:
+                break
+            if index >= (offset or 0):
+                yield attach(session, row)
+
+    def count(self, query):
+        """ Returns the number of rows a query matches on every shard """
+        return sum(self.map(lambda session: query.with_session(session).count()))
+
+    def _stream(self, query, shard):
+        """ Yields the rows of a query on one shard, closing its session at the end """
+        session = Session(bind=self.engines[shard])
+        try:
+            for row in query.with_session(session):
+                yield row
+        finally:
+            session.close()
+
+    def _sort_key(self, names, strict):
+        """ Returns the merge key for ORDER BY (name, descending) pairs
+
+        NULL sorts like the database does, last on Postgres and first
+        elsewhere. Rows without the columns of the default id order keep
+        the order of the shards
+        """
+        nulls_last = self.engines[0].dialect.name == 'postgresql'
+
+        def key(row):
+            values = []
+            for name, descending in names:
+                try:
+                    value = row_value(row, name)
+                except AttributeError:
+                    if strict:
+                        raise
+                    return ()
+                value = ((value is None) == nulls_last, value)
+                values.append(Descending(value) if descending else value)
+            return tuple(values)
+        return key
+
+    ######################################################################
+    #  S C H E M A   A N D   S T A T S
+    ######################################################################
+
+    def create_all(self):
+        """ Creates the sharded table and its indexes on every shard that is missing it """
+        for engine in self.engines:
+            self.table.create(engine, checkfirst=True)
+        self.discard_ids()
+
+    def drop_all(self):
+        """ Drops the sharded table from every shard """
+        for engine in self.engines:
+            self.table.drop(engine, checkfirst=True)
+        self.discard_ids()
+
+    def stats(self):
+        """ Returns the fan-out queries and the connection pool of every shard as a dictionary """
+        return {"key": self.key,
+                "fan_out_queries": self.queries,
+                "shards": [dict(pool_stats(engine), url=repr(engine.url))
+                           for engine in self.engines]}
+
+    def dispose(self):
+        """ Closes the connections of every shard and stops the fan-out threads """
+        if self.pool is not None:
+            self.pool.terminate()
+            self.pool = None
+        for engine in self.engines:
+            engine.dispose()
@@ -0,0 +1,129 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Catalog Export and Import Formats
+
+Reads and writes products as NDJSON or CSV one line at a time, so that
+exporting or importing the whole catalog never holds more than a line
+(or a batch) in memory. CSV files have a header row with CSV_COLUMNS.
+"""
+import io
+import csv
+import sys
+import json
+
+PY2 = sys.version_info[0] == 2
+
+# the columns of a CSV export, in order
+CSV_COLUMNS = ('id', 'name', 'category', 'available', 'price')
+TRUE_VALUES = ('true', 't', 'yes', '1')
+FALSE_VALUES = ('false', 'f', 'no', '0')
+
+
+def _text(value):
+    """ Returns a CSV field as text """
+    if value is None:
+        return u''
+    if isinstance(value, bool):
+        return u'true' if value else u'false'
+    if PY2 and isinstance(value, str):
+        return value.decode('utf-8')
+    return value if isinstance(value, type(u'')) else type(u'')(value)
+
+
+def csv_lines(rows):
+    """ Yields a header line and then a CSV line for each tuple of CSV_COLUMNS values """
+    buffer = io.BytesIO() if PY2 else io.StringIO()
+    writer = csv.writer(buffer, lineterminator='\n')
+
+    def line(values):
+        """ Returns the CSV line of a tuple of values """
+        fields = [_text(value) for value in values]
+        writer.writerow([field.encode('utf-8') for field in fields] if PY2 else fields)
+        text = buffer.getvalue()
+        buffer.seek(0)
+        buffer.truncate()
+        return text
+
+    yield line(CSV_COLUMNS)
+    for row in rows:
+        yield line(row)
+
+
+def read_ndjson(lines):
+    """ Yields a dictionary for each line of NDJSON, or None for a line that is not JSON """
+    for line in lines:
+        if isinstance(line, bytes):
+            line = line.decode('utf-8')
+        if not line.strip():
+            continue
+        try:
+            yield json.loads(line)
+        except ValueError:
+            yield None
+
+
+def read_csv(lines):
+    """ Yields a product dictionary for each row of a CSV file with a header row
+
+    Empty fields are None and available is parsed as a boolean. Rows that
+    do not match the header, or whose available is not a boolean, are None
+    """
+    if PY2:
+        reader = csv.reader(lines)
+    else:
+        reader = csv.reader(line.decode('utf-8') if isinstance(line, bytes) else line
+                            for line in lines)
+    header = None
+    for fields in reader:
+        if PY2:
+            fields = [field.decode('utf-8') for field in fields]
+        if not fields:
+            continue
+        if header is None:
+            header = [field.strip().lower() for field in fields]
+            continue
+        if len(fields) != len(header):
+            yield None
+            continue
+        item = dict((key, value if value != '' else None) for key, value in zip(header, fields))
+        available = (item.get('available') or '').lower()
+        if available in TRUE_VALUES:
+            item['available'] = True
+        elif available in FALSE_VALUES:
+            item['available'] = False
+        elif available:
+            yield None
+            continue
+        yield item
+
+
+def copy_line(values):
+    """ Returns a line of Postgres COPY ... WITH (FORMAT csv) for a tuple of values
+
+    Unlike csv.writer it tells None, written as an empty field, from an
+    empty string, written as ""
+    """
+    fields = []
+    for value in values:
+        if value is None:
+            fields.append(u'')
+        elif isinstance(value, bool):
+            fields.append(u't' if value else u'f')
+        elif isinstance(value, (int, float)):
+            fields.append(type(u'')(repr(value)))
+        else:
+            fields.append(u'"' + _text(value).replace(u'"', u'""') + u'"')
+    return u','.join(fields) + u'\n'
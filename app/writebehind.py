@@ -0,0 +1,174 @@
+# Copyright 2016, 2017 John J. Rofrano. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Write-Behind Availability Queue
+
+Coalesces bursts of availability changes. Changes are merged per
+product, the last one wins, and a background thread writes them with
+Products.set_availability() every WRITE_BEHIND_INTERVAL seconds, or as
+soon as WRITE_BEHIND_BATCH products are waiting. WRITE_BEHIND chooses
+what a request waits for:
+
+- off: nothing is queued, every change is its own UPDATE and commit
+- group: the request waits until the batch holding its change is
+  committed, so an answer still means the change is durable, but one
+  commit serves every request in the batch
+- async: the request is answered as soon as the change is queued.
+  Changes still in the queue are lost if the process is killed, and
+  so are the batches that fail to be written. A batch of the queue is
+  committed in parts, and the changes of the parts committed before a
+  failure are reported as written
+
+Each change carries the version the product was at when it was queued
+and is only written if the product is still at it, so a change never
+overwrites a write made after it was queued: it is dropped instead.
+
+The queue is flushed by close(), which runs at exit and from the
+gunicorn worker_exit hook.
+"""
+import time
+import atexit
+import logging
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger(__name__)
+
+
+class PendingChange(object):
+    """ A queued change that a request can wait for """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.found = None    # whether the product was found at its version and written
+        self.failed = False  # True if the batch could not be written
+
+    def wait(self, timeout=None):
+        """ Waits for the change to be written, returns False if it was not in time """
+        return self.done.wait(timeout)
+
+
+class AvailabilityQueue(object):
+    """
+    Merges availability changes per product and writes them in batches
+
+    Args:
+        app (Flask): the app whose database the changes are written to
+        write (function): called in an app context with a dictionary of
+            availability by product id, one of the version each product
+            must still be at and a set it adds the ids to as it commits
+            them, like Products.set_availability()
+        interval (float): the most seconds a change waits to be written
+        batch_size (int): the number of products that triggers a write
+    """
+
+    def __init__(self, app, write, interval=0.05, batch_size=500):
+        self.app = app
+        self.write = write
+        self.interval = interval
+        self.batch_size = batch_size
+        self.changes = OrderedDict()   # product id -> (available, version, [PendingChange])
+        self.condition = threading.Condition()
+        self.thread = None
+        self.closed = False
+        self.registered = False
+        self.flushes = 0
+        self.written = 0
+        self.merged = 0
+        self.failures = 0
+
+    def put(self, product_id, available, version):
+        """ Queues a change to a product read at a version and returns a PendingChange for it """
+        pending = PendingChange()
+        with self.condition:
+            if self.thread is None:
+                self._start()
+            if product_id in self.changes:
+                self.merged += 1
+                waiters = self.changes.pop(product_id)[2]
+            else:
+                waiters = []
+            waiters.append(pending)
+            self.changes[product_id] = (available, version, waiters)
+            if len(self.changes) >= self.batch_size:
+                self.condition.notify()
+        return pending
+
+    def flush(self):
+        """ Writes every queued change now, returns the number of products written """
+        with self.condition:
+            changes, self.changes = self.changes, OrderedDict()
+        if not changes:
+            return 0
+        found, failed = set(), False
+        try:
+            with self.app.app_context():
+                self.write(dict((product_id, available)
+                                for product_id, (available, _, _) in changes.items()),
+                           dict((product_id, version)
+                                for product_id, (_, version, _) in changes.items()), found)
+        except Exception:   # the thread must survive a database outage
+            # the changes not committed yet are dropped, their group requests answer with an error
+            failed = True
+            self.failures += 1
+            logger.exception('Failed to write %s availability changes', len(changes))
+        self.flushes += 1
+        self.written += len(found)
+        for product_id, (_, _, waiters) in changes.items():
+            for pending in waiters:
+                pending.found = product_id in found
+                pending.failed = failed and not pending.found
+                pending.done.set()
+        return len(found)
+
+    def close(self):
+        """ Stops the background thread and writes what is left in the queue """
+        with self.condition:
+            self.closed = True
+            self.condition.notify()
+        thread, self.thread = self.thread, None
+        if thread is not None:
+            thread.join()
+        self.flush()
+
+    def stats(self):
+        """ Returns the queue counters as a dictionary """
+        return {"queued": len(self.changes),
+                "flushes": self.flushes,
+                "written": self.written,
+                "merged": self.merged,
+                "failures": self.failures}
+
+    def _start(self):
+        """ Starts the background thread, called with the condition held """
+        self.closed = False
+        self.thread = threading.Thread(target=self._run, name='availability-queue')
+        self.thread.daemon = True
+        self.thread.start()
+        if not self.registered:
+            atexit.register(self.close)
+            self.registered = True
+
+    def _run(self):
+        """ Writes the queued changes every interval, or sooner when a batch is full """
+        while True:
+            with self.condition:
+                deadline = time.time() + self.interval
+                while not self.closed and len(self.changes) < self.batch_size and \
+                        time.time() < deadline:
+                    self.condition.wait(deadline - time.time())
+                if self.closed:
+                    return
+            self.flush()
@@ -0,0 +1,6 @@
+"""
+Benchmarks for the Products Service
+
+Benchmarks are not part of the test suite, run them as modules e.g.:
+  python -m benchmarks.serialization
+"""
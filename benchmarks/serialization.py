@@ -0,0 +1,77 @@
+"""
+Serialization Benchmark
+
+Compares the two ways of turning a list of Products into a JSON response:
+
+  orm  - load Products instances, serialize() each one and jsonify() the list
+  fast - select plain tuples with rows() and encode them with encode_row()
+
+Run with:
+  python -m benchmarks.serialization [count] [repeat]
+
+The products are seeded into BENCH_DATABASE_URI (a SQLite file by default)
+"""
+import os
+import sys
+import time
+
+os.environ['DATABASE_URI'] = os.getenv('BENCH_DATABASE_URI', 'sqlite:///../db/bench.db')
+
+from flask import jsonify
+from app import create_app
+from app.models import Products, db
+
+
+def seed(count):
+    """ Fills the products table with count products """
+    db.drop_all()
+    db.create_all()
+    categories = ['Television', 'T-Shirt', 'Table', 'Helicopter']
+    items = [{"name": "Product {}".format(i),
+              "category": categories[i % len(categories)],
+              "available": i % 3 != 0,
+              "price": round(i * 1.37 % 3000, 2)} for i in range(count)]
+    Products.bulk_create(items)
+
+
+def orm_path():
+    """ Serializes the products the way list_products used to """
+    products = Products.query.order_by(Products.id).all()
+    return jsonify([product.serialize() for product in products]).get_data()
+
+
+def fast_path():
+    """ Serializes the products with the columnar fast path """
+    rows = Products.rows(Products.query.order_by(Products.id))
+    return '[' + ','.join(Products.encode_row(row) for row in rows) + ']\n'
+
+
+def best_time(function, repeat):
+    """ Returns the fastest of repeat runs of function in seconds """
+    times = []
+    for _ in range(repeat):
+        db.session.remove()
+        start = time.time()
+        function()
+        times.append(time.time() - start)
+    return min(times)
+
+
+def main(count=10000, repeat=5):
+    """ Runs the benchmark and prints the results """
+    app = create_app()
+    seed(count)
+    with app.test_request_context():
+        if orm_path() != fast_path():
+            sys.exit('The fast path output differs from jsonify(serialize())')
+        print('Serializing {} products, best of {} runs'.format(count, repeat))
+        results = [(name, best_time(function, repeat))
+                   for name, function in [('orm', orm_path), ('fast', fast_path)]]
+    for name, seconds in results:
+        print('{:>6}: {:8.1f} ms {:12.0f} rows/s'.format(name, seconds * 1000, count / seconds))
+    print('speedup: {:.1f}x'.format(results[0][1] / results[1][1]))
+    db.drop_all()
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:3]])
@@ -0,0 +1,59 @@
+"""
+Startup Benchmark
+
+Measures how long a fresh process takes to import the app, and then to
+boot it with create_app() with and without the schema check, the way a
+gunicorn worker starts. Each measurement runs in its own interpreter so
+that nothing is already imported.
+
+Run with:
+  python -m benchmarks.startup [runs]
+
+The schema is checked against BENCH_DATABASE_URI (a SQLite file by default)
+"""
+import os
+import sys
+import subprocess
+
+DATABASE_URI = os.getenv('BENCH_DATABASE_URI', 'sqlite:///../db/bench.db')
+
+# each script prints the seconds it took
+IMPORT = """
+import time
+started = time.time()
+import app
+print(time.time() - started)
+"""
+BOOT = """
+import time
+from app import create_app
+started = time.time()
+create_app(check_schema={})
+print(time.time() - started)
+"""
+
+
+def measure(script, runs):
+    """ Returns the median seconds of a script over runs fresh interpreters """
+    env = dict(os.environ, DATABASE_URI=DATABASE_URI)
+    times = []
+    with open(os.devnull, 'w') as devnull:
+        for _ in range(runs):
+            output = subprocess.check_output([sys.executable, '-c', script],
+                                             env=env, stderr=devnull)
+            times.append(float(output.strip().splitlines()[-1]))
+    return sorted(times)[len(times) // 2]
+
+
+def main(runs=5):
+    """ Runs the benchmark and prints the results """
+    measure(BOOT.format(True), 1)   # create the schema first
+    print('Median of {} runs'.format(runs))
+    for name, script in [('import', IMPORT),
+                         ('boot without schema check', BOOT.format(False)),
+                         ('boot with schema check', BOOT.format(True))]:
+        print('{:>26}: {:7.1f} ms'.format(name, measure(script, runs) * 1000))
+
+
+if __name__ == '__main__':
+    main(*[int(arg) for arg in sys.argv[1:2]])
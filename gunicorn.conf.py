@@ -0,0 +1,62 @@
+"""
+Gunicorn configuration
+
+Run with:
+  gunicorn -c gunicorn.conf.py 'app:create_app()'
+
+The master checks the database schema once before it forks the workers,
+which then boot without running any DDL.
+
+Set prometheus_multiproc_dir to an empty directory to have /metrics
+report the requests of every worker rather than just the one serving it.
+
+A worker writes the availability changes it still holds in its
+write-behind queue before it exits.
+
+GET /products/changes holds a request open for up to CHANGES_MAX_WAIT
+seconds, and a server-sent events stream for CHANGES_STREAM_SECONDS, so
+each worker serves requests on GUNICORN_THREADS threads. With gevent
+workers (-k gevent and run_async:create_app(), see run_async.py) a wait
+only holds a greenlet. On single threaded sync workers, where one wait
+would block every other request of the worker, the change feed answers
+at once and streams end after the changes already there.
+"""
+import os
+import time
+
+bind = '0.0.0.0:5000'
+workers = int(os.getenv('WEB_CONCURRENCY', '2'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+threads = int(os.getenv('GUNICORN_THREADS', '16'))
+# greenlets per gevent worker
+worker_connections = int(os.getenv('ASYNC_CONNECTIONS', '1000'))
+
+
+def on_starting(server):
+    """ Creates and migrates the schema once for every worker """
+    if server.cfg.worker_class_str == 'sync':
+        # the workers inherit the environment and read it into the app config
+        server.log.warning('Sync workers: the change feed does not wait for changes')
+        os.environ['CHANGES_MAX_WAIT'] = '0'
+        os.environ['CHANGES_STREAM_SECONDS'] = '0'
+    if os.getenv('SCHEMA_CHECK', 'true').lower() != 'true':
+        return
+    from app import check_schema
+    started = time.time()
+    version = check_schema()
+    server.log.info('Schema at version %s, checked in %.3fs', version, time.time() - started)
+    # the workers inherit the environment and skip the check
+    os.environ['SCHEMA_CHECK'] = 'false'
+
+
+def child_exit(server, worker):
+    """ Drops the live gauges of a worker that exits, its counters are kept """
+    if os.getenv('prometheus_multiproc_dir'):
+        from prometheus_client import multiprocess
+        multiprocess.mark_process_dead(worker.pid)
+
+
+def worker_exit(server, worker):
+    """ Writes the availability changes a worker still holds before it exits """
+    from app import service
+    service.availability_queue.close()
@@ -0,0 +1,52 @@
+"""
+Product Service Async Runner
+
+Serves the same app from a single process with gevent: every request
+runs in a greenlet and the sockets of the database driver, Redis and the
+clients are cooperative, so a request waiting on the database yields to
+the others instead of pinning a worker. Hundreds of requests can be in
+flight while at most DB_POOL_SIZE + DB_MAX_OVERFLOW of them use a
+database connection and the rest wait for one in the pool.
+
+Run it standalone:
+  python run_async.py
+
+Or under gunicorn with gevent workers:
+  gunicorn -c gunicorn.conf.py -k gevent --worker-connections 1000 'run_async:create_app()'
+
+Only drivers that do their I/O through Python sockets, or that support
+wait callbacks like psycopg2, are cooperative. The DB2 driver (ibm_db)
+blocks the whole process while a statement runs, so use Postgres for
+DATABASE_URI when serving this way.
+"""
+# patch the standard library before anything else imports it
+from gevent import monkey
+monkey.patch_all()
+from psycogreen.gevent import patch_psycopg
+patch_psycopg()
+
+import os
+from gevent.pool import Pool
+from gevent.pywsgi import WSGIServer
+from app import app, create_app
+
+# Pull options from environment
+PORT = os.getenv('PORT', '5000')
+# Requests served at the same time, the rest wait in the listen backlog
+ASYNC_CONNECTIONS = int(os.getenv('ASYNC_CONNECTIONS', '1000'))
+
+
+def make_server(host='0.0.0.0', port=int(PORT), connections=ASYNC_CONNECTIONS):
+    """ Returns a gevent WSGI server for the app that runs up to connections greenlets """
+    return WSGIServer((host, port), app, spawn=Pool(connections), log=None)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == "__main__":
+    print("****************************************")
+    print(" P R O D U C T   S E R V I C E   R U N N I N G   A S Y N C")
+    print("****************************************")
+    create_app()
+    make_server().serve_forever()
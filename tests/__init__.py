@@ -1,2 +1,14 @@
 from tests.test_products import TestProducts
 from tests.test_server import TestProductsServer
+from tests.test_migrations import TestMigrations
+from tests.test_cache import TestLRUCache, TestRedisCache
+from tests.test_pool import TestConnectionPool
+from tests.test_metrics import TestMetrics
+from tests.test_profiling import TestProfiling
+from tests.test_search import TestSearchIndex
+from tests.test_app import TestAppFactory
+from tests.test_transfer import TestTransfer
+from tests.test_encoding import TestEncoding
+from tests.test_writebehind import TestAvailabilityQueue
+from tests.test_replicas import TestReplicas
+from tests.test_sharding import TestSharding, TestShardedProducts, TestShardedServer
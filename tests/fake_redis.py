@@ -0,0 +1,167 @@
+"""
+Fake Redis Server for testing
+
+A small in-memory server that speaks enough of the Redis protocol for
+the RedisCache: PING, GET, MGET, SET (with EX), DEL, INCR(BY), SCAN, FLUSHDB,
+PUBLISH, SUBSCRIBE and UNSUBSCRIBE. Start one per test with:
+
+    server = FakeRedisServer()
+    server.start()
+    cache = RedisCache(server.url)
+    ...
+    server.stop()
+"""
+import time
+import fnmatch
+import threading
+try:
+    import socketserver
+except ImportError:
+    import SocketServer as socketserver
+
+
+def encode(value):
+    """ Encodes a reply in the Redis protocol """
+    if value is None:
+        return b'$-1\r\n'
+    if isinstance(value, bool):
+        return b'+OK\r\n'
+    if isinstance(value, int):
+        return b':%d\r\n' % value
+    if isinstance(value, list):
+        return b'*%d\r\n' % len(value) + b''.join(encode(item) for item in value)
+    return b'$%d\r\n%s\r\n' % (len(value), value)
+
+
+class FakeRedisHandler(socketserver.StreamRequestHandler):
+    """ Serves the commands of one client connection """
+
+    def setup(self):
+        socketserver.StreamRequestHandler.setup(self)
+        self.write_lock = threading.Lock()
+        self.channels = set()
+
+    def send(self, data):
+        """ Writes a reply, pushes from PUBLISH may come from other threads """
+        with self.write_lock:
+            self.wfile.write(data)
+            self.wfile.flush()
+
+    def read_command(self):
+        """ Reads one command as a list of bulk strings """
+        line = self.rfile.readline()
+        if not line:
+            return None
+        args = []
+        for _ in range(int(line[1:])):
+            length = int(self.rfile.readline()[1:])
+            args.append(self.rfile.read(length + 2)[:-2])
+        return args
+
+    def handle(self):
+        server = self.server
+        try:
+            while True:
+                args = self.read_command()
+                if args is None:
+                    break
+                self.send(server.execute(self, args[0].upper(), args[1:]))
+        finally:
+            with server.lock:
+                for channel in self.channels:
+                    server.subscribers[channel].discard(self)
+
+
+class FakeRedisServer(socketserver.ThreadingTCPServer):
+    """ In-memory Redis server listening on a free localhost port """
+    daemon_threads = True
+    allow_reuse_address = True
+
+    def __init__(self):
+        socketserver.ThreadingTCPServer.__init__(self, ('127.0.0.1', 0), FakeRedisHandler)
+        self.lock = threading.RLock()
+        self.data = {}
+        self.expires = {}
+        self.subscribers = {}
+        self.thread = None
+
+    @property
+    def url(self):
+        """ The Redis URL to connect to this server """
+        return 'redis://{}:{}/0'.format(*self.server_address)
+
+    def start(self):
+        """ Serves clients in a background thread """
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def stop(self):
+        """ Stops serving and closes the listening socket """
+        if self.thread is not None:
+            self.shutdown()
+            self.thread = None
+        self.server_close()
+
+    def _get(self, key):
+        expires = self.expires.get(key)
+        if expires is not None and expires < time.time():
+            self.data.pop(key, None)
+            self.expires.pop(key, None)
+        return self.data.get(key)
+
+    def execute(self, client, command, args):
+        """ Runs one command and returns the encoded reply """
+        with self.lock:
+            if command == b'PING':
+                return b'+PONG\r\n'
+            if command == b'GET':
+                return encode(self._get(args[0]))
+            if command == b'MGET':
+                return encode([self._get(key) for key in args])
+            if command == b'SET':
+                self.data[args[0]] = args[1]
+                self.expires.pop(args[0], None)
+                if len(args) > 3 and args[2].upper() == b'EX':
+                    self.expires[args[0]] = time.time() + int(args[3])
+                return encode(True)
+            if command == b'DEL':
+                count = 0
+                for key in args:
+                    if self._get(key) is not None:
+                        count += 1
+                    self.data.pop(key, None)
+                return encode(count)
+            if command in (b'INCR', b'INCRBY'):
+                value = int(self._get(args[0]) or 0) + (int(args[1]) if args[1:] else 1)
+                self.data[args[0]] = str(value).encode()
+                return encode(value)
+            if command == b'SCAN':
+                pattern = args[args.index(b'MATCH') + 1] if b'MATCH' in args else b'*'
+                keys = [key for key in list(self.data)
+                        if self._get(key) is not None and fnmatch.fnmatchcase(key, pattern)]
+                return encode([b'0', keys])
+            if command == b'FLUSHDB':
+                self.data.clear()
+                self.expires.clear()
+                return encode(True)
+            if command == b'PUBLISH':
+                receivers = list(self.subscribers.get(args[0], ()))
+                for receiver in receivers:
+                    receiver.send(encode([b'message', args[0], args[1]]))
+                return encode(len(receivers))
+            if command == b'SUBSCRIBE':
+                replies = []
+                for channel in args:
+                    self.subscribers.setdefault(channel, set()).add(client)
+                    client.channels.add(channel)
+                    replies.append(encode([b'subscribe', channel, len(client.channels)]))
+                return b''.join(replies)
+            if command == b'UNSUBSCRIBE':
+                replies = []
+                for channel in args or list(client.channels):
+                    self.subscribers.get(channel, set()).discard(client)
+                    client.channels.discard(channel)
+                    replies.append(encode([b'unsubscribe', channel, len(client.channels)]))
+                return b''.join(replies)
+            return b'-ERR unknown command\r\n'
@@ -15,6 +15,12 @@ class ProductFactory(factory.Factory):
     available = FuzzyChoice(choices=[True, False])
     price = FuzzyChoice(choices=[34.12, 0.99, 12, 18.1231, 3000, 3000.12])
 
+class ProductDataFactory(ProductFactory):
+    """ Creates fake product dictionaries without an id, e.g. to seed a database """
+    class Meta:
+        model = dict
+        exclude = ('id',)
+
 if __name__ == '__main__':
     for _ in range(10):
         product = ProductFactory()
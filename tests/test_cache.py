@@ -0,0 +1,220 @@
+"""
+Test cases for the Product Cache
+
+Test cases can be run with:
+  pytest tests/test_cache.py
+"""
+
+import time
+import unittest
+import mock
+from app.cache import LRUCache, RedisCache, make_cache
+from .fake_redis import FakeRedisServer
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLRUCache(unittest.TestCase):
+    """ Test Cases for LRUCache """
+
+    def test_get_and_set(self):
+        """ Store and read back a value """
+        cache = LRUCache(maxsize=2)
+        self.assertEqual(cache.get(1), None)
+        cache.set(1, {"name": "Television"})
+        self.assertEqual(cache.get(1), {"name": "Television"})
+        stats = cache.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+        self.assertEqual(stats['size'], 1)
+
+    def test_get_and_set_many(self):
+        """ Store and read back several values at once """
+        cache = LRUCache()
+        cache.set_many({1: 'one', 2: 'two'})
+        self.assertEqual(cache.get_many([1, 2, 3]), {1: 'one', 2: 'two'})
+        self.assertEqual(cache.stats()['hits'], 2)
+        self.assertEqual(cache.stats()['misses'], 1)
+
+    def test_evict_least_recently_used(self):
+        """ Evict the least recently used entry when full """
+        cache = LRUCache(maxsize=2)
+        cache.set(1, 'one')
+        cache.set(2, 'two')
+        cache.get(1)
+        cache.set(3, 'three')
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual(cache.get(1), 'one')
+        self.assertEqual(cache.get(3), 'three')
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    @mock.patch('app.cache.time.time')
+    def test_expire_entries(self, time_mock):
+        """ Expire entries after their time to live """
+        time_mock.return_value = 1000
+        cache = LRUCache(ttl=10)
+        cache.set(1, 'one')
+        time_mock.return_value = 1005
+        self.assertEqual(cache.get(1), 'one')
+        time_mock.return_value = 1011
+        self.assertEqual(cache.get(1), None)
+        self.assertEqual(cache.stats()['evictions'], 1)
+
+    def test_delete_and_clear(self):
+        """ Invalidate one entry and then all of them """
+        cache = LRUCache()
+        cache.set(1, 'one')
+        cache.set(2, 'two')
+        cache.delete(1)
+        self.assertEqual(cache.get(1), None)
+        cache.clear()
+        self.assertEqual(cache.get(2), None)
+        self.assertEqual(cache.stats()['size'], 0)
+
+    def test_set_after_invalidation(self):
+        """ Drop a value read before an invalidation """
+        cache = LRUCache()
+        generation = cache.generation()
+        cache.invalidate(1)
+        cache.set(1, 'stale', generation)
+        cache.set_many({2: 'stale'}, generation)
+        self.assertEqual(cache.get_many([1, 2]), {})
+        cache.set(1, 'fresh', cache.generation())
+        self.assertEqual(cache.get(1), 'fresh')
+
+    def test_disabled(self):
+        """ A cache with no size stores nothing """
+        cache = LRUCache(maxsize=0)
+        cache.set(1, 'one')
+        self.assertEqual(cache.get(1), None)
+
+
+class TestRedisCache(unittest.TestCase):
+    """ Test Cases for RedisCache against a fake Redis server """
+
+    def setUp(self):
+        self.server = FakeRedisServer()
+        self.server.start()
+        self.caches = []
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        self.server.stop()
+
+    def _make_cache(self, local=None):
+        cache = RedisCache(self.server.url, ttl=60, local=local)
+        self.caches.append(cache)
+        return cache
+
+    def _wait_for(self, condition):
+        """ Waits up to 5 seconds for an invalidation to be delivered """
+        deadline = time.time() + 5
+        while not condition() and time.time() < deadline:
+            time.sleep(0.01)
+        return condition()
+
+    def test_shared_between_workers(self):
+        """ Entries stored by one worker are seen by another """
+        worker1 = self._make_cache()
+        worker2 = self._make_cache()
+        self.assertEqual(worker2.get('product:1'), None)
+        worker1.set('product:1', {"name": "Television"})
+        self.assertEqual(worker2.get('product:1'), {"name": "Television"})
+        worker1.invalidate('product:1')
+        self.assertEqual(worker2.get('product:1'), None)
+        stats = worker2.stats()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 2)
+
+    def test_get_and_set_many(self):
+        """ Read several entries in one round trip, local ones first """
+        worker1 = self._make_cache()
+        worker2 = self._make_cache(LRUCache())
+        worker1.set_many({'product:1': 'one', 'product:2': 'two'})
+        worker2.local.set('product:3', 'three')
+        self.assertEqual(worker2.get_many(['product:1', 'product:3', 'product:4']),
+                         {'product:1': 'one', 'product:3': 'three'})
+        self.assertEqual(worker2.local.get('product:1'), 'one')
+        self.assertEqual(worker2.stats()['misses'], 1)
+        self.assertEqual(worker2.get_many(['product:3']), {'product:3': 'three'})
+
+    def test_invalidate_generation(self):
+        """ Any invalidation retires the cached lists """
+        cache = self._make_cache()
+        generation = cache.generation()
+        cache.invalidate()
+        self.assertNotEqual(cache.generation(), generation)
+
+    def test_set_after_invalidation(self):
+        """ Drop a value read before another worker invalidated it """
+        worker1 = self._make_cache(LRUCache())
+        worker2 = self._make_cache()
+        generation = worker1.generation()
+        worker2.invalidate('product:1')
+        worker1.set('product:1', 'stale', generation)
+        self.assertEqual(worker2.get('product:1'), None)
+        self.assertEqual(worker1.get('product:1'), None)
+        worker1.set('product:1', 'fresh', worker1.generation())
+        self.assertEqual(worker2.get('product:1'), 'fresh')
+
+    def test_read_during_invalidation(self):
+        """ Keep a value out of the local cache when it is invalidated while Redis is read """
+        worker1 = self._make_cache(LRUCache())
+        worker1.set_many({'product:1': 'old', 'product:2': 'old'})
+        worker1.local.clear()
+        client = worker1.client
+
+        def invalidated(read):
+            """ Runs a Redis read, then the invalidation published by another worker """
+            def call(*args):
+                data = read(*args)
+                worker1.local.invalidate('product:1', 'product:2')
+                return data
+            return call
+        with mock.patch.object(client, 'get', invalidated(client.get)), \
+                mock.patch.object(client, 'mget', invalidated(client.mget)):
+            self.assertEqual(worker1.get('product:1'), 'old')
+            self.assertEqual(worker1.get_many(['product:2']), {'product:2': 'old'})
+        self.assertEqual(worker1.local.get_many(['product:1', 'product:2']), {})
+
+    def test_invalidations_published_to_local_caches(self):
+        """ Writes in one worker drop stale local entries in the others """
+        worker1 = self._make_cache(LRUCache())
+        worker2 = self._make_cache(LRUCache())
+        worker1.set('product:1', 'old')
+        self.assertEqual(worker2.get('product:1'), 'old')
+        self.assertEqual(worker2.local.get('product:1'), 'old')
+        worker1.invalidate('product:1')
+        self.assertTrue(self._wait_for(lambda: worker2.local.get('product:1') is None))
+        worker2.set('product:2', 'two')
+        worker1.clear()
+        self.assertTrue(self._wait_for(lambda: worker2.local.stats()['size'] == 0))
+        self.assertEqual(worker2.get('product:2'), None)
+
+    def test_server_down(self):
+        """ Redis failures are treated as cache misses """
+        cache = make_cache('redis', self.server.url, maxsize=0)
+        self.caches.append(cache)
+        self.server.stop()
+        cache.set('product:1', 'one')
+        self.assertEqual(cache.get('product:1'), None)
+        self.assertEqual(cache.generation(), None)
+        cache.invalidate('product:1')
+        cache.clear()
+        self.assertEqual(cache.stats()['errors'], 5)
+
+    def test_make_cache(self):
+        """ Create caches from the configuration """
+        self.assertTrue(isinstance(make_cache('local'), LRUCache))
+        cache = make_cache('redis', self.server.url)
+        self.caches.append(cache)
+        self.assertTrue(isinstance(cache.local, LRUCache))
+        self.assertRaises(ValueError, make_cache, 'memcached')
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
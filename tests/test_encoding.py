@@ -0,0 +1,120 @@
+"""
+Test cases for the Response Encodings
+
+Test cases can be run with:
+  pytest tests/test_encoding.py
+"""
+
+import os
+import gzip
+import json
+import unittest
+from io import BytesIO
+import brotli
+import msgpack
+from flask_api import status    # HTTP Status Codes
+import app.service as service
+from app.models import Products, db
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestEncoding(unittest.TestCase):
+    """ Test Cases for response compression and negotiated encodings """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all tests """
+        service.app.debug = False
+        service.app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        service.init_db()
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # create new tables
+        for number in range(50):
+            Products(name='Product {}'.format(number), category='Catalog',
+                     available=True, price=number).save()
+        self.app = service.app.test_client()
+
+    def tearDown(self):
+        service.app.debug = False
+        db.session.remove()
+        db.drop_all()
+
+    def test_gzip(self):
+        """ Compress a large list with gzip """
+        plain = self.app.get('/products')
+        self.assertNotIn('Content-Encoding', plain.headers)
+        self.assertIn('Accept-Encoding', plain.headers['Vary'])
+        resp = self.app.get('/products', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertTrue(resp.content_length < plain.content_length)
+        body = gzip.GzipFile(fileobj=BytesIO(resp.get_data())).read()
+        self.assertEqual(body, plain.get_data())
+
+    def test_brotli_preferred(self):
+        """ Compress with brotli when the client accepts it """
+        plain = self.app.get('/products')
+        resp = self.app.get('/products', headers={'Accept-Encoding': 'gzip, deflate, br'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'br')
+        self.assertEqual(brotli.decompress(resp.get_data()), plain.get_data())
+        resp = self.app.get('/products', headers={'Accept-Encoding': 'gzip, br;q=0'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+
+    def test_etag_per_representation(self):
+        """ Give each encoding its own ETag and revalidate any of them """
+        plain = self.app.get('/products').headers['ETag']
+        gzipped = self.app.get('/products', headers={'Accept-Encoding': 'gzip'}).headers['ETag']
+        packed = self.app.get('/products', headers={'Accept': 'application/msgpack',
+                                                    'Accept-Encoding': 'br'}).headers['ETag']
+        self.assertEqual(gzipped, plain[:-1] + '-gzip"')
+        self.assertEqual(packed, plain[:-1] + '-msgpack-br"')
+        for etag in (plain, gzipped, packed):
+            resp = self.app.get('/products', headers={'If-None-Match': etag,
+                                                      'Accept-Encoding': 'gzip'})
+            self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        product = Products.all()[0]
+        resp = self.app.put('/products/{}'.format(product.id), json=product.serialize(),
+                            headers={'If-Match': '"{}-1-gzip"'.format(product.id)})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+
+    def test_small_responses(self):
+        """ Send small responses uncompressed """
+        product = Products.all()[0]
+        resp = self.app.get('/products/{}'.format(product.id),
+                            headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn('Content-Encoding', resp.headers)
+
+    def test_streamed(self):
+        """ Compress a streamed export as it is streamed """
+        plain = self.app.get('/products/export').get_data()
+        resp = self.app.get('/products/export', headers={'Accept-Encoding': 'gzip'})
+        self.assertEqual(resp.headers['Content-Encoding'], 'gzip')
+        self.assertEqual(gzip.GzipFile(fileobj=BytesIO(resp.get_data())).read(), plain)
+
+    def test_compact_json(self):
+        """ Write JSON without whitespace even in debug mode """
+        service.app.debug = True
+        body = self.app.get('/products').get_data(as_text=True)
+        self.assertNotIn('\n ', body)
+        self.assertNotIn(', "', body)
+        product = Products.all()[0]
+        body = self.app.get('/products/{}'.format(product.id)).get_data(as_text=True)
+        self.assertEqual(body.strip(), json.dumps(product.serialize(), sort_keys=True,
+                                                  separators=(',', ':')))
+
+    def test_msgpack(self):
+        """ Send JSON as MessagePack to clients that prefer it """
+        plain = self.app.get('/products')
+        resp = self.app.get('/products', headers={'Accept': 'application/msgpack'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/msgpack')
+        self.assertIn('Accept', resp.headers['Vary'])
+        self.assertEqual(msgpack.unpackb(resp.get_data(), raw=False), plain.get_json())
+        resp = self.app.get('/products', headers={'Accept': 'application/json, application/msgpack;q=0.5'})
+        self.assertEqual(resp.mimetype, 'application/json')
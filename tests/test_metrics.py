@@ -0,0 +1,121 @@
+"""
+Test cases for the Request Metrics
+
+Test cases can be run with:
+  pytest tests/test_metrics.py
+"""
+
+import os
+import shutil
+import tempfile
+import unittest
+import mock
+from flask_api import status    # HTTP Status Codes
+from prometheus_client import REGISTRY
+from sqlalchemy.exc import DBAPIError
+import app.service as service
+from app import metrics
+from app.models import Products, db
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMetrics(unittest.TestCase):
+    """ Test Cases for the /metrics endpoint """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all tests """
+        service.app.debug = False
+        service.app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        service.init_db()
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # create new tables
+        self.app = service.app.test_client()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def _sample(self, name, **labels):
+        return REGISTRY.get_sample_value(name, labels) or 0
+
+    def test_request_latency_by_route(self):
+        """ Count requests by route rule and status, not by URL """
+        product = Products(name="Radio", category="Electronics", available=True, price=20)
+        product.save()
+        labels = dict(method='GET', route='/products/<int:product_id>', status='200')
+        count = self._sample('http_request_duration_seconds_count', **labels)
+        self.app.get('/products/{}'.format(product.id))
+        self.app.get('/products/{}'.format(product.id))
+        self.assertEqual(self._sample('http_request_duration_seconds_count', **labels),
+                         count + 2)
+        labels['status'] = '404'
+        missing = self._sample('http_request_duration_seconds_count', **labels)
+        self.app.get('/products/0')
+        self.assertEqual(self._sample('http_request_duration_seconds_count', **labels),
+                         missing + 1)
+        unmatched = dict(method='GET', route='unmatched', status='404')
+        before = self._sample('http_request_duration_seconds_count', **unmatched)
+        self.app.get('/no/such/page')
+        self.assertEqual(self._sample('http_request_duration_seconds_count', **unmatched),
+                         before + 1)
+
+    def test_response_size_and_queries(self):
+        """ Observe the response size and SQL statements of a request """
+        Products(name="Radio", category="Electronics", available=True, price=20).save()
+        size = self._sample('http_response_size_bytes_sum',
+                            method='GET', route='/products', status='200')
+        queries = self._sample('db_queries_per_request_sum', method='GET', route='/products')
+        resp = self.app.get('/products')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(self._sample('http_response_size_bytes_sum',
+                                      method='GET', route='/products', status='200'),
+                         size + len(resp.data))
+        self.assertTrue(self._sample('db_queries_per_request_sum',
+                                     method='GET', route='/products') > queries)
+        self.assertTrue(self._sample('db_query_duration_seconds_count',
+                                     method='GET', route='/products') > 0)
+
+    def test_failed_query(self):
+        """ Forget the start time of a statement that raised """
+        with db.engine.connect() as connection:
+            self.assertRaises(DBAPIError, connection.execute, 'SELECT * FROM no_such_table')
+            self.assertEqual(connection.info['query_start'], [])
+            connection.execute('SELECT 1')
+            self.assertEqual(connection.info['query_start'], [])
+
+    def test_metrics_endpoint(self):
+        """ Expose the metrics in the Prometheus text format """
+        self.app.get('/healthcheck')
+        resp = self.app.get('/metrics')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertTrue(resp.content_type.startswith('text/plain'))
+        self.assertIn(b'http_request_duration_seconds_bucket{', resp.data)
+        self.assertIn(b'route="/healthcheck"', resp.data)
+        self.assertNotIn(b'route="/metrics"', resp.data)
+
+    def test_multiprocess_collection(self):
+        """ Read the samples of every worker from the multiprocess directory """
+        directory = tempfile.mkdtemp()
+        try:
+            with mock.patch.dict('os.environ', {'prometheus_multiproc_dir': directory}):
+                with mock.patch('prometheus_client.multiprocess.MultiProcessCollector') \
+                        as collector:
+                    body, content_type = metrics.collect()
+            self.assertEqual(collector.call_count, 1)
+            self.assertNotIn(b'http_request_duration_seconds', body)
+            self.assertTrue(content_type.startswith('text/plain'))
+        finally:
+            shutil.rmtree(directory)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,85 @@
+"""
+Test cases for Schema Migrations
+
+Test cases can be run with:
+  pytest tests/test_migrations.py
+"""
+
+import unittest
+import os
+import mock
+from sqlalchemy import inspect
+from app.models import Products, db
+from app import app, migrations
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestMigrations(unittest.TestCase):
+    """ Test Cases for Schema Migrations """
+
+    @classmethod
+    def setUpClass(cls):
+        """ These run once per Test suite """
+        app.debug = False
+        # Set up the test database
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        Products.init_db(app)
+        db.drop_all()    # clean up the last tests
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+
+    def _index_names(self):
+        return set(index['name'] for index in inspect(db.engine).get_indexes('products'))
+
+    def test_upgrade_new_database(self):
+        """ Upgrade a database just created with the current schema """
+        db.create_all()
+        self.assertEqual(migrations.upgrade(), migrations.MIGRATIONS[-1][0])
+        self.assertIn('ix_products_category_available_price', self._index_names())
+
+    def test_upgrade_existing_table(self):
+        """ Upgrade a products table created before the indexes existed """
+        db.engine.execute('CREATE TABLE products (id INTEGER NOT NULL PRIMARY KEY, '
+                          'name VARCHAR(63), category VARCHAR(63), '
+                          'available BOOLEAN, price FLOAT)')
+        db.engine.execute("INSERT INTO products (name, category, available, price) "
+                          "VALUES ('Radio', 'Electronics', 1, 20)")
+        self.assertEqual(self._index_names(), set())
+        self.assertEqual(migrations.upgrade(), 8)
+        self.assertEqual(self._index_names(),
+                         set(['ix_products_name', 'ix_products_price',
+                              'ix_products_category_available_price',
+                              'ix_products_category_price']))
+        # running it again is a no-op
+        self.assertEqual(migrations.upgrade(), 8)
+        Products(name="Television", category="Electronics", available=True).save()
+        self.assertEqual(len(Products.find_by_category("Electronics").all()), 2)
+        radio = Products.find_by_name("Radio").first()
+        self.assertEqual(radio.version, 1)
+        self.assertNotEqual(radio.updated_at, None)
+        self.assertEqual(radio.serialize()['price'], '20.00')
+
+    def test_inexact_prices(self):
+        """ Refuse to keep prices in a floating point column that cannot be changed """
+        db.engine.execute('CREATE TABLE products (id INTEGER NOT NULL PRIMARY KEY, '
+                          'name VARCHAR(63), category VARCHAR(63), '
+                          'available BOOLEAN, price FLOAT)')
+        db.engine.execute("INSERT INTO products (name, category, available, price) "
+                          "VALUES ('Radio', 'Electronics', 1, 20)")
+        with mock.patch.object(db.engine.dialect, 'name', 'mysql'):
+            self.assertRaises(RuntimeError, migrations.upgrade)
+        self.assertEqual(db.engine.execute('SELECT price FROM products').scalar(), 20)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
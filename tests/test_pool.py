@@ -0,0 +1,76 @@
+"""
+Test cases for the Connection Pool
+
+Test cases can be run with:
+  pytest tests/test_pool.py
+"""
+
+import json
+import unittest
+import mock
+from sqlalchemy import create_engine, exc
+from app.pool import InstrumentedQueuePool, pool_stats
+from app.vcap_services import get_pool_options
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestConnectionPool(unittest.TestCase):
+    """ Test Cases for InstrumentedQueuePool """
+
+    def setUp(self):
+        self.engine = create_engine('sqlite://', poolclass=InstrumentedQueuePool,
+                                    pool_size=1, max_overflow=0, pool_timeout=0.05)
+
+    def tearDown(self):
+        self.engine.dispose()
+
+    def test_checkout_stats(self):
+        """ Count checkouts and connections in use """
+        conn = self.engine.connect()
+        stats = pool_stats(self.engine)
+        self.assertEqual(stats['in_use'], 1)
+        self.assertEqual(stats['checkouts'], 1)
+        self.assertEqual(stats['connects'], 1)
+        conn.close()
+        self.engine.connect().close()
+        stats = pool_stats(self.engine)
+        self.assertEqual(stats['in_use'], 0)
+        self.assertEqual(stats['idle'], 1)
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['connects'], 1)
+        self.assertEqual(stats['waits'], 0)
+
+    def test_wait_timeout(self):
+        """ Count checkouts that wait for a connection and time out """
+        conn = self.engine.connect()
+        self.assertRaises(exc.TimeoutError, self.engine.connect)
+        conn.close()
+        stats = pool_stats(self.engine)
+        self.assertEqual(stats['waits'], 1)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertTrue(stats['max_wait_ms'] >= 50)
+
+    def test_other_pools(self):
+        """ Report the status of pools that are not instrumented """
+        engine = create_engine('sqlite://')
+        self.assertEqual(pool_stats(engine)['pool'], engine.pool.__class__.__name__)
+
+    @mock.patch.dict('os.environ', {'DB_POOL_SIZE': '3', 'DB_POOL_PRE_PING': 'false'})
+    def test_pool_options_from_environment(self):
+        """ Read the pool settings from the environment """
+        self.assertEqual(get_pool_options(), {'pool_size': 3, 'pool_pre_ping': False})
+
+    def test_pool_options_from_vcap(self):
+        """ Read the pool settings from the VCAP_SERVICES credentials """
+        creds = {'uri': 'db2://localhost', 'pool_size': 2, 'pool_recycle': 600}
+        vcap = json.dumps({'dashDB For Transactions': [{'credentials': creds}]})
+        with mock.patch.dict('os.environ', {'VCAP_SERVICES': vcap, 'DB_POOL_SIZE': '4'}):
+            self.assertEqual(get_pool_options(), {'pool_size': 4, 'pool_recycle': 600})
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -22,11 +22,24 @@ Test cases can be run with:
 
 import unittest
 import os
-from app.models import Products, DataValidationError, db
+import mock
+from sqlalchemy import event
+from sqlalchemy.exc import SQLAlchemyError
+from decimal import Decimal
+from collections import OrderedDict
+from datetime import datetime, timedelta
+from app.models import Products, ProductChange, DataValidationError, VersionConflictError, db
+from flask import jsonify
 from app import app
 
 DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
 
+
+def engine_of(product_id):
+    """ Returns the engine of the database that holds a product, its shard if there are shards """
+    shard = db.shards.for_id(product_id)
+    return db.engine if shard is None else db.shards.engine(shard)
+
 ######################################################################
 #  T E S T   C A S E S
 ######################################################################
@@ -90,6 +103,38 @@ class TestProducts(unittest.TestCase):
         self.assertEqual(len(products), 1)
         self.assertEqual(products[0].category, "HD")
 
+    def test_save_versions_a_product(self):
+        """ Saving a product bumps its version and updated time """
+        product = Products(name="Television", category="Electronics", available=True)
+        product.save()
+        self.assertEqual(product.version, 1)
+        self.assertNotEqual(product.updated_at, None)
+        product.category = "HD"
+        product.save()
+        self.assertEqual(product.version, 2)
+        self.assertEqual(product.validators()['version'], 2)
+
+    def test_update_by_id(self):
+        """ Update a product in a single compare-and-swap statement """
+        product = Products(name="Television", category="Electronics", available=True)
+        product.save()
+        updated = Products.update_by_id(product.id, {"available": False}, version=1)
+        self.assertEqual(updated.available, False)
+        self.assertEqual(updated.version, 2)
+        self.assertRaises(VersionConflictError, Products.update_by_id,
+                          product.id, {"available": True}, version=1)
+        self.assertEqual(Products.update_by_id(0, {"available": True}), None)
+
+    def test_save_lost_update(self):
+        """ Saving a product that another writer changed raises a conflict """
+        product = Products(name="Television", category="Electronics", available=True)
+        product.save()
+        table = Products.__table__
+        engine_of(product.id).execute(table.update().values(category="HD", version=2))
+        product.category = "4K"
+        self.assertRaises(VersionConflictError, product.save)
+        self.assertEqual(Products.find(product.id).category, "HD")
+
     def test_delete_a_product(self):
         """ Delete a product """
         product = Products(name="Television", category="Electronics", available=True)
@@ -99,6 +144,21 @@ class TestProducts(unittest.TestCase):
         product.delete()
         self.assertEqual(len(Products.all()), 0)
 
+    def test_delete_changed_product(self):
+        """ Delete a product that another writer changed or deleted """
+        product = Products(name="Television", category="Electronics", available=True)
+        product.save()
+        table = Products.__table__
+        engine_of(product.id).execute(table.update().values(category="HD", version=2))
+        product.delete()
+        self.assertEqual(Products.find(product.id), None)
+        product = Products(name="Radio", category="Electronics", available=True)
+        product.save()
+        engine_of(product.id).execute(table.delete())
+        product.delete()
+        self.assertEqual([change['operation'] for change in ProductChange.since(0)],
+                         ['created', 'deleted', 'created'])
+
     def test_serialize_a_product(self):
         """ Test serialization of a Product """
         product = Products(name="Television", category="Electronics", available=True)
@@ -160,6 +220,214 @@ class TestProducts(unittest.TestCase):
         self.assertEqual(product[0].name, "T-Shirt")
         self.assertEqual(product[0].available, False)
 
+    def test_page_products(self):
+        """ Page through Products by id """
+        for name in ["Television", "T-Shirt", "Table"]:
+            Products(name=name, category="Stuff", available=True).save()
+        products, next_after = Products.page(limit=2)
+        self.assertEqual([product.name for product in products], ["Television", "T-Shirt"])
+        self.assertEqual(next_after, products[-1].id)
+        products, next_after = Products.page(after=next_after, limit=2)
+        self.assertEqual([product.name for product in products], ["Table"])
+        self.assertEqual(next_after, None)
+
+    def test_stream_products(self):
+        """ Stream Products from a query """
+        Products(name="Television", category="Electronics", available=True).save()
+        Products(name="T-Shirt", category="Clothing", available=False).save()
+        products = list(Products.stream(Products.find_by_category("Clothing"), batch_size=1))
+        self.assertEqual(len(products), 1)
+        self.assertEqual(products[0].name, "T-Shirt")
+        self.assertEqual(len(list(Products.stream())), 2)
+
+    def test_find_by_filters(self):
+        """ Find Products by a combination of filters """
+        Products(name="Television", category="Electronics", available=True, price=500).save()
+        Products(name="Radio", category="Electronics", available=False, price=20).save()
+        Products(name="Walkman", category="Electronics", available=True, price=30).save()
+        Products(name="T-Shirt", category="Clothing", available=True, price=10).save()
+        products = Products.find_by_filters(category="Electronics", available=True,
+                                            price_max=100).all()
+        self.assertEqual([product.name for product in products], ["Walkman"])
+        products = Products.find_by_filters(category=["Electronics", "Clothing"],
+                                            price_min=15, sort=["-price"]).all()
+        self.assertEqual([product.name for product in products],
+                         ["Television", "Walkman", "Radio"])
+        self.assertEqual(Products.find_by_filters(price=10).count(), 1)
+        self.assertRaises(DataValidationError, Products.find_by_filters, sort=["color"])
+
+    def test_exact_prices(self):
+        """ Store prices exactly to the cent """
+        product = Products().deserialize({"name": "Gum", "category": "Food",
+                                          "available": True, "price": 0.1})
+        product.save()
+        Products(name="Mint", category="Food", available=True, price="0.2").save()
+        Products(name="Candy", category="Food", available=True, price=2.675).save()
+        self.assertEqual(Products.find(product.id).serialize()['price'], '0.10')
+        self.assertEqual(Products.find_by_price(0.1).count(), 1)
+        self.assertEqual(Products.find_by_price([0.1, 0.2]).count(), 2)
+        self.assertEqual(Products.find_by_name("Candy").first().price, Decimal('2.68'))
+        self.assertEqual(Products.find_by_filters(price_min=0.3).count(), 1)
+        stats = Products.stats()[0]
+        self.assertEqual((stats['min_price'], stats['max_price']), (0.1, 2.68))
+        for price in ['cheap', 'nan', 'inf', 1e9, None, True]:
+            self.assertRaises(DataValidationError, Products().deserialize,
+                              {"name": "Gum", "category": "Food", "available": True,
+                               "price": price})
+        self.assertRaises(DataValidationError, Products.find_by_price, 'nan')
+
+    def test_cheapest(self):
+        """ Find the cheapest Products of a category from its price index """
+        for name, category, available, price in [("TV", "Electronics", True, 500),
+                                                 ("Radio", "Electronics", False, 20),
+                                                 ("Walkman", "Electronics", True, 30),
+                                                 ("Cable", "Electronics", True, None),
+                                                 ("T-Shirt", "Clothing", True, 10)]:
+            Products(name=name, category=category, available=available, price=price).save()
+        cheapest = Products.cheapest(2, category="Electronics")
+        self.assertEqual([product.name for product in cheapest], ["Radio", "Walkman"])
+        cheapest = Products.cheapest(5, category="Electronics", available=True, price_max=100)
+        self.assertEqual([product.name for product in cheapest], ["Walkman"])
+        self.assertEqual(Products.cheapest(1)[0].name, "T-Shirt")
+        if db.engine.dialect.name == 'sqlite':
+            query = Products.query.filter(Products.category == "Electronics",
+                                          Products.price.isnot(None)) \
+                                  .order_by(Products.price, Products.id).limit(2)
+            statement = str(query.statement.compile(compile_kwargs={"literal_binds": True}))
+            plan = ' '.join(str(row[-1]) for row in
+                            db.engine.execute('EXPLAIN QUERY PLAN ' + statement))
+            self.assertIn('ix_products_category_price', plan)
+
+    def test_bulk_create_executemany(self):
+        """ Insert a bulk batch with one statement and read back its ids """
+        Products(name="Radio", category="Electronics", available=True, price=1).save()
+        inserts = []
+        def count(conn, cursor, statement, parameters, context, executemany):
+            if statement.startswith('INSERT INTO products'):
+                inserts.append(executemany)
+        event.listen(db.engine, 'before_cursor_execute', count)
+        try:
+            results = Products.bulk_create([{"name": name, "category": "Electronics",
+                                             "available": True, "price": 1}
+                                            for name in ("TV", "Phone", "Laptop")])
+        finally:
+            event.remove(db.engine, 'before_cursor_execute', count)
+        self.assertEqual(inserts, [True])
+        ids = [result['id'] for result in results]
+        self.assertEqual([Products.find(product_id).name for product_id in ids],
+                         ["TV", "Phone", "Laptop"])
+        self.assertEqual(set(product.version for product in Products.all()), set([1]))
+
+    def test_bulk_failed_batch(self):
+        """ Retry a failed bulk batch one item at a time """
+        items = [{"name": "Television", "category": "Electronics", "available": True, "price": 1},
+                 {"name": "x" * 100, "category": "Electronics", "available": True, "price": 1}]
+        original_insert = Products._insert
+        def insert(mappings):
+            if any(len(mapping['name']) > 63 for mapping in mappings):
+                raise SQLAlchemyError('value too long')
+            return original_insert(mappings)
+        with mock.patch.object(Products, '_insert', side_effect=insert):
+            results = Products.bulk_create(items, batch_size=2)
+        self.assertEqual([result['status'] for result in results], ['created', 'failed'])
+        self.assertEqual(len(Products.all()), 1)
+
+    def test_fast_serialization(self):
+        """ Encode rows to the same JSON as jsonify(serialize()) """
+        Products(name=u"Caf\xe9 \"Noir\" / 1", category="Food", available=True, price=18.1231).save()
+        Products(name="T-Shirt", category=None, available=False, price=3000).save()
+        Products(name=None, category="Tables", available=None, price=None).save()
+        query = Products.query.order_by(Products.id)
+        with app.test_request_context():
+            expected = jsonify([product.serialize() for product in query]).get_data()
+        encoded = '[' + ','.join(Products.encode_row(row) for row in Products.rows(query)) + ']\n'
+        self.assertEqual(encoded, expected)
+        self.assertEqual(Products.list_json(sort=['id']) + '\n', expected)
+
+    def test_changes_stop_at_a_gap(self):
+        """ Hold back the changes after a gap until it has settled """
+        product = Products(name="Radio", category="Electronics", available=True, price=5)
+        product.save()
+        now = datetime.utcnow()
+        # change 2 is still being written by another transaction
+        db.session.add(ProductChange(seq=3, product_id=product.id, operation='updated',
+                                     changed_at=now))
+        db.session.commit()
+        self.assertEqual([change['seq'] for change in ProductChange.since(0)], [1])
+        self.assertEqual(ProductChange.since(1), [])
+        ProductChange.query.filter_by(seq=3).update({'changed_at': now - timedelta(seconds=10)})
+        db.session.commit()
+        changes = ProductChange.since(1)
+        self.assertEqual([change['seq'] for change in changes], [3])
+        self.assertEqual(changes[0]['product']['name'], 'Radio')
+
+    def test_import_changes(self):
+        """ Record a change for every imported product """
+        Products.import_products([{"name": "TV", "category": "Electronics",
+                                   "available": True, "price": 10}] * 3, batch_size=2)
+        changes = ProductChange.since(0)
+        self.assertEqual([change['operation'] for change in changes], ['created'] * 3)
+        self.assertEqual(sorted(change['id'] for change in changes),
+                         sorted(product.id for product in Products.all()))
+
+    def test_set_availability(self):
+        """ Set the availability of many Products in one batch """
+        radio = Products(name="Radio", category="Electronics", available=True, price=5)
+        radio.save()
+        chair = Products(name="Chair", category="Furniture", available=False, price=50)
+        chair.save()
+        found = Products.set_availability({radio.id: False, chair.id: True, 0: False})
+        self.assertEqual(found, set([radio.id, chair.id]))
+        self.assertEqual(Products.find(radio.id).available, False)
+        self.assertEqual(Products.find(radio.id).version, 2)
+        self.assertEqual(Products.find(chair.id).available, True)
+        changes = ProductChange.since(2)
+        self.assertEqual(sorted(change['id'] for change in changes), [radio.id, chair.id])
+        self.assertEqual(Products.set_availability({}), set())
+
+    def test_set_availability_at_version(self):
+        """ Leave alone the Products that changed since their version was read """
+        radio = Products(name="Radio", category="Electronics", available=True, price=5)
+        radio.save()
+        chair = Products(name="Chair", category="Furniture", available=True, price=50)
+        chair.save()
+        Products.update_by_id(chair.id, {'price': 60})
+        radio_id, chair_id = radio.id, chair.id
+        found = Products.set_availability({radio_id: False, chair_id: False},
+                                          {radio_id: 1, chair_id: 1})
+        self.assertEqual(found, set([radio_id]))
+        db.session.remove()
+        self.assertEqual(Products.find(radio_id).available, False)
+        chair = Products.find(chair_id)
+        self.assertEqual((chair.available, chair.version), (True, 2))
+
+    def test_set_availability_partly_failed(self):
+        """ Report the Products of the batches committed before one failed """
+        radio = Products(name="Radio", category="Electronics", available=True, price=5)
+        radio.save()
+        chair = Products(name="Chair", category="Furniture", available=True, price=50)
+        chair.save()
+        radio_id, chair_id = radio.id, chair.id
+        existing = Products._existing
+        calls = []
+
+        def fail_second(ids):
+            """ Looks up the first batch and fails on the second """
+            calls.append(ids)
+            if len(calls) > 1:
+                raise SQLAlchemyError('down')
+            return existing(ids)
+        found = set()
+        with mock.patch('app.models.LOOKUP_BATCH_SIZE', 1), \
+                mock.patch.object(Products, '_existing', side_effect=fail_second):
+            self.assertRaises(SQLAlchemyError, Products.set_availability,
+                              OrderedDict([(radio_id, False), (chair_id, False)]), None, found)
+        db.session.rollback()
+        self.assertEqual(len(found), 1)
+        db.session.remove()
+        self.assertEqual([Products.find(product_id).available for product_id in (radio_id, chair_id)],
+                         [product_id not in found for product_id in (radio_id, chair_id)])
+
     def test_find_404(self):
         """ Test Find 404"""
         Products(name="Television", category="Electronics", available=True).save()
@@ -0,0 +1,124 @@
+"""
+Test cases for SQL Profiling
+
+Test cases can be run with:
+  pytest tests/test_profiling.py
+"""
+
+import os
+import json
+import unittest
+from flask import Response
+from flask_api import status    # HTTP Status Codes
+from sqlalchemy.exc import DBAPIError
+import app.service as service
+from app import profiling
+from app.models import Products, db
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestProfiling(unittest.TestCase):
+    """ Test Cases for the SQL profiling hooks """
+
+    @classmethod
+    def setUpClass(cls):
+        """ Run once before all tests """
+        service.app.debug = False
+        service.app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    def setUp(self):
+        service.init_db()
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # create new tables
+        service.app.config['SQL_PROFILING'] = True
+        profiling.PROFILES.clear()
+        self.app = service.app.test_client()
+
+    def tearDown(self):
+        service.app.config['SQL_PROFILING'] = False
+        db.session.remove()
+        db.drop_all()
+
+    def test_normalize(self):
+        """ Replace the literals and parameters of a statement """
+        self.assertEqual(profiling.normalize('SELECT *\n  FROM products WHERE id IN (?, ?, ?) '
+                                             'AND price > 5.5 LIMIT ?'),
+                         'SELECT * FROM products WHERE id IN (?) AND price > ? LIMIT ?')
+        self.assertEqual(profiling.normalize('SELECT * FROM products WHERE id = %(id_1)s '
+                                             'AND name = :name AND x = y::text'),
+                         'SELECT * FROM products WHERE id = ? AND name = ? AND x = y::text')
+
+    def test_profiling_off(self):
+        """ Leave requests alone when profiling is off """
+        service.app.config['SQL_PROFILING'] = False
+        resp = self.app.get('/products')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotIn('Server-Timing', resp.headers)
+        resp = self.app.get('/debug/sql')
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_server_timing(self):
+        """ Report the statements of a request in Server-Timing and /debug/sql """
+        product = Products(name="Radio", category="Electronics", available=True, price=20)
+        product.save()
+        resp = self.app.put('/products/{}/unavailable'.format(product.id))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        timings = resp.headers.getlist('Server-Timing')
+        self.assertEqual(len(timings), 2)
+        self.assertTrue(timings[0].startswith('db;dur='))
+        self.assertTrue(timings[1].startswith('total;dur='))
+        resp = self.app.get('/debug/sql')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = json.loads(resp.data)
+        self.assertEqual(len(data), 1)
+        profile = data[0]
+        self.assertEqual(profile['method'], 'PUT')
+        self.assertEqual(profile['endpoint'], 'unavailable_products')
+        self.assertEqual(profile['queries'], len(profile['statements']))
+        self.assertIn('{} queries'.format(profile['queries']), timings[0])
+        update = [item for item in profile['statements']
+                  if item['statement'].startswith('UPDATE')]
+        self.assertEqual(update[0]['rows'], 1)
+        self.assertEqual(profile['repeated'], [])
+
+    def test_failed_statement(self):
+        """ Record a statement that raised, with its error """
+        with service.app.test_request_context('/products'):
+            profiling.start_request()
+            with db.engine.connect() as connection:
+                self.assertRaises(DBAPIError, connection.execute, 'SELECT * FROM no_such_table')
+                self.assertEqual(connection.info['profile_start'], [])
+                connection.execute('SELECT 1')
+            profiling.finish_request(Response())
+        statements = profiling.profiles()[0]['statements']
+        self.assertEqual([item['statement'] for item in statements],
+                         ['SELECT * FROM no_such_table', 'SELECT 1'])
+        self.assertIn('no_such_table', statements[0]['error'])
+        self.assertNotIn('error', statements[1])
+
+    def test_repeated_statements(self):
+        """ Flag a request that runs the same statement once per row """
+        for name in ['Radio', 'Television', 'Phone', 'Camera', 'Laptop']:
+            Products(name=name, category="Electronics", available=True).save()
+        with service.app.test_request_context('/products'):
+            profiling.start_request()
+            for product in Products.all():
+                db.session.expire(product)
+                Products.find(product.id)
+            response = profiling.finish_request(Response())
+        self.assertEqual(len(response.headers.getlist('Server-Timing')), 2)
+        profile = profiling.profiles(repeated_only=True)[0]
+        self.assertEqual(len(profile['repeated']), 1)
+        self.assertEqual(profile['repeated'][0]['count'], 5)
+        self.assertIn('WHERE products.id = ?', profile['repeated'][0]['statement'])
+        self.assertEqual(profiling.profiles(repeated_only=True), profiling.profiles())
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,173 @@
+"""
+Test cases for the Read Replicas
+
+Test cases can be run with:
+  pytest tests/test_replicas.py
+"""
+
+import os
+import time
+import unittest
+from datetime import datetime
+import mock
+from sqlalchemy import create_engine
+from app.models import Products, ProductChange, db
+from app.vcap_services import get_replica_uris
+from app import app
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'db')
+# each replica holds a single product named after it
+REPLICAS = dict((name, os.path.join(DB_DIR, 'test_replica_{}.db'.format(name.lower())))
+                for name in ('One', 'Two'))
+# a replica that cannot be opened
+BROKEN = 'sqlite:////nonexistent/replica.db'
+# a replica that can be opened but has no tables
+EMPTY = os.path.join(DB_DIR, 'test_replica_empty.db')
+
+
+def replica_uri(name):
+    """ Returns the URI of a test replica """
+    return 'sqlite:///' + REPLICAS[name]
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestReplicas(unittest.TestCase):
+    """ Test Cases for routing reads to replicas """
+
+    @classmethod
+    def setUpClass(cls):
+        app.debug = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+        for name, path in REPLICAS.items():
+            engine = create_engine('sqlite:///' + path)
+            for table in (Products.__table__, ProductChange.__table__):
+                table.drop(engine, checkfirst=True)
+                table.create(engine)
+            engine.execute(Products.__table__.insert(), name=name, category='Replica',
+                           available=True, price=1, version=1)
+            engine.dispose()
+        # replica One has replayed the first change of the primary, Two has not
+        create_engine(replica_uri('One')).execute(ProductChange.__table__.insert(), seq=1,
+                                                  operation='created', changed_at=datetime.utcnow())
+
+    @classmethod
+    def tearDownClass(cls):
+        for path in list(REPLICAS.values()) + [EMPTY]:
+            if os.path.exists(path):
+                os.remove(path)
+
+    def setUp(self):
+        self.config = mock.patch.dict(app.config, REPLICA_STICKY_SECONDS=0,
+                                      REPLICA_MAX_LAG_SECONDS=0)
+        self.config.start()
+        self.use_replicas(replica_uri('One'))
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+        db.session.execute(Products.__table__.insert(), {'name': 'Primary', 'version': 1})
+        db.session.commit()
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.config.stop()
+        Products.init_db(app)
+
+    def use_replicas(self, *uris):
+        """ Initializes the database with replicas """
+        app.config['REPLICA_URIS'] = list(uris)
+        Products.init_db(app)
+
+    def names(self, query=None):
+        """ Returns the product names a query reads """
+        db.session.remove()
+        Products.replicas.allow(db.session)
+        query = Products.read_query() if query is None else query
+        return [name for name, in query.with_entities(Products.name).order_by(Products.id)]
+
+    def test_read_from_replica(self):
+        """ Send the read-only queries of an allowed session to the replica """
+        self.assertEqual(self.names(), ['One'])
+        self.assertEqual(Products.find(1).name, 'One')
+        self.assertEqual(self.names(Products.find_by_category('Replica')), ['One'])
+        self.assertEqual(Products.stats()[0]['category'], 'Replica')
+        self.assertEqual(Products.replicas.reads, 4)
+        # queries that are not marked and sessions that are not allowed use the primary
+        self.assertEqual(self.names(Products.query), ['Primary'])
+        Products.replicas.allow(db.session, False)
+        self.assertEqual([product.name for product in Products.all()], ['Primary'])
+
+    def test_read_your_writes(self):
+        """ Keep reads on the primary for a while after a write """
+        app.config['REPLICA_STICKY_SECONDS'] = 60
+        self.use_replicas(replica_uri('One'))
+        self.assertEqual(self.names(), ['One'])
+        Products(name='New', category='Primary', available=True, price=2).save()
+        self.assertEqual(self.names(), ['Primary', 'New'])
+
+    def test_client_last_write(self):
+        """ Keep the reads of a client that wrote recently on the primary """
+        app.config['REPLICA_STICKY_SECONDS'] = 60
+        self.use_replicas(replica_uri('One'))
+        db.session.remove()
+        Products.replicas.allow(db.session, last_write=time.time() - 10)
+        self.assertEqual(Products.read_query().first().name, 'Primary')
+        Products.replicas.allow(db.session, last_write=time.time() - 120)
+        self.assertEqual(Products.read_query().first().name, 'One')
+
+    def test_round_robin(self):
+        """ Take the replicas in turn """
+        self.use_replicas(replica_uri('One'), replica_uri('Two'))
+        self.assertEqual([self.names()[0] for _ in range(4)], ['One', 'Two', 'One', 'Two'])
+
+    def test_failover(self):
+        """ Skip a replica that fails, and use the primary when none is left """
+        self.use_replicas(BROKEN, replica_uri('Two'))
+        self.assertEqual([self.names()[0] for _ in range(3)], ['Two'] * 3)
+        stats = Products.replicas.stats()
+        self.assertEqual(stats['failovers'], 1)
+        self.assertEqual([replica['healthy'] for replica in stats['replicas']], [False, True])
+        self.use_replicas(BROKEN)
+        self.assertEqual(self.names(), ['Primary'])
+        self.assertEqual(self.names(), ['Primary'])
+        self.assertEqual(Products.replicas.failovers, 1)
+
+    def test_query_failover(self):
+        """ Run a query that a replica fails on the primary, and skip that replica """
+        self.use_replicas('sqlite:///' + EMPTY, replica_uri('Two'))
+        self.assertEqual(self.names(), ['Primary'])
+        self.assertEqual(Products.find(1).name, 'Two')
+        self.assertEqual([self.names()[0] for _ in range(2)], ['Two'] * 2)
+        stats = Products.replicas.stats()
+        self.assertEqual(stats['failovers'], 1)
+        self.assertEqual([replica['healthy'] for replica in stats['replicas']], [False, True])
+
+    def test_lagging_replica(self):
+        """ Skip a replica that has not caught up with the primary for too long """
+        app.config['REPLICA_MAX_LAG_SECONDS'] = 10
+        self.use_replicas(replica_uri('One'), replica_uri('Two'))
+        ProductChange.record('created', 1)
+        db.session.commit()
+        with mock.patch('app.replicas.time.time', return_value=1000):
+            self.assertEqual([self.names()[0] for _ in range(2)], ['One', 'Two'])
+        with mock.patch('app.replicas.time.time', return_value=1006):
+            self.assertEqual([self.names()[0] for _ in range(2)], ['One', 'Two'])
+        with mock.patch('app.replicas.time.time', return_value=1012):
+            self.assertEqual([self.names()[0] for _ in range(2)], ['One', 'One'])
+            stats = Products.replicas.stats()
+        self.assertEqual([replica['healthy'] for replica in stats['replicas']], [True, False])
+
+    def test_replica_uris(self):
+        """ Read the replica URIs from the environment """
+        with mock.patch.dict(os.environ, {'DATABASE_REPLICA_URIS': 'sqlite:///a.db, sqlite:///b.db'}):
+            self.assertEqual(get_replica_uris(), ['sqlite:///a.db', 'sqlite:///b.db'])
+        with mock.patch.dict(os.environ, {'DATABASE_REPLICA_URIS': ''}):
+            self.assertEqual(get_replica_uris(), [])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,89 @@
+"""
+Test cases for the Search Index
+
+Test cases can be run with:
+  pytest tests/test_search.py
+"""
+
+import time
+import unittest
+from app.search import SearchIndex, tokenize
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSearchIndex(unittest.TestCase):
+    """ Test Cases for SearchIndex """
+
+    def setUp(self):
+        self.index = SearchIndex()
+        self.index.build([(1, 'Flat Screen Television', 'Electronics'),
+                          (2, 'Television Stand', 'Furniture'),
+                          (3, 'Telescope', 'Optics'),
+                          (4, 'Coffee Table', 'Furniture'),
+                          (5, 'Radio', None)])
+
+    def _ids(self, text, **kwargs):
+        return [product_id for product_id, _ in self.index.search(text, **kwargs)[1]]
+
+    def test_tokenize(self):
+        """ Split a text into lower case words """
+        self.assertEqual(tokenize('Flat-Screen  TV, 4K'), ['flat', 'screen', 'tv', '4k'])
+        self.assertEqual(tokenize(None), [])
+
+    def test_exact_and_prefix(self):
+        """ Rank exact words above prefixes and names above categories """
+        self.assertEqual(self._ids('television'), [1, 2])
+        self.assertEqual(self._ids('tele'), [3, 1, 2])
+        self.assertEqual(self._ids('furniture'), [2, 4])
+        self.assertEqual(self._ids('table'), [4])
+        score = dict(self.index.search('television')[1])
+        self.assertEqual(score[1], 2.0)
+
+    def test_every_word_matches(self):
+        """ Only return products that match every word """
+        self.assertEqual(self._ids('television furn'), [2])
+        self.assertEqual(self._ids('television radio'), [])
+        self.assertEqual(self.index.search('  ,  '), (0, []))
+
+    def test_fuzzy(self):
+        """ Match misspelled words by trigram similarity """
+        self.assertEqual(self._ids('televsion'), [1, 2])
+        self.assertEqual(self._ids('xyzzy'), [])
+
+    def test_pagination(self):
+        """ Return the total and a page of the ranked matches """
+        total, hits = self.index.search('tele', limit=2, offset=1)
+        self.assertEqual(total, 3)
+        self.assertEqual([product_id for product_id, _ in hits], [1, 2])
+
+    def test_add_and_remove(self):
+        """ Keep the index up to date with changed products """
+        self.index.add(5, 'Clock Radio', 'Electronics')
+        self.assertEqual(self._ids('clock'), [5])
+        self.assertEqual(self._ids('electronics'), [1, 5])
+        self.index.add(5, 'Radio', 'Audio')
+        self.assertEqual(self._ids('clock'), [])
+        self.index.remove(3)
+        self.assertEqual(self._ids('tele'), [1, 2])
+        self.assertEqual(self._ids('telescpe'), [])
+        self.index.remove(42)
+
+    def test_stale_and_expired(self):
+        """ Track changed products and the age of the index """
+        self.assertFalse(self.index.expired())
+        self.index.invalidate(1, 2)
+        self.assertEqual(self.index.pop_stale(), set([1, 2]))
+        self.assertEqual(self.index.pop_stale(), set())
+        self.index.built_at = time.time() - self.index.max_age - 1
+        self.assertTrue(self.index.expired())
+        self.index.clear()
+        self.assertTrue(self.index.expired())
+        self.assertEqual(self._ids('television'), [])
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -22,14 +22,18 @@ Test cases can be run with the following:
 """
 import unittest
 import os
+import json
 import logging
 import mock
+from sqlalchemy.exc import SQLAlchemyError
 from flask_api import status    # HTTP Status Codes
 import app.service as service
 import app.vcap_services as vcap
 #from mock import MagicMock, patch
 from app.models import Products, DataValidationError, db
+from app.cache import RedisCache
 from .product_factory import ProductFactory
+from .fake_redis import FakeRedisServer
 
 DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
 
@@ -101,6 +105,155 @@ class TestProductsServer(unittest.TestCase):
         data = resp.get_json()
         self.assertEqual(data['name'], test_product.name)
 
+    def test_read_replica_requests(self):
+        """ Read from the replicas in GET requests that do not ask for the latest data """
+        product = self._create_products(1)[0]
+        with mock.patch.dict(service.app.config, REPLICA_URIS=[DATABASE_URI],
+                             REPLICA_STICKY_SECONDS=0):
+            service.init_db()
+            url = '/products/{}'.format(product.id)
+            resp = self.app.get(url)
+            self.assertEqual(resp.get_json()['name'], product.name)
+            self.assertEqual(Products.replicas.reads, 1)
+            Products.cache.clear()
+            resp = self.app.get(url, headers={'Cache-Control': 'no-cache'})
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            resp = self.app.delete(url)
+            self.assertEqual(resp.status_code, status.HTTP_204_NO_CONTENT)
+            self.assertEqual(Products.replicas.reads, 1)
+            resp = self.app.get('/pool/stats')
+            self.assertEqual(len(resp.get_json()['replicas']['replicas']), 1)
+        service.init_db()
+
+    def test_read_replica_after_write(self):
+        """ Keep the reads of a client that wrote on the primary, whichever worker serves them """
+        product = self._create_products(1)[0]
+        with mock.patch.dict(service.app.config, REPLICA_URIS=[DATABASE_URI],
+                             REPLICA_STICKY_SECONDS=60):
+            service.init_db()
+            url = '/products/{}'.format(product.id)
+            data = self.app.get(url).get_json()
+            self.assertEqual(Products.replicas.reads, 1)
+            data['name'] = 'changed'
+            resp = self.app.put(url, json=data)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            # as if the next request was handled by another worker
+            Products.replicas.last_write = 0
+            Products.cache.clear()
+            self.assertEqual(self.app.get(url).get_json()['name'], 'changed')
+            self.assertEqual(Products.replicas.reads, 1)
+            # other clients read from the replica
+            Products.cache.clear()
+            self.assertEqual(service.app.test_client().get(url).status_code, status.HTTP_200_OK)
+            self.assertEqual(Products.replicas.reads, 2)
+        service.init_db()
+
+    def test_get_product_cached(self):
+        """ Get a single Product through the cache """
+        test_product = self._create_products(1)[0]
+        url = '/products/{}'.format(test_product.id)
+        self.app.get(url)
+        with mock.patch('app.service.Products.find') as find_mock:
+            resp = self.app.get(url)
+            self.assertFalse(find_mock.called)
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['name'], test_product.name)
+        stats = self.app.get('/cache/stats').get_json()
+        self.assertEqual(stats['hits'], 1)
+        self.assertEqual(stats['misses'], 1)
+
+    def test_get_product_cache_invalidated(self):
+        """ Get a single Product after it was changed """
+        test_product = self._create_products(1)[0]
+        url = '/products/{}'.format(test_product.id)
+        data = self.app.get(url).get_json()
+        data['name'] = 'changed'
+        self.app.put(url, json=data, content_type='application/json')
+        self.assertEqual(self.app.get(url).get_json()['name'], 'changed')
+        self.app.put(url + '/unavailable')
+        self.assertEqual(self.app.get(url).get_json()['available'], False)
+        self.app.delete(url)
+        self.assertEqual(self.app.get(url).status_code, status.HTTP_404_NOT_FOUND)
+
+    def test_get_product_cache_race(self):
+        """ Do not cache a Product read just before a write invalidated it """
+        test_product = self._create_products(1)[0]
+        url = '/products/{}'.format(test_product.id)
+        find = Products.find
+
+        def find_then_write(product_id):
+            """ Reads the product and lets a write invalidate it before it is cached """
+            product = find(product_id)
+            Products.invalidate(product_id)
+            return product
+        with mock.patch('app.service.Products.find', side_effect=find_then_write):
+            self.assertEqual(self.app.get(url).status_code, status.HTTP_200_OK)
+        self.assertEqual(Products.cache.get(Products.cache_key(test_product.id)), None)
+
+    def test_get_product_list_cache_invalidated(self):
+        """ Get a cached list of Products after a new one was added """
+        server = FakeRedisServer()
+        server.start()
+        self.addCleanup(server.stop)
+        with mock.patch.object(Products, 'cache', RedisCache(server.url)):
+            self._create_products(2)
+            self.assertEqual(len(self.app.get('/products').get_json()), 2)
+            with mock.patch('app.service.Products.find_by_filters') as find_mock:
+                self.assertEqual(len(self.app.get('/products').get_json()), 2)
+                self.assertFalse(find_mock.called)
+            self._create_products(1)
+            self.assertEqual(len(self.app.get('/products').get_json()), 3)
+
+    def test_get_product_list_not_cached_locally(self):
+        """ Keep lists out of a cache that the other workers do not see """
+        self._create_products(2)
+        self.app.get('/products')
+        with mock.patch('app.service.Products.find_by_filters',
+                        side_effect=Products.find_by_filters) as find_mock:
+            self.assertEqual(len(self.app.get('/products').get_json()), 2)
+            self.assertTrue(find_mock.called)
+        self.assertEqual(Products.cache.stats()['size'], 0)
+
+    def test_get_product_conditional(self):
+        """ Get a single Product only when it has changed """
+        test_product = self._create_products(1)[0]
+        url = '/products/{}'.format(test_product.id)
+        resp = self.app.get(url)
+        etag = resp.headers['ETag']
+        last_modified = resp.headers['Last-Modified']
+        self.assertEqual(etag, '"{}-1"'.format(test_product.id))
+        resp = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        self.assertEqual(len(resp.data), 0)
+        resp = self.app.get(url, headers={'If-Modified-Since': last_modified})
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # change it and the old ETag no longer matches
+        data = self.app.get(url).get_json()
+        resp = self.app.put(url, json=data, content_type='application/json')
+        self.assertEqual(resp.headers['ETag'], '"{}-2"'.format(test_product.id))
+        resp = self.app.get(url, headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['name'], test_product.name)
+
+    def test_get_product_list_conditional(self):
+        """ Get a list of Products only when it has changed """
+        products = self._create_products(3)
+        resp = self.app.get('/products')
+        etag = resp.headers['ETag']
+        self.assertIn('Last-Modified', resp.headers)
+        with mock.patch('app.service.Products.list_json') as list_mock:
+            resp = self.app.get('/products', headers={'If-None-Match': etag})
+            self.assertFalse(list_mock.called)
+        self.assertEqual(resp.status_code, status.HTTP_304_NOT_MODIFIED)
+        # other filters have their own ETag
+        resp = self.app.get('/products', query_string='sort=-id', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        # deleting a product changes the ETag
+        self.app.delete('/products/{}'.format(products[0].id))
+        resp = self.app.get('/products', headers={'If-None-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 2)
+
     def test_get_product_not_found(self):
         """ Get a Product thats not found """
         resp = self.app.get('/products/0')
@@ -168,6 +321,82 @@ class TestProductsServer(unittest.TestCase):
         updated_product = resp.get_json()
         self.assertEqual(updated_product['available'], False)
 
+    def test_unavailable_write_behind_superseded(self):
+        """ Drop a queued change when the Product is updated before it is written """
+        product = self._create_products(1)[0]
+        url = '/products/{}'.format(product.id)
+        with mock.patch.dict(service.app.config, WRITE_BEHIND='async'):
+            resp = self.app.put(url + '/unavailable')
+            self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+        data = dict(product.serialize(), available=True, name='newer')
+        resp = self.app.put(url, json=data, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        service.availability_queue.close()
+        db.session.remove()
+        product = Products.find(product.id)
+        self.assertEqual((product.name, product.available, product.version), ('newer', True, 2))
+        with mock.patch.dict(service.app.config, WRITE_BEHIND='group'):
+            with mock.patch.object(Products, 'find_version', return_value=1):
+                resp = self.app.put(url + '/unavailable')
+            self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+
+    def test_unavailable_write_behind(self):
+        """ Make Products unavailable through the write-behind queue """
+        product = self._create_products(1)[0]
+        url = '/products/{}/unavailable'.format(product.id)
+        with mock.patch.dict(service.app.config, WRITE_BEHIND='group'):
+            resp = self.app.put(url)
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            self.assertEqual(resp.get_json()['available'], False)
+            self.assertIn('ETag', resp.headers)
+            resp = self.app.put('/products/0/unavailable')
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+            with mock.patch.object(service.availability_queue, 'write',
+                                   side_effect=SQLAlchemyError('down')):
+                resp = self.app.put(url)
+            self.assertEqual(resp.status_code, status.HTTP_503_SERVICE_UNAVAILABLE)
+        Products.query.filter_by(id=product.id).update({'available': True})
+        db.session.commit()
+        with mock.patch.dict(service.app.config, WRITE_BEHIND='async'):
+            resp = self.app.put(url)
+            self.assertEqual(resp.status_code, status.HTTP_202_ACCEPTED)
+            self.assertEqual(resp.get_json(), {'id': product.id, 'available': False})
+            resp = self.app.put('/products/0/unavailable')
+            self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        service.availability_queue.close()
+        db.session.remove()
+        self.assertEqual(Products.find(product.id).available, False)
+        resp = self.app.get('/writebehind/stats')
+        self.assertEqual(resp.get_json()['queued'], 0)
+
+    def test_update_product_if_match(self):
+        """ Update a Product only if it has not changed since it was read """
+        test_product = self._create_products(1)[0]
+        url = '/products/{}'.format(test_product.id)
+        resp = self.app.get(url)
+        etag = resp.headers['ETag']
+        data = resp.get_json()
+        data['category'] = 'first'
+        resp = self.app.put(url, json=data, content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertNotEqual(resp.headers['ETag'], etag)
+        # a second writer that read the same version loses
+        data['category'] = 'second'
+        resp = self.app.put(url, json=data, content_type='application/json',
+                            headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put(url + '/unavailable', headers={'If-Match': etag})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        resp = self.app.put(url, json=data, content_type='application/json',
+                            headers={'If-Match': '"something-else"'})
+        self.assertEqual(resp.status_code, status.HTTP_412_PRECONDITION_FAILED)
+        self.assertEqual(self.app.get(url).get_json()['category'], 'first')
+        # * matches any version
+        resp = self.app.put(url, json=data, content_type='application/json',
+                            headers={'If-Match': '*'})
+        self.assertEqual(resp.get_json()['category'], 'second')
+
     def test_update_product_not_found(self):
         """ Update a product that is not found """
         test_product = ProductFactory()
@@ -211,6 +440,403 @@ class TestProductsServer(unittest.TestCase):
         for product in data:
             self.assertEqual(product['category'], test_category)
 
+    def test_query_product_list_by_filters(self):
+        """ Query Products by several filters at once """
+        products = self._create_products(20)
+        test_category = products[0].category
+        matches = [product for product in products
+                   if product.category == test_category and product.available
+                   and 1 <= float(product.price) <= 100]
+        resp = self.app.get('/products',
+                            query_string={'category': test_category,
+                                          'available': 'true',
+                                          'price_min': 1,
+                                          'price_max': 100,
+                                          'sort': '-price'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), len(matches))
+        prices = [float(product['price']) for product in data]
+        self.assertEqual(prices, sorted(prices, reverse=True))
+        for product in data:
+            self.assertEqual(product['category'], test_category)
+            self.assertEqual(product['available'], True)
+
+    def test_query_product_list_in_list(self):
+        """ Query Products matching any of several categories """
+        products = self._create_products(10)
+        categories = set([products[0].category, products[1].category])
+        resp = self.app.get('/products', query_string=[('category', c) for c in categories])
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), len([p for p in products if p.category in categories]))
+
+    def test_query_product_list_bad_filters(self):
+        """ Query Products with bad filter values """
+        for query in ['available=maybe', 'price_min=cheap', 'sort=color', 'sort=name&limit=2']:
+            resp = self.app.get('/products', query_string=query)
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST, query)
+
+    def test_get_product_list_paged(self):
+        """ Get a list of Products one page at a time """
+        self._create_products(5)
+        resp = self.app.get('/products', query_string='limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(len(data), 2)
+        seen = [product['id'] for product in data]
+        while 'Link' in resp.headers:
+            link = resp.headers['Link']
+            self.assertIn('rel="next"', link)
+            resp = self.app.get(link[1:link.index('>')])
+            self.assertEqual(resp.status_code, status.HTTP_200_OK)
+            seen.extend(product['id'] for product in resp.get_json())
+        self.assertEqual(len(seen), 5)
+        self.assertEqual(seen, sorted(seen))
+
+    def test_get_product_list_paged_bad_limit(self):
+        """ Get a page of Products with a bad limit """
+        resp = self.app.get('/products', query_string='limit=zero')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/products', query_string='limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_stream_product_list(self):
+        """ Stream a list of Products as a JSON array """
+        resp = self.app.get('/products', query_string='stream=true')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json(), [])
+        self._create_products(3)
+        resp = self.app.get('/products', query_string='stream=true')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(len(resp.get_json()), 3)
+
+    def test_stream_product_list_ndjson(self):
+        """ Stream a list of Products as newline delimited JSON """
+        products = self._create_products(3)
+        resp = self.app.get('/products', headers={'Accept': 'application/x-ndjson'})
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(json.loads(lines[0])['name'], products[0].name)
+
+    def test_bulk_create_products(self):
+        """ Create many Products in one request """
+        products = [ProductFactory().serialize() for _ in range(5)]
+        products.insert(2, {"name": "no category"})
+        resp = self.app.post('/products/bulk', query_string='batch_size=2',
+                             json=products, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data['counts'], {'created': 5, 'invalid': 1})
+        self.assertEqual(data['results'][2]['status'], status.HTTP_400_BAD_REQUEST)
+        ids = [result['id'] for result in data['results'] if 'id' in result]
+        self.assertEqual(len(set(ids)), 5)
+        resp = self.app.get('/products/{}'.format(ids[0]))
+        self.assertEqual(resp.get_json()['name'], products[0]['name'])
+
+    def test_bulk_create_products_ndjson(self):
+        """ Create many Products from newline delimited JSON """
+        lines = [json.dumps(ProductFactory().serialize()) for _ in range(3)] + ['{bad json']
+        resp = self.app.post('/products/bulk', data='\n'.join(lines),
+                             content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['counts'], {'created': 3, 'invalid': 1})
+        self.assertEqual(len(self.app.get('/products').get_json()), 3)
+
+    def test_bulk_update_products(self):
+        """ Update many Products in one request """
+        products = [product.serialize() for product in self._create_products(3)]
+        self.app.get('/products/{}'.format(products[0]['id']))  # cache it
+        for product in products:
+            product['category'] = 'unknown'
+        products.append(dict(products[0], id=0))
+        products.append(dict(products[0], id='one'))
+        resp = self.app.put('/products/bulk', json=products, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual(data['counts'], {'updated': 3, 'not found': 1, 'invalid': 1})
+        self.assertEqual(data['results'][3]['status'], status.HTTP_404_NOT_FOUND)
+        resp = self.app.get('/products/{}'.format(products[0]['id']))
+        self.assertEqual(resp.get_json()['category'], 'unknown')
+
+    def test_bulk_delete_products(self):
+        """ Delete many Products in one request """
+        products = self._create_products(3)
+        ids = [products[0].id, {"id": products[1].id}, 0]
+        resp = self.app.delete('/products/bulk', json=ids, content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.get_json()['counts'], {'deleted': 2, 'not found': 1})
+        resp = self.app.get('/products/{}'.format(products[0].id))
+        self.assertEqual(resp.status_code, status.HTTP_404_NOT_FOUND)
+        self.assertEqual(len(self.app.get('/products').get_json()), 1)
+
+    def test_bulk_bad_body(self):
+        """ Send a bulk request that is not an array """
+        resp = self.app.post('/products/bulk', json={"name": "one"},
+                             content_type='application/json')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.post('/products/bulk', data='name=one',
+                             content_type='text/plain')
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_search_products(self):
+        """ Search the Products by words of their name and category """
+        for name, category in [('Flat Screen Television', 'Electronics'),
+                               ('Television Stand', 'Furniture'),
+                               ('Telescope', 'Optics')]:
+            Products(name=name, category=category, available=True, price=10).save()
+        resp = self.app.get('/products/search', query_string='q=tele&limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.headers['X-Total-Count'], '3')
+        data = resp.get_json()
+        self.assertEqual([product['name'] for product in data],
+                         ['Telescope', 'Flat Screen Television'])
+        self.assertTrue(data[0]['score'] > data[1]['score'])
+        self.assertIn('offset=2', resp.headers['Link'])
+        resp = self.app.get('/products/search', query_string='q=tele&limit=2&offset=2')
+        self.assertEqual([product['name'] for product in resp.get_json()], ['Television Stand'])
+        self.assertNotIn('Link', resp.headers)
+        # changes are searchable right away
+        stand = Products.find_by_name('Television Stand').first()
+        stand.name = 'TV Stand'
+        stand.save()
+        Products(name='Telephone', category='Electronics', available=True, price=5).save()
+        resp = self.app.get('/products/search', query_string='q=tele electronics')
+        self.assertEqual([product['name'] for product in resp.get_json()],
+                         ['Telephone', 'Flat Screen Television'])
+        resp = self.app.get('/products/search', query_string='q=stand')
+        self.assertEqual([product['name'] for product in resp.get_json()], ['TV Stand'])
+        resp = self.app.delete('/products/{}'.format(stand.id))
+        resp = self.app.get('/products/search', query_string='q=stand')
+        self.assertEqual(resp.get_json(), [])
+
+    def test_search_products_bad_args(self):
+        """ Search without words or with a bad page """
+        resp = self.app.get('/products/search', query_string='q=')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/products/search', query_string='q=tv&offset=-1')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/products/search', query_string='q=tv&limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/products/search', query_string='q=tv&limit=ten')
+        self.assertEqual(resp.get_json()['message'], 'limit must be an integer')
+
+    def test_search_index_rebuild(self):
+        """ Rebuild an expired search index in the background """
+        self._create_products(2)
+        self.app.get('/products/search', query_string='q=anything')
+        Products.search_index.built_at -= Products.search_index.max_age + 1
+        with mock.patch('app.models.threading.Thread') as thread:
+            self.app.get('/products/search', query_string='q=anything')
+        self.assertTrue(thread.return_value.start.called)
+        Products._rebuild_search_index(Products.search_index)
+        self.assertFalse(Products.search_index.expired())
+        self.assertFalse(Products.search_index.rebuilding)
+
+    def test_export_products(self):
+        """ Export every Product as NDJSON and as CSV """
+        products = self._create_products(3)
+        resp = self.app.get('/products/export')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertEqual(resp.mimetype, 'application/x-ndjson')
+        self.assertIn('products.ndjson', resp.headers['Content-Disposition'])
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual([json.loads(line)['id'] for line in lines],
+                         [product.id for product in products])
+        resp = self.app.get('/products/export', query_string='format=csv')
+        self.assertEqual(resp.mimetype, 'text/csv')
+        lines = resp.get_data(as_text=True).splitlines()
+        self.assertEqual(lines[0], 'id,name,category,available,price')
+        self.assertEqual(len(lines), 4)
+        self.assertTrue(lines[1].startswith('{},'.format(products[0].id)))
+        # both formats read like the other read-only requests
+        for query in ('', 'format=csv'):
+            with mock.patch('app.service.Products.read_query',
+                            side_effect=Products.read_query) as read_mock:
+                self.app.get('/products/export', query_string=query).get_data()
+                self.assertTrue(read_mock.called, query)
+
+    def test_import_products(self):
+        """ Import Products from NDJSON and CSV, reporting the bad lines """
+        lines = [json.dumps(ProductFactory().serialize()) for _ in range(3)]
+        lines.insert(1, '{"name": "no price"}')
+        lines.append('not json')
+        resp = self.app.post('/products/import', query_string='batch_size=2',
+                             data='\n'.join(lines), content_type='application/x-ndjson')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        report = resp.get_json()
+        self.assertEqual((report['imported'], report['invalid'], report['failed']), (3, 2, 0))
+        self.assertEqual([error['line'] for error in report['errors']], [2, 5])
+        self.assertIn('rows_per_second', report)
+        # a CSV export imports back as the same products
+        exported = self.app.get('/products/export', query_string='format=csv').get_data()
+        Products.delete_all()
+        resp = self.app.post('/products/import', data=exported, content_type='text/csv')
+        self.assertEqual(resp.get_json()['imported'], 3)
+        self.assertEqual(len(self.app.get('/products').get_json()), 3)
+        resp = self.app.post('/products/import', data='name', content_type='text/plain')
+        self.assertEqual(resp.status_code, status.HTTP_415_UNSUPPORTED_MEDIA_TYPE)
+
+    def test_product_changes(self):
+        """ Follow the changes to the Products by sequence number """
+        resp = self.app.get('/products/changes')
+        self.assertEqual(resp.get_json(), {'changes': [], 'next': 0})
+        products = self._create_products(2)
+        self.app.put('/products/{}/unavailable'.format(products[0].id))
+        self.app.delete('/products/{}'.format(products[1].id))
+        self.app.delete('/products/bulk', json=[products[0].id], content_type='application/json')
+        resp = self.app.get('/products/changes', query_string='since=0&limit=4')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([(change['id'], change['operation']) for change in data['changes']],
+                         [(products[0].id, 'created'), (products[1].id, 'created'),
+                          (products[0].id, 'updated'), (products[1].id, 'deleted')])
+        self.assertEqual(data['next'], 4)
+        # the product is read when the changes are, so it is gone by now
+        self.assertEqual(data['changes'][0]['product'], None)
+        Products.delete_all()
+        resp = self.app.get('/products/changes', query_string='since=4')
+        self.assertEqual([change['operation'] for change in resp.get_json()['changes']],
+                         ['deleted', 'reset'])
+        resp = self.app.get('/products/changes', query_string='since=-1')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_product_changes_long_poll(self):
+        """ Wait for a change that is not there yet """
+        service.app.config['CHANGES_POLL_INTERVAL'] = 0.05
+        try:
+            resp = self.app.get('/products/changes', query_string='since=0&wait=0.1')
+            self.assertEqual(resp.get_json(), {'changes': [], 'next': 0})
+            product = self._create_products(1)[0]
+            resp = self.app.get('/products/changes', query_string='since=0&wait=5')
+            self.assertEqual(resp.get_json()['changes'][0]['product']['id'], product.id)
+        finally:
+            service.app.config['CHANGES_POLL_INTERVAL'] = 1.0
+
+    def test_product_changes_events(self):
+        """ Stream the changes as server-sent events """
+        products = self._create_products(2)
+        service.app.config['CHANGES_STREAM_SECONDS'] = 0
+        try:
+            resp = self.app.get('/products/changes', headers={'Accept': 'text/event-stream',
+                                                              'Last-Event-ID': '1'})
+            self.assertEqual(resp.mimetype, 'text/event-stream')
+            events = resp.get_data(as_text=True).split('\n\n')
+            self.assertEqual(events[1].split('\n')[:2], ['id: 2', 'event: created'])
+            data = json.loads(events[1].split('\n')[2][len('data: '):])
+            self.assertEqual(data['product']['id'], products[1].id)
+            resp = self.app.get('/products/changes', headers={'Accept': 'text/event-stream',
+                                                              'Last-Event-ID': 'x'})
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        finally:
+            service.app.config['CHANGES_STREAM_SECONDS'] = 300.0
+
+    def test_lookup_products(self):
+        """ Get many Products by id in one request """
+        products = self._create_products(3)
+        ids = [products[2].id, 0, products[0].id, products[2].id]
+        self.app.get('/products/{}'.format(products[0].id))  # cache it
+        hits = Products.cache.stats()['hits']
+        resp = self.app.get('/products', query_string='ids=' + ','.join(str(i) for i in ids))
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([product['id'] for product in data['products']],
+                         [products[2].id, products[0].id])
+        self.assertEqual(data['not_found'], [0])
+        self.assertEqual(Products.cache.stats()['hits'], hits + 1)
+        # the others were cached by the lookup
+        resp = self.app.post('/products/lookup', json=ids, content_type='application/json')
+        self.assertEqual(resp.get_json(), data)
+        self.assertEqual(Products.cache.stats()['hits'], hits + 3)
+        resp = self.app.post('/products/lookup', json={"ids": [products[1].id]},
+                             content_type='application/json')
+        self.assertEqual(resp.get_json()['products'][0]['name'], products[1].name)
+        resp = self.app.get('/products', query_string='ids={}'.format(products[1].id))
+        self.assertEqual(len(resp.get_json()['products']), 1)
+        resp = self.app.get('/products', query_string='ids=0')
+        self.assertEqual(resp.get_json(), {'products': [], 'not_found': [0]})
+        for body in [{"ids": "1"}, ["one"], [True]]:
+            resp = self.app.post('/products/lookup', json=body, content_type='application/json')
+            self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/products', query_string='ids=1,x')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_cheapest_products(self):
+        """ Get the cheapest Products of a category """
+        for name, category, price in [('TV', 'Electronics', 500), ('Radio', 'Electronics', 19.99),
+                                      ('Cable', 'Electronics', 19.99), ('Shirt', 'Clothing', 5)]:
+            Products(name=name, category=category, available=True, price=price).save()
+        resp = self.app.get('/products/cheapest', query_string='category=Electronics&limit=2')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([product['name'] for product in data], ['Radio', 'Cable'])
+        self.assertEqual(data[0]['price'], '19.99')
+        resp = self.app.get('/products/cheapest', query_string='limit=0')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+        resp = self.app.get('/products', query_string='price=19.99')
+        self.assertEqual(len(resp.get_json()), 2)
+
+    def test_products_stats(self):
+        """ Get the number of Products and their prices by category """
+        for name, category, available, price in [('TV', 'Electronics', True, 100),
+                                                 ('Radio', 'Electronics', False, 25.5),
+                                                 ('Chair', 'Furniture', True, None),
+                                                 ('Gift', None, True, 10)]:
+            Products(name=name, category=category, available=available, price=price).save()
+        resp = self.app.get('/products/stats')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        data = resp.get_json()
+        self.assertEqual([group['category'] for group in data], [None, 'Electronics', 'Furniture'])
+        self.assertEqual(data[1], {'category': 'Electronics', 'count': 2, 'available_count': 1,
+                                   'avg_price': 62.75, 'min_price': 25.5, 'max_price': 100})
+        self.assertEqual(data[2]['avg_price'], None)
+        resp = self.app.get('/products/stats', query_string='group_by=available,category')
+        data = resp.get_json()
+        self.assertEqual(len(data), 4)
+        self.assertEqual(data[0]['available'], False)
+        self.assertEqual(data[0]['category'], 'Electronics')
+        resp = self.app.get('/products/stats', query_string='group_by=price')
+        self.assertEqual(resp.status_code, status.HTTP_400_BAD_REQUEST)
+
+    def test_products_stats_summary(self):
+        """ Keep the stats summary up to date through every kind of write """
+        service.app.config['STATS_SUMMARY'] = True
+        try:
+            service.init_db()
+            products = self._create_products(6)
+            products[0].price = 1000000
+            products[0].category = 'Luxury'
+            products[0].save()
+            self.app.put('/products/{}/unavailable'.format(products[1].id))
+            self.app.delete('/products/{}'.format(products[2].id))
+            self.app.put('/products/bulk', json=[dict(products[3].serialize(), price=0.5)],
+                         content_type='application/json')
+            self.app.delete('/products/bulk', json=[products[4].id],
+                            content_type='application/json')
+            self.app.post('/products/bulk', json=[products[5].serialize()],
+                          content_type='application/json')
+            for group_by in ['category', 'available', 'category,available']:
+                query_string = 'group_by=' + group_by
+                summary = self.app.get('/products/stats', query_string=query_string).get_json()
+                service.app.config['STATS_SUMMARY'] = False
+                service.init_db()
+                computed = self.app.get('/products/stats', query_string=query_string).get_json()
+                self.assertEqual(summary, computed)
+                service.app.config['STATS_SUMMARY'] = True
+                service.init_db()
+        finally:
+            service.app.config['STATS_SUMMARY'] = False
+            service.init_db()
+
+    def test_connection_pool_stats(self):
+        """ Get the connection pool statistics """
+        self._create_products(1)
+        resp = self.app.get('/pool/stats')
+        self.assertEqual(resp.status_code, status.HTTP_200_OK)
+        self.assertIn('pool', resp.get_json())
+
     def test_method_not_allowed(self):
         """ Test a sending invalid http method """
         resp = self.app.post('/products/1')
@@ -0,0 +1,268 @@
+"""
+Test cases for the Sharded Products
+
+Test cases can be run with:
+  pytest tests/test_sharding.py
+"""
+
+import os
+import unittest
+import mock
+from sqlalchemy.exc import IntegrityError
+from app.models import Products, ProductChange, ProductIds, db
+from app.vcap_services import get_shard_uris
+from app import app, service
+from tests import test_products, test_server
+
+DATABASE_URI = os.getenv('DATABASE_URI', 'sqlite:///../db/test.db')
+DB_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'db')
+SHARDS = [os.path.join(DB_DIR, 'test_shard_{}.db'.format(shard)) for shard in range(3)]
+
+
+def remove_shards():
+    """ Deletes the databases of the shards """
+    for path in SHARDS:
+        if os.path.exists(path):
+            os.remove(path)
+
+
+def on_shards():
+    """ Returns the names of the products on each shard, by id """
+    names = []
+    for engine in db.shards.engines:
+        table = Products.__table__
+        names.append([name for name, in engine.execute(
+            table.select().with_only_columns([table.c.name]).order_by(table.c.id))])
+    return names
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestSharding(unittest.TestCase):
+    """ Test Cases for products sharded across databases """
+
+    @classmethod
+    def setUpClass(cls):
+        app.debug = False
+        app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URI
+
+    @classmethod
+    def tearDownClass(cls):
+        remove_shards()
+
+    def setUp(self):
+        self.config = mock.patch.dict(app.config, SHARD_ID_BLOCK=10,
+                                      SHARD_URIS=['sqlite:///' + path for path in SHARDS])
+        self.config.start()
+        self.use_shards('id')
+
+    def tearDown(self):
+        db.session.remove()
+        db.drop_all()
+        self.config.stop()
+        Products.init_db(app)
+
+    def use_shards(self, key):
+        """ Initializes the database with shards placed by key """
+        app.config['SHARD_KEY'] = key
+        Products.init_db(app)
+        db.drop_all()    # clean up the last tests
+        db.create_all()  # make our sqlalchemy tables
+
+    def create(self, *products):
+        """ Saves (name, category, price) products and returns their ids """
+        ids = []
+        for name, category, price in products:
+            product = Products(name=name, category=category, available=True, price=price)
+            product.save()
+            ids.append(product.id)
+        return ids
+
+    def test_place_by_id(self):
+        """ Spread new products over the shards by their id """
+        ids = self.create(('A', 'Pets', 3), ('B', 'Toys', 1), ('C', 'Pets', 2), ('D', 'Toys', 4))
+        self.assertEqual(ids, [1, 2, 3, 4])
+        self.assertEqual(on_shards(), [['C'], ['A', 'D'], ['B']])
+        self.assertEqual(db.session.query(ProductIds.next_value).scalar(), 11)
+        # another worker reserves the next block
+        self.assertEqual(ProductIds.allocate(10), 11)
+        self.assertEqual(db.shards.stats()['key'], 'id')
+
+    def test_place_by_category(self):
+        """ Keep the products of a category on one shard """
+        self.use_shards('category')
+        ids = self.create(('A', 'Pets', 3), ('B', 'Toys', 1), ('C', 'Pets', 2))
+        self.assertEqual(len(set(ids)), 3)
+        shards = [db.shards.for_id(product_id) for product_id in ids]
+        self.assertEqual(shards[0], shards[2])
+        self.assertEqual(shards[0], db.shards.for_category('Pets'))
+        self.assertEqual(shards[1], db.shards.for_category('Toys'))
+        self.assertEqual(Products.find(ids[2]).name, 'C')
+
+    def test_single_product(self):
+        """ Read, update and delete a product on its shard """
+        product_id = self.create(('A', 'Pets', 3), ('B', 'Toys', 1))[1]
+        db.session.remove()
+        product = Products.find(product_id)
+        self.assertEqual(product.name, 'B')
+        product.name = 'Ball'
+        product.save()
+        self.assertEqual(Products.update_by_id(product_id, {'price': 5}, version=2).price, 5)
+        self.assertEqual(on_shards(), [[], ['A'], ['Ball']])
+        Products.find(product_id).delete()
+        self.assertEqual(Products.find(product_id), None)
+        self.assertEqual(on_shards(), [[], ['A'], []])
+        self.assertEqual([change['operation'] for change in ProductChange.since(0)],
+                         ['created', 'created', 'updated', 'updated', 'deleted'])
+
+    def test_fan_out(self):
+        """ Merge the rows of every shard in order and cut them to the page """
+        self.create(('A', 'Pets', 3), ('B', 'Toys', 1), ('C', 'Pets', 2),
+                    ('D', 'Toys', 4), ('E', 'Pets', None))
+        self.assertEqual([product.name for product in Products.all()], list('ABCDE'))
+        self.assertEqual(Products.query.count(), 5)
+        self.assertEqual(Products.find_by_category('Pets').count(), 3)
+        products, after = Products.page(limit=2)
+        self.assertEqual(([product.id for product in products], after), ([1, 2], 2))
+        products, after = Products.page(after=2, limit=2)
+        self.assertEqual([product.id for product in products], [3, 4])
+        self.assertEqual([product.name for product in Products.cheapest(3)], ['B', 'C', 'A'])
+        query = Products.query.order_by(Products.price.desc(), Products.id).offset(1).limit(2)
+        self.assertEqual([product.name for product in query], ['A', 'C'])
+        self.assertEqual([product.name for product in Products.stream(batch_size=2)], list('ABCDE'))
+        self.assertEqual(db.shards.stats()['fan_out_queries'] > 0, True)
+
+    def test_aggregates(self):
+        """ Add up the stats and validators of the shards """
+        self.create(('A', 'Pets', 3), ('B', 'Toys', 1), ('C', 'Pets', 2))
+        stats = Products.stats()
+        self.assertEqual([(row['category'], row['count'], row['min_price'], row['max_price'])
+                          for row in stats], [('Pets', 2, 2.0, 3.0), ('Toys', 1, 1.0, 1.0)])
+        self.assertEqual(stats[0]['avg_price'], 2.5)
+        before = Products.list_validators()
+        Products.update_by_id(2, {'price': 6})
+        self.assertNotEqual(Products.list_validators()['etag'], before['etag'])
+
+    def test_bulk(self):
+        """ Write the bulk operations and the import to each product's shard """
+        results = Products.bulk_create([{'name': name, 'category': 'Pets', 'available': True,
+                                         'price': 1} for name in 'ABCD'])
+        self.assertEqual([result['id'] for result in results], [1, 2, 3, 4])
+        results = Products.bulk_update([{'id': 2, 'name': 'Bee', 'category': 'Pets',
+                                         'available': False, 'price': 2},
+                                        {'id': 9, 'name': 'X', 'category': 'Pets',
+                                         'available': True, 'price': 1}])
+        self.assertEqual([result['status'] for result in results], ['updated', 'not found'])
+        self.assertEqual(Products.set_availability({1: False, 3: False, 9: True}), set([1, 3]))
+        results = Products.bulk_delete([4, 9])
+        self.assertEqual([result['status'] for result in results], ['deleted', 'not found'])
+        report = Products.import_products([{'name': 'E', 'category': 'Toys', 'available': True,
+                                            'price': 5}])
+        self.assertEqual(report['imported'], 1)
+        self.assertEqual(on_shards(), [['C'], ['A'], ['Bee', 'E']])
+        self.assertEqual([product.available for product in Products.all()],
+                         [False, False, False, True])
+        self.assertEqual(Products.query.filter_by(category='Pets').update({'price': 7}), 3)
+        self.assertEqual(Products.query.filter_by(category='Toys').delete(), 1)
+        Products.delete_all()
+        self.assertEqual(on_shards(), [[], [], []])
+
+    def test_rest_api(self):
+        """ Serve the same API from the shards """
+        client = service.app.test_client()
+        for name in 'ABC':
+            resp = client.post('/products', json={'name': name, 'category': 'Pets',
+                                                  'available': True, 'price': 1})
+            self.assertEqual(resp.status_code, 201)
+        resp = client.get('/products?category=Pets')
+        self.assertEqual([product['id'] for product in resp.get_json()], [1, 2, 3])
+        self.assertEqual(client.get('/products/2').get_json()['name'], 'B')
+        self.assertEqual(client.delete('/products/2').status_code, 204)
+        self.assertEqual(client.get('/products/2').status_code, 404)
+        stats = client.get('/pool/stats').get_json()
+        self.assertEqual(len(stats['shards']['shards']), 3)
+
+    def test_saved_after_fan_out(self):
+        """ Save the changes to products that a fan-out query read """
+        self.create(('A', 'Pets', 3), ('B', 'Toys', 1))
+        db.session.remove()
+        product = Products.find_by_name('B').first()
+        self.assertEqual(product in db.session, True)
+        product.name = 'Ball'
+        product.save()
+        self.assertEqual([product.name for product in Products.all()], ['A', 'Ball'])
+        self.assertEqual(on_shards(), [[], ['A'], ['Ball']])
+
+    def test_recreated_ids(self):
+        """ Start the ids past the shards when the allocator is recreated """
+        self.create(('A', 'Pets', 3), ('B', 'Toys', 1))
+        ProductIds.__table__.drop(db.engine)
+        ProductIds.__table__.create(db.engine)
+        self.assertEqual(ProductIds.allocate(10), 3)
+        # a block reserved before the tables were recreated is given up on its first conflict
+        db.shards.next_value, db.shards.last_value = 1, 11
+        self.assertRaises(IntegrityError, self.create, ('C', 'Pets', 2))
+        self.assertEqual(self.create(('C', 'Pets', 2)), [13])
+        db.shards.next_value, db.shards.last_value = 1, 11
+        results = Products.bulk_create([{'name': name, 'category': 'Pets', 'available': True,
+                                         'price': 1} for name in 'DE'])
+        self.assertEqual([result['id'] for result in results], [23, 24])
+        # recreating the tables of every database starts the ids over
+        db.session.remove()
+        db.drop_all()
+        db.create_all()
+        self.assertEqual(self.create(('F', 'Pets', 2)), [1])
+
+    def test_shard_uris(self):
+        """ Read the shard URIs from the environment """
+        with mock.patch.dict(os.environ, {'DATABASE_SHARD_URIS': 'sqlite:///a.db,sqlite:///b.db'}):
+            self.assertEqual(get_shard_uris(), ['sqlite:///a.db', 'sqlite:///b.db'])
+        with mock.patch.dict(os.environ, {'DATABASE_SHARD_URIS': ''}):
+            self.assertEqual(get_shard_uris(), [])
+
+
+class Sharded(object):
+    """ Runs the tests of a test case with the products on shards """
+
+    @classmethod
+    def setUpClass(cls):
+        super(Sharded, cls).setUpClass()
+        cls.shard_config = mock.patch.dict(app.config, SHARD_URIS=['sqlite:///' + path
+                                                                   for path in SHARDS])
+        cls.shard_config.start()
+
+    @classmethod
+    def tearDownClass(cls):
+        db.session.remove()
+        db.drop_all()
+        cls.shard_config.stop()
+        Products.init_db(app)
+        remove_shards()
+        super(Sharded, cls).tearDownClass()
+
+
+class TestShardedProducts(Sharded, test_products.TestProducts):
+    """ The model tests with the products on shards """
+
+    @unittest.skip('the rows of each shard are inserted with their ids, see test_bulk')
+    def test_bulk_create_executemany(self):
+        pass
+
+
+class TestShardedServer(Sharded, test_server.TestProductsServer):
+    """ The server tests with the products on shards """
+
+    @unittest.skip('the sharded products are not read from replicas')
+    def test_read_replica_requests(self):
+        pass
+
+    @unittest.skip('the sharded products are not read from replicas')
+    def test_read_replica_after_write(self):
+        pass
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+"""
+Test cases for the Catalog Export and Import Formats
+
+Test cases can be run with:
+  pytest tests/test_transfer.py
+"""
+
+import unittest
+from app.transfer import csv_lines, read_csv, read_ndjson, copy_line
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestTransfer(unittest.TestCase):
+    """ Test Cases for the NDJSON and CSV formats """
+
+    def test_csv_round_trip(self):
+        """ Write products as CSV and read them back """
+        rows = [(1, u'Café, "Deluxe"', u'Food', True, 4.5),
+                (2, u'Radio', None, False, None)]
+        lines = list(csv_lines(rows))
+        self.assertEqual(len(lines), 3)
+        self.assertEqual(lines[0].strip(), 'id,name,category,available,price')
+        items = list(read_csv(line for text in lines for line in text.splitlines(True)))
+        self.assertEqual(items[0], {'id': u'1', 'name': u'Café, "Deluxe"', 'category': u'Food',
+                                    'available': True, 'price': u'4.5'})
+        self.assertEqual(items[1]['category'], None)
+        self.assertEqual(items[1]['available'], False)
+
+    def test_read_bad_csv(self):
+        """ Read rows that do not match the header or have a bad available """
+        items = list(read_csv([b'name,available\n', b'\n', b'TV,yes\n', b'TV\n', b'TV,maybe\n']))
+        self.assertEqual(items, [{'name': u'TV', 'available': True}, None, None])
+
+    def test_read_ndjson(self):
+        """ Read NDJSON lines, skipping blank ones """
+        items = list(read_ndjson([b'{"name": "TV"}\n', b'\n', b'{bad\n']))
+        self.assertEqual(items, [{'name': 'TV'}, None])
+
+    def test_copy_line(self):
+        """ Tell NULL from an empty string in COPY lines """
+        self.assertEqual(copy_line((u'a "b"', u'', None, True, 2.5, 1)),
+                         u'"a ""b""","",,t,2.5,1\n')
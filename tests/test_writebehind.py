@@ -0,0 +1,99 @@
+"""
+Test cases for the Write-Behind Availability Queue
+
+Test cases can be run with:
+  pytest tests/test_writebehind.py
+"""
+
+import unittest
+from flask import Flask
+from app.models import VersionConflictError
+from app.writebehind import AvailabilityQueue
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestAvailabilityQueue(unittest.TestCase):
+    """ Test Cases for the write-behind queue """
+
+    def setUp(self):
+        self.writes = []
+        self.versions = []
+        self.queue = AvailabilityQueue(Flask(__name__), self.write, interval=60, batch_size=3)
+
+    def tearDown(self):
+        self.queue.close()
+
+    def write(self, changes, versions, found):
+        """ Records a batch and writes every product but 0, at every version but 0 """
+        self.writes.append(changes)
+        self.versions.append(versions)
+        found.update(product_id for product_id in changes
+                     if product_id != 0 and versions[product_id] != 0)
+        return found
+
+    def test_merge_changes(self):
+        """ Keep only the last change to a product """
+        first = self.queue.put(1, False, 1)
+        second = self.queue.put(1, True, 2)
+        missing = self.queue.put(0, False, 1)
+        self.assertEqual(self.queue.flush(), 1)
+        self.assertEqual(self.writes, [{1: True, 0: False}])
+        self.assertEqual(self.versions, [{1: 2, 0: 1}])
+        for pending in (first, second):
+            self.assertTrue(pending.wait(0))
+            self.assertTrue(pending.found)
+        self.assertFalse(missing.found)
+        self.assertEqual(self.queue.stats(), {"queued": 0, "flushes": 1, "written": 1,
+                                              "merged": 1, "failures": 0})
+
+    def test_full_batch(self):
+        """ Write as soon as a batch is full rather than after the interval """
+        pending = [self.queue.put(product_id, False, 1) for product_id in (1, 2, 3)]
+        self.assertTrue(pending[0].wait(5))
+        self.assertEqual(self.writes, [{1: False, 2: False, 3: False}])
+
+    def test_close(self):
+        """ Write the queued changes when the queue is closed """
+        pending = self.queue.put(1, False, 1)
+        self.assertFalse(pending.wait(0))
+        self.queue.close()
+        self.assertTrue(pending.wait(0))
+        self.assertEqual(self.writes, [{1: False}])
+        self.assertEqual(self.queue.thread, None)
+
+    def test_failed_write(self):
+        """ Report a batch that could not be written to its requests """
+        self.queue.write = lambda changes, versions, found: 1 / 0
+        pending = self.queue.put(1, False, 1)
+        self.assertEqual(self.queue.flush(), 0)
+        self.assertTrue(pending.failed)
+        self.assertEqual(self.queue.stats()['failures'], 1)
+
+    def test_partly_failed_write(self):
+        """ Report the changes committed before a batch failed as written """
+        def write(changes, versions, found):
+            """ Commits product 1, then fails """
+            found.add(1)
+            raise VersionConflictError('Products changed')
+        self.queue.write = write
+        written = self.queue.put(1, False, 1)
+        lost = self.queue.put(2, False, 1)
+        self.assertEqual(self.queue.flush(), 1)
+        self.assertEqual((written.found, written.failed), (True, False))
+        self.assertEqual((lost.found, lost.failed), (False, True))
+        self.assertEqual(self.queue.stats()['written'], 1)
+
+    def test_superseded_write(self):
+        """ Report a change that was not written because its product changed """
+        pending = self.queue.put(1, False, 0)
+        self.assertEqual(self.queue.flush(), 0)
+        self.assertFalse(pending.found)
+        self.assertFalse(pending.failed)
+
+
+######################################################################
+#   M A I N
+######################################################################
+if __name__ == '__main__':
+    unittest.main()